@@ -5,13 +5,14 @@ import time
 
 from skopt import gp_minimize
 
+from game.game import draw_seed, derive_seed
 from gt.brg import compute_eps_brg
 from gt.eq import compute_scc_eq, save_eq_data, aggregators, aggregate
 from bo_util import safe_create_dir, save_step_config_file, read_reserve_prices, \
-    read_revenue, get_gaussian, get_tuple_of_reserves, get_map_of_reserves, \
+    get_gaussian, get_tuple_of_reserves, get_map_of_reserves, \
     read_reserve_prices_from_dict, \
     MIN_RESERVE_PRICE, MAX_RESERVE_PRICE, map_of_initial_reserve, get_gp_algorithm_param
-from experiments import estimate_a_single_game
+from experiments import estimate_a_single_game, shutdown_simulation_pool, utilization_reports, save_in_background, wait_for_saves
 from singletonsetup import SingletonSetup
 
 """
@@ -20,22 +21,29 @@ from singletonsetup import SingletonSetup
 """
 
 
-def query_game(the_setup, the_results_dir, the_eps):
+def query_game(the_setup, the_results_dir, the_eps, the_seed=None, the_raw_results=False):
     """
     Given the setup object, the results dir and the eps, this function call other functions that
     1) simulate the game
     2) compute the eps brg
     3) save the game play data.
+    Each step hands its results to the next in memory, and files are saved in the background, so that the optimizer does not wait for the disk.
     :param the_setup:
     :param the_results_dir:
     :param the_eps:
-    :return:
+    :param the_seed: the seed of the random streams of the step.
+    :param the_raw_results: if True, the results of all games are saved to results.csv, e.g., for plots that need them, instead of only their
+    aggregate to results.json.
+    :return: the revenue of the game, negated, as read_revenue would read it from the saved file.
     """
     # Estimate the game.
-    estimate_a_single_game(the_setup, file=the_results_dir + 'results.csv', serial=False)
+    results = estimate_a_single_game(the_setup, file=the_results_dir + ('results.csv' if the_raw_results else 'results.json'), serial=False,
+                                     seed=the_seed, checkpoint=True, asynchronous=True)
+    print(f"\t\t Utilization of the simulation pool = {100.0 * utilization_reports[-1]['utilization']:.1f}% "
+          f"({utilization_reports[-1]['chunks']} chunks in {utilization_reports[-1]['wall_time']:.1f}s)")
 
     # Compute the BRG
-    G, revenue_per_node = compute_eps_brg(file=the_results_dir + 'results.csv', eps=the_eps, normalize_revenue=True)
+    G, revenue_per_node = compute_eps_brg(eps=the_eps, normalize_revenue=True, results=results)
 
     # Compute the eq - In this case SCC eq.
     family_of_nodes, revenue_per_node_per_family_member = compute_scc_eq(G=G, revenue_per_node=revenue_per_node)
@@ -44,11 +52,14 @@ def query_game(the_setup, the_results_dir, the_eps):
     # family_of_nodes, revenue_per_node_per_family_member = compute_sink_eq(G=G, revenue_per_node=revenue_per_node)
 
     # Save the data from the equilibria to a file that can be read later.
-    save_eq_data(family_of_nodes=family_of_nodes,
-                 revenue_per_node_per_family_member=revenue_per_node_per_family_member,
-                 aggregations=aggregate(revenue_per_node_per_family_member, aggregators['min-min'][0], aggregators['min-min'][1]),
-                 file=the_results_dir + 'eq.txt',
-                 verbose=False)
+    aggregations = aggregate(revenue_per_node_per_family_member, aggregators['min-min'][0], aggregators['min-min'][1])
+    save_in_background(save_eq_data,
+                       family_of_nodes=family_of_nodes,
+                       revenue_per_node_per_family_member=revenue_per_node_per_family_member,
+                       aggregations=aggregations,
+                       file=the_results_dir + 'eq.txt',
+                       verbose=False)
+    return -aggregations[0]
 
 
 if len(sys.argv) > 1:
@@ -73,11 +84,20 @@ eps_values = eval(expt_config['PARAMETERS']['eps_values'])
 delta = float(expt_config['PARAMETERS']['delta'])
 budget = int(expt_config['PARAMETERS']['budget'])
 trials = int(expt_config['PARAMETERS']['trials'])
+# The seed of the whole experiment, from which the seed of each step is derived. If there is none yet, draw one and save it, so that reruns reproduce
+# the experiment.
+if 'seed' not in expt_config['PARAMETERS']:
+    expt_config['PARAMETERS']['seed'] = str(draw_seed())
+    with open(expt_directory_base + 'config.ini', 'w') as expt_config_file:
+        expt_config.write(expt_config_file)
+seed = int(expt_config['PARAMETERS']['seed'])
+# Whether to save the results of all games of each step, and not only their aggregate.
+raw_results = expt_config['PARAMETERS'].getboolean('raw_results', fallback=False)
 
 # We will perform a number of trials ...
 for trial in range(start_trial, trials):
     # .. For a number of epsilons.
-    for eps in eps_values:
+    for eps_index, eps in enumerate(eps_values):
         # Create the folder for the experiment
         expt_directory = safe_create_dir(expt_directory_base + algorithm + '/eps_' + str(eps) + '/trial_' + str(trial) + '/', False)
 
@@ -110,9 +130,8 @@ for trial in range(start_trial, trials):
             SingletonSetup.set_reserve_prices(the_init_reserve)
             SingletonSetup.set_expt_step(init_x_folder_index)
             safe_create_dir(f'{expt_directory}{init_x_folder_index}', False)
-            query_game(my_setup, expt_directory + str(my_setup.expt_step) + '/', eps)
+            revenue_at_step = query_game(my_setup, expt_directory + str(my_setup.expt_step) + '/', eps, derive_seed(seed, (trial, eps_index, 0, i)), raw_results)
             save_step_config_file(init_x_folder_index, the_init_reserve, expt_directory, False)
-            revenue_at_step = read_revenue(init_x_folder_index, expt_directory)
             # print(f'\t Revenue for this initial reserve = {revenue_at_step}')
             revenue_map[get_tuple_of_reserves(the_init_reserve)] = revenue_at_step
 
@@ -130,10 +149,8 @@ for trial in range(start_trial, trials):
             # Update the setup with the experiment step and the reserve prices.
             SingletonSetup.set_reserve_prices(current_reserve_prices)
             SingletonSetup.set_expt_step(i)
-            query_game(my_setup, expt_directory + str(my_setup.expt_step) + '/', eps)
-
-            # Read the value of the revenue found.
-            revenue_at_step = read_revenue(i, expt_directory)
+            # The value of the revenue found.
+            revenue_at_step = query_game(my_setup, expt_directory + str(my_setup.expt_step) + '/', eps, derive_seed(seed, (trial, eps_index, 1, i)), raw_results)
             # print(f'\t Revenue at step = {revenue_at_step}')
 
             # Query the next point using some search strategy. As of now, we have Random and B.O.
@@ -181,3 +198,7 @@ for trial in range(start_trial, trials):
         #    revenue_table.add_row([r, rev])
         # print(revenue_table)
         # print(f'\n total_time for one BO experiment with budget = {budget}  = {time.time() - initial_time_bo}')
+
+# All steps, eps and trials shared the simulation pool. Results and equilibria may still be being saved.
+shutdown_simulation_pool()
+wait_for_saves()
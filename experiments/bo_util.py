@@ -34,7 +34,7 @@ ordered_segments = [('Male', 'Young', 'High'),
                     ('Female', 'Old', 'Low')]
 Gaussian = namedtuple('Gaussian', ['mean', 'std'])
 
-# Since the has of a good is by the first letter of segments, we need this map to convert between reserves prices store in config file and a map.
+# Since goods are stored in config files by their id, i.e., the first letter of segments, we need this map to convert between reserves prices store in config file and a map.
 letter_to_segment = {'f': 'Female', 'm': 'Male', 'h': 'High', 'l': 'Low', 'y': 'Young', 'o': 'Old'}
 
 
@@ -1,19 +1,40 @@
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
 from multiprocessing import cpu_count
 
+import atexit
+import math
+import os
+import pickle
+import shutil
+import time
+import uuid
+from typing import List, Tuple, Callable, Dict
+
 import numpy as np
 import pandas as pd
 from prettytable import PrettyTable
 
-from game.statistics import compute_statistics
+from game.game import CampaignSampler, ImpressionSampler, get_random_generator, draw_seed
+from game.results import results_schema, ResultsWriter, ResultsAggregate
+from gt.brg import get_undecided_edges
+from game.statistics import compute_statistics, compute_statistics_batch, compute_target_match_mask
 from bo_util import safe_create_dir
 from singletonsetup import SingletonSetup
-from we_wf_experiments import run_we_wf_experiments
+from we_wf_experiments import run_we_wf_experiments, run_we_wf_profiles
+
+# The columns of the results of games, see summarize_games.
+results_columns = list(results_schema)
+
+# The static arguments of jobs in a worker of the simulation pool, see initialize_simulation_worker.
+worker_static_arguments = None
 
 
-def run_a_game_on_range(num_we, num_wf, k, start, end, m, reach_discount_factor, setup_base_goods, setup_pmf_base, setup_possible, setup_pmf_target, verbose):
+def run_a_game_on_range(num_we, num_wf, k, start, end, m, reach_discount_factor, setup_base_goods, setup_pmf_base, setup_possible, setup_pmf_target, verbose, auction_engine='reference',
+                        seed=None):
     """
-    Runs a single game on a range.
+    Runs a single game on a range. Unless verbose, statistics of all the games in the range are computed at once.
+    If seeded, game t draws all its randomness from the stream (num_we, t) of the seed, so that its results do not depend on the range it is played in.
     :param num_we:
     :param num_wf:
     :param k:
@@ -26,15 +47,142 @@ def run_a_game_on_range(num_we, num_wf, k, start, end, m, reach_discount_factor,
     :param setup_possible:
     :param setup_pmf_target:
     :param verbose:
+    :param auction_engine:
+    :param seed: the seed of the random streams of the games. If None, games use the global random state.
     :return:
     """
-    results = []
-    for t in range(start, end):
-        results.append(run_a_game(num_we, num_wf, k, t, m, reach_discount_factor, setup_base_goods, setup_pmf_base, setup_possible, setup_pmf_target, verbose))
-    return results
+    rngs = [None if seed is None else get_random_generator(seed, (num_we, t)) for t in range(start, end)]
+    if verbose:
+        # Report each game as it is played.
+        return [run_a_game(num_we, num_wf, k, t, m, reach_discount_factor, setup_base_goods, setup_pmf_base, setup_possible, setup_pmf_target, verbose, auction_engine,
+                           rng) + (t, seed)
+                for t, rng in zip(range(start, end), rngs)]
+    # Play all the games of the range first, and then compute the statistics of all of them with a single call. The distributions of campaigns and
+    # impression opportunities are the same for all of them, so their samplers are built once.
+    campaign_sampler = CampaignSampler(num_we + num_wf, reach_discount_factor, k, setup_possible, setup_pmf_target)
+    impression_sampler = ImpressionSampler(setup_base_goods, setup_pmf_base)
+    campaigns_of_games = campaign_sampler.draw(end - start) if seed is None else [campaign_sampler.draw(1, rng)[0] for rng in rngs]
+    games = [run_we_wf_experiments(reach_discount_factor, k, num_we, num_wf, setup_base_goods, setup_pmf_base, setup_possible, setup_pmf_target, verbose, auction_engine, campaigns,
+                                   rng, impression_sampler)
+             for campaigns, rng in zip(campaigns_of_games, rngs)]
+    return [row + (t, seed) for row, t in zip(summarize_games(games), range(start, end))]
+
+
+def run_all_profiles_on_range(n, k, start, end, m, reach_discount_factor, setup_base_goods, setup_pmf_base, setup_possible, setup_pmf_target, verbose, auction_engine='reference',
+                              profiles=None, seed=None):
+    """
+    Runs the games of a range for all n + 1 profiles with common random numbers, i.e., each sampled market is played by every profile (see run_we_wf_profiles).
+    Neighbouring profiles then only differ in the strategy of the deviating player, and the results of a market share its index as sample, so that the
+    utilities of deviating players can be paired, see gt.brg.compute_paired_differences. If seeded, market t draws all its randomness from the stream
+    (n + 1, t) of the seed, which no single profile uses.
+    :param n:
+    :param k:
+    :param start:
+    :param end:
+    :param m:
+    :param reach_discount_factor:
+    :param setup_base_goods:
+    :param setup_pmf_base:
+    :param setup_possible:
+    :param setup_pmf_target:
+    :param verbose:
+    :param auction_engine:
+    :param profiles: the profiles to play, as numbers of WE players. If None, all n + 1 profiles.
+    :param seed: the seed of the random streams of the markets. If None, markets use the global random state.
+    :return:
+    """
+    campaign_sampler = CampaignSampler(n, reach_discount_factor, k, setup_possible, setup_pmf_target)
+    impression_sampler = ImpressionSampler(setup_base_goods, setup_pmf_base)
+    rngs = [None if seed is None else get_random_generator(seed, (n + 1, t)) for t in range(start, end)]
+    campaigns_of_games = campaign_sampler.draw(end - start) if seed is None else [campaign_sampler.draw(1, rng)[0] for rng in rngs]
+    games, samples = [], []
+    for t, campaigns, rng in zip(range(start, end), campaigns_of_games, rngs):
+        if verbose:
+            print("\r" + "All profiles \t -> \t " + str((t / (m - 1)) * 100 if m > 1 else 100.0) + "% done", end="")
+        profile_games = run_we_wf_profiles(reach_discount_factor, k, n, setup_base_goods, setup_pmf_base, setup_possible, setup_pmf_target, False, auction_engine, campaigns,
+                                           profiles, rng, impression_sampler)
+        games += profile_games
+        samples += [t] * len(profile_games)
+    return [row + (t, seed) for row, t in zip(summarize_games(games, samples), samples)]
+
+
+def summarize_games(games, samples: List[int] = None):
+    """
+    Computes the statistics of all the given games, i.e., results of run_we_wf_experiments, with a single call.
+    :param games:
+    :param samples: for each game, the index of the market it was played on, if markets are shared by profiles. Otherwise, None.
+    :return: for each game, the number of WE and WF players, the mean utility of WE and WF players, the revenue, the variance of the utility of WE and
+    WF players, the sample, and the utility of the deviating players, i.e., the last WE player and the first WF player (see summarize_deviators).
+    Callers add the index of the game and its seed, see results_columns.
+    """
+    if len(games) == 0:
+        return []
+    utilities, revenue = compute_statistics_batch(allocations=np.stack([the_allocations.values for _, _, the_allocations, _, _ in games]),
+                                                  expenditure=np.stack([the_expenditure.values for _, _, _, the_expenditure, _ in games]),
+                                                  matches_target=np.stack([compute_target_match_mask(the_allocations.campaigns, the_allocations.goods)
+                                                                           for _, _, the_allocations, _, _ in games]),
+                                                  reaches=np.array([[c.reach for c in the_allocations.campaigns] for _, _, the_allocations, _, _ in games]),
+                                                  budgets=np.array([[c.budget for c in the_allocations.campaigns] for _, _, the_allocations, _, _ in games]))
+    # Campaigns are listed with the WE players first, so WE (WF) players are the first num_we (last num_wf) campaigns.
+    samples = [None] * len(games) if samples is None else samples
+    return [(len(we_c), len(wf_c)) + summarize_utilities(utilities[t, :len(we_c)].tolist(), utilities[t, len(we_c):].tolist(), revenue[t])
+            + (samples[t],) + summarize_deviators(utilities[t, :len(we_c)].tolist(), utilities[t, len(we_c):].tolist())
+            for t, (we_c, wf_c, _, _, _) in enumerate(games)]
+
+
+def summarize_utilities(we_utilities, wf_utilities, revenue):
+    """
+    By symmetry, the utility of every player of a strategy is a sample of the utility of that strategy, so a game records the mean utility of the
+    players of each strategy, together with the variance among them, from which compute_effective_number_of_samples accounts for their correlation.
+    :param we_utilities: the utilities of WE players.
+    :param wf_utilities: the utilities of WF players.
+    :param revenue:
+    :return: the mean utility of WE and WF players, the revenue, and the variance of the utility of WE and WF players.
+    """
+    return float(np.mean(we_utilities)) if len(we_utilities) > 0 else 0.0, \
+           float(np.mean(wf_utilities)) if len(wf_utilities) > 0 else 0.0, \
+           revenue, \
+           float(np.var(we_utilities)) if len(we_utilities) > 0 else 0.0, \
+           float(np.var(wf_utilities)) if len(wf_utilities) > 0 else 0.0
+
+
+def summarize_deviators(we_utilities, wf_utilities):
+    """
+    Profile i + 1 is profile i where player i deviates from WF to WE. Since WE players come first, the deviating players of the edges of a profile are its
+    last WE player and its first WF player.
+    :param we_utilities: the utilities of WE players.
+    :param wf_utilities: the utilities of WF players.
+    :return: the utility of the last WE player and the utility of the first WF player, or NaN if there is no such player.
+    """
+    return float(we_utilities[-1]) if len(we_utilities) > 0 else math.nan, float(wf_utilities[0]) if len(wf_utilities) > 0 else math.nan
+
+
+def compute_effective_number_of_samples(results: pd.DataFrame) -> pd.DataFrame:
+    """
+    Computes, for each profile, how many independent samples of the utility of each strategy the games are worth. The players of a strategy in the same
+    game are correlated, so a game is worth between 1 and num_WE (num_WF) samples: the number of games times the ratio between the variance of the
+    utility of a player, given by the law of total variance, and the variance of the mean utility per game.
+    :param results: the results of estimate_a_single_game.
+    :return: a data frame with the number of games and the effective number of WE and WF samples of each profile.
+    """
+    rows = []
+    for (num_we, num_wf), data in results.groupby(['num_WE', 'num_WF']):
+        row = {'num_WE': num_we, 'num_WF': num_wf, 'games': len(data)}
+        for strategy, players in [('we', num_we), ('wf', num_wf)]:
+            variance_of_means = data[strategy].var(ddof=0)
+            variance = data[strategy + '_var'].mean() + variance_of_means
+            if players == 0:
+                row[strategy + '_samples'] = 0.0
+            elif variance_of_means > 0.0:
+                row[strategy + '_samples'] = float(np.clip(len(data) * variance / variance_of_means, len(data), len(data) * players))
+            else:
+                row[strategy + '_samples'] = float(len(data) * players)
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['num_WE', 'num_WF', 'games', 'we_samples', 'wf_samples'])
 
 
-def run_a_game(num_we, num_wf, k, t, m, reach_discount_factor, setup_base_goods, setup_pmf_base, setup_possible, setup_pmf_target, verbose):
+def run_a_game(num_we, num_wf, k, t, m, reach_discount_factor, setup_base_goods, setup_pmf_base, setup_possible, setup_pmf_target, verbose, auction_engine='reference',
+               rng=None):
     """
     Runs a single game.
     :param num_we:
@@ -48,21 +196,25 @@ def run_a_game(num_we, num_wf, k, t, m, reach_discount_factor, setup_base_goods,
     :param setup_possible:
     :param setup_pmf_target:
     :param verbose:
+    :param auction_engine:
+    :param rng: the numpy generator of all the randomness of the game. If None, the global random state.
     :return:
     """
     if verbose:
         print("\r" + "(WE, WF) = (", num_we, ",", num_wf, ") \t -> \t " + str((t / (m - 1)) * 100) + "% done", end="")
     # All fixed parameters are ready, can run an experiment now.
-    we_c, wf_c, the_allocations, the_expenditure = run_we_wf_experiments(reach_discount_factor,
-                                                                         k,
-                                                                         num_we,
-                                                                         num_wf,
-                                                                         setup_base_goods,
-                                                                         setup_pmf_base,
-                                                                         setup_possible,
-                                                                         setup_pmf_target,
-                                                                         verbose)
-    utilities, total_expenditure = compute_statistics(the_allocations, the_expenditure)
+    we_c, wf_c, the_allocations, the_expenditure, the_ledger = run_we_wf_experiments(reach_discount_factor,
+                                                                                     k,
+                                                                                     num_we,
+                                                                                     num_wf,
+                                                                                     setup_base_goods,
+                                                                                     setup_pmf_base,
+                                                                                     setup_possible,
+                                                                                     setup_pmf_target,
+                                                                                     verbose,
+                                                                                     auction_engine,
+                                                                                     rng=rng)
+    utilities, total_expenditure = compute_statistics(the_allocations, the_expenditure, the_ledger)
     if verbose:
         print("*** Final Report ***")
         final_report_table = PrettyTable()
@@ -86,92 +238,647 @@ def run_a_game(num_we, num_wf, k, t, m, reach_discount_factor, setup_base_goods,
         print(final_utilities_table)
         print("Total auctioneer revenue = ", total_expenditure)
 
-    # Record the utility of a we (wf) as the utility of the first player playing we (wf)
-    we_utility = utilities[we_c[0]] if len(we_c) > 0 else 0.0
-    wf_utility = utilities[wf_c[0]] if len(wf_c) > 0 else 0.0
-    return num_we, num_wf, we_utility, wf_utility, total_expenditure
+    # Record the utility of a we (wf) as the mean utility of the players playing we (wf)
+    return (num_we, num_wf) + summarize_utilities([utilities[c] for c in we_c], [utilities[c] for c in wf_c], total_expenditure) \
+           + (None,) + summarize_deviators([utilities[c] for c in we_c], [utilities[c] for c in wf_c])
 
 
-def estimate_a_single_game(setup_obj: SingletonSetup, file: str = None, verbose: bool = False, serial: bool = True):
+def get_static_arguments(setup_obj: SingletonSetup) -> Dict:
     """
-    Estimate a single game. Saves results in the corresponding experiment folder.
+    The arguments of sampling jobs that do not change during an experiment. Reserve prices do change, but are attributes of the base goods.
     :param setup_obj:
+    :return:
+    """
+    return dict(k=setup_obj.k,
+                reach_discount_factor=setup_obj.reach_discount_factor,
+                setup_base_goods=setup_obj.base_goods,
+                setup_pmf_base=setup_obj.pmf_base_goods,
+                setup_possible=setup_obj.possible_campaign_targets,
+                setup_pmf_target=setup_obj.pmf_target_goods)
+
+
+def initialize_simulation_worker(static_arguments: Dict):
+    """
+    Initializes a worker of the simulation pool with the static arguments of jobs, so that they are sent once instead of with every job.
+    :param static_arguments: see get_static_arguments.
+    :return:
+    """
+    global worker_static_arguments
+    worker_static_arguments = static_arguments
+
+
+def run_simulation_job(function: Callable, reserve_prices: List[float], arguments: Dict, aggregate: bool = False):
+    """
+    Runs a sampling job in a worker of the simulation pool.
+    :param function:
+    :param reserve_prices: the reserve price of each base good of the current step, in order.
+    :param arguments: the arguments of the job, except for the static ones.
+    :param aggregate: if True, only the aggregate of the results is sent back, see game.results.ResultsAggregate.
+    :return: the results of the job, or their aggregate, and the time it took in the worker.
+    """
+    initial_time = time.perf_counter()
+    for g, reserve_price in zip(worker_static_arguments['setup_base_goods'], reserve_prices):
+        g.reserve_price = reserve_price
+    results = function(**worker_static_arguments, **arguments)
+    if aggregate:
+        results = aggregate_results(results)
+    return results, time.perf_counter() - initial_time
+
+
+def aggregate_results(results: List[tuple]) -> ResultsAggregate:
+    """
+    :param results:
+    :return: the aggregate of the given results.
+    """
+    aggregate = ResultsAggregate()
+    aggregate.add_rows(results)
+    return aggregate
+
+
+class SimulationPool:
+    """
+    A pool of processes that play games, whose workers are started and initialized with the static setup once, and then reused by every step of an
+    experiment. Jobs only carry the reserve prices of the step and their own arguments.
+    """
+
+    def __init__(self, setup_obj: SingletonSetup, max_workers: int = None):
+        self.static_arguments = get_static_arguments(setup_obj)
+        self.key = (setup_obj.k, setup_obj.n, setup_obj.reach_discount_factor)
+        self.max_workers = max_workers or cpu_count()
+        self.executor = ProcessPoolExecutor(self.max_workers, initializer=initialize_simulation_worker, initargs=(self.static_arguments,))
+
+    def submit(self, function: Callable, arguments: Dict, aggregate: bool = False) -> Future:
+        reserve_prices = [g.reserve_price for g in self.static_arguments['setup_base_goods']]
+        return self.executor.submit(run_simulation_job, function, reserve_prices, arguments, aggregate)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+    def __repr__(self):
+        return f"SimulationPool(k = {self.key[0]}, n = {self.key[1]}, reach_discount_factor = {self.key[2]})"
+
+
+# The simulation pool of this process, see get_simulation_pool.
+simulation_pool = None
+
+
+def get_simulation_pool(setup_obj: SingletonSetup) -> SimulationPool:
+    """
+    Returns the simulation pool of this process, starting it on the first call, or if the static setup changed.
+    :param setup_obj:
+    :return:
+    """
+    global simulation_pool
+    if simulation_pool is not None and simulation_pool.key != (setup_obj.k, setup_obj.n, setup_obj.reach_discount_factor):
+        shutdown_simulation_pool()
+    if simulation_pool is None:
+        simulation_pool = SimulationPool(setup_obj)
+    return simulation_pool
+
+
+@atexit.register
+def shutdown_simulation_pool():
+    """
+    Shuts down the simulation pool of this process, if any.
+    :return:
+    """
+    global simulation_pool
+    if simulation_pool is not None:
+        simulation_pool.shutdown()
+        simulation_pool = None
+
+
+def get_sampling_jobs(setup_obj: SingletonSetup, profiles: List[int], start: int, end: int, m: int, verbose: bool = False, auction_engine: str = 'reference',
+                      common_random_numbers: bool = False, seed: int = None) -> List[Tuple[Callable, Dict]]:
+    """
+    Returns the jobs that play games start to end - 1 of the given profiles, one per profile, or a single one with common random numbers. Each job is
+    a function together with its keyword arguments, except for the static ones (see get_static_arguments), and returns a list of results as
+    summarize_games. Jobs are split into chunks by run_sampling_jobs.
+    :param setup_obj:
+    :param profiles: the profiles to play, as numbers of WE players.
+    :param start:
+    :param end:
+    :param m: the total number of games per profile, only used to report progress.
     :param verbose:
-    :param file:
-    :param serial:
+    :param auction_engine: the key in game.game.auction_engines of the implementation used to simulate the auctions.
+    :param common_random_numbers: if True, the job plays all the given profiles on the same sampled markets, see run_we_wf_profiles.
+    :param seed: the seed of the random streams of the games, see run_a_game_on_range and run_all_profiles_on_range.
     :return:
     """
-    k = setup_obj.k
-    n = setup_obj.n
-    reach_discount_factor = setup_obj.reach_discount_factor
-    m = setup_obj.number_of_samples_per_profile()
+    common_arguments = dict(m=m, verbose=verbose, auction_engine=auction_engine, seed=seed)
+    if common_random_numbers:
+        return [(run_all_profiles_on_range, dict(n=setup_obj.n, start=start, end=end, profiles=profiles, **common_arguments))]
+    return [(run_a_game_on_range, dict(num_we=num_we, num_wf=setup_obj.n - num_we, start=start, end=end, **common_arguments)) for num_we in profiles]
+
+
+def split_job(job: Tuple[Callable, Dict], chunk_size: int) -> List[Tuple[Callable, Dict]]:
+    """
+    Splits a job into jobs of consecutive ranges of at most chunk_size games.
+    :param job:
+    :param chunk_size:
+    :return:
+    """
+    function, arguments = job
+    return [(function, {**arguments, 'start': start, 'end': min(start + chunk_size, arguments['end'])})
+            for start in range(arguments['start'], arguments['end'], chunk_size)]
+
+
+class ChunkScheduler:
+    """
+    Splits jobs into chunks on demand, so that workers never wait for the slowest profile. The throughput of each job, in games per second, is measured
+    online from the chunks done so far. The next chunk always comes from the job with the most estimated time left, and is sized to take about
+    target_time seconds, or less towards the end, so that the remaining work is spread among all workers. Jobs not measured yet start with a pilot
+    chunk of min_chunk_size games.
+    """
+
+    def __init__(self, jobs: List[Tuple[Callable, Dict]], workers: int, target_time: float = 2.0, min_chunk_size: int = 10, max_chunk_size: int = 1000):
+        self.jobs = jobs
+        self.workers = workers
+        self.target_time = target_time
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.next_start = [arguments['start'] for _, arguments in jobs]
+        self.games_done = [0] * len(jobs)
+        self.time_spent = [0.0] * len(jobs)
+        self.chunks = 0
+        self.initial_time = time.perf_counter()
+
+    def get_remaining_games(self, j: int) -> int:
+        return self.jobs[j][1]['end'] - self.next_start[j]
+
+    def get_throughput(self, j: int) -> float:
+        """
+        :param j:
+        :return: the games per second of job j, or, if not measured yet, of all jobs. None if nothing was measured yet.
+        """
+        if self.time_spent[j] > 0.0:
+            return self.games_done[j] / self.time_spent[j]
+        return sum(self.games_done) / sum(self.time_spent) if sum(self.time_spent) > 0.0 else None
+
+    def next_chunk(self):
+        """
+        :return: the index of the job the next chunk belongs to, and the chunk, as a job. None if there is nothing left to do.
+        """
+        pending = [j for j in range(0, len(self.jobs)) if self.get_remaining_games(j) > 0]
+        if len(pending) == 0:
+            return None
+        unmeasured = [j for j in pending if self.next_start[j] == self.jobs[j][1]['start']]
+        if len(unmeasured) > 0 or self.get_throughput(pending[0]) is None:
+            j = unmeasured[0] if len(unmeasured) > 0 else pending[0]
+            size = self.min_chunk_size
+        else:
+            time_left = {j: self.get_remaining_games(j) / self.get_throughput(j) for j in pending}
+            j = max(pending, key=lambda i: time_left[i])
+            chunk_time = min(self.target_time, sum(time_left.values()) / self.workers)
+            size = max(self.min_chunk_size, min(self.max_chunk_size, round(chunk_time * self.get_throughput(j))))
+        size = min(size, self.get_remaining_games(j))
+        function, arguments = self.jobs[j]
+        chunk = (function, {**arguments, 'start': self.next_start[j], 'end': self.next_start[j] + size})
+        self.next_start[j] += size
+        self.chunks += 1
+        return j, chunk
+
+    def record(self, j: int, games: int, elapsed: float):
+        """
+        Records that a chunk of job j with the given number of games took elapsed seconds in a worker.
+        :param j:
+        :param games:
+        :param elapsed:
+        :return:
+        """
+        self.games_done[j] += games
+        self.time_spent[j] += elapsed
+
+    def get_report(self) -> Dict:
+        """
+        :return: the number of chunks and games, the wall time, the time workers were busy, and the utilization, i.e., the fraction of the time of all
+        workers that was spent playing games.
+        """
+        wall_time = time.perf_counter() - self.initial_time
+        busy_time = sum(self.time_spent)
+        return dict(chunks=self.chunks,
+                    games=sum(self.games_done),
+                    wall_time=wall_time,
+                    busy_time=busy_time,
+                    workers=self.workers,
+                    utilization=busy_time / (wall_time * self.workers) if wall_time > 0.0 else 0.0)
+
+
+# The report of each call to run_sampling_jobs in the simulation pool of this process, see ChunkScheduler.get_report.
+utilization_reports = []
+
+
+class Checkpoint:
+    """
+    Persists the results of every chunk of an estimation as soon as it is done, one file per chunk, so that a restarted estimation only plays the
+    chunks that are missing. Games are seeded (see run_a_game_on_range), so the chunks played after a restart give the same results as if the
+    estimation had never stopped, as long as the seed, which the checkpoint keeps, is the same. Chunks are only restored for the same setup, i.e.,
+    the same static arguments and reserve prices, so that, e.g., a step restarted with other reserve prices does not mix in the games of the old ones.
+    """
+
+    def __init__(self, directory: str, seed: int):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, 'seed.txt'), 'w') as f:
+            f.write(str(seed))
+
+    @staticmethod
+    def read_seed(directory: str) -> int:
+        """
+        :param directory:
+        :return: the seed of the checkpoint in the given directory, or None if there is none.
+        """
+        if not os.path.exists(os.path.join(directory, 'seed.txt')):
+            return None
+        with open(os.path.join(directory, 'seed.txt')) as f:
+            return int(f.read())
+
+    @staticmethod
+    def get_identity(setup_obj: SingletonSetup, function: Callable, arguments: Dict, aggregate: bool) -> Dict:
+        """
+        Chunks of the same job share their identity, i.e., everything but their range and how they report progress, together with the parts of the
+        setup the games depend on that are not arguments of jobs, i.e., k, the reach discount factor and the reserve prices of the base goods.
+        """
+        return {'function': function.__name__, 'aggregate': aggregate, 'k': setup_obj.k, 'reach_discount_factor': setup_obj.reach_discount_factor,
+                'reserve_prices': [g.reserve_price for g in setup_obj.base_goods],
+                **{k: v for k, v in arguments.items() if k not in ['start', 'end', 'm', 'verbose']}}
+
+    def save(self, setup_obj: SingletonSetup, function: Callable, arguments: Dict, aggregate: bool, result):
+        """
+        Saves the result of a chunk. The file is written under a temporary name first, so that a crash never leaves a partial chunk behind.
+        :param setup_obj:
+        :param function:
+        :param arguments:
+        :param aggregate:
+        :param result:
+        :return:
+        """
+        file = os.path.join(self.directory, uuid.uuid4().hex + '.pkl')
+        with open(file + '.tmp', 'wb') as f:
+            pickle.dump({'identity': Checkpoint.get_identity(setup_obj, function, arguments, aggregate), 'start': arguments['start'], 'end': arguments['end'],
+                         'result': result}, f)
+        os.replace(file + '.tmp', file)
+
+    def restore(self, setup_obj: SingletonSetup, jobs: List[Tuple[Callable, Dict]], aggregate: bool):
+        """
+        Finds the chunks of the given jobs that are done.
+        :param setup_obj:
+        :param jobs:
+        :param aggregate:
+        :return: the results of the chunks done, and the jobs of the ranges that are still missing.
+        """
+        chunks = []
+        for file in sorted(os.listdir(self.directory)):
+            if file.endswith('.pkl'):
+                with open(os.path.join(self.directory, file), 'rb') as f:
+                    chunks.append(pickle.load(f))
+        results, missing_jobs = [], []
+        for function, arguments in jobs:
+            identity = Checkpoint.get_identity(setup_obj, function, arguments, aggregate)
+            done = sorted([c for c in chunks if c['identity'] == identity and arguments['start'] <= c['start'] and c['end'] <= arguments['end']],
+                          key=lambda c: c['start'])
+            position = arguments['start']
+            for c in done:
+                # Chunks never overlap, unless, e.g., the checkpoint was copied over, in which case the results of the overlap are only counted once.
+                if c['start'] < position:
+                    continue
+                if c['start'] > position:
+                    missing_jobs.append((function, {**arguments, 'start': position, 'end': c['start']}))
+                results.append(c['result'])
+                position = c['end']
+            if position < arguments['end']:
+                missing_jobs.append((function, {**arguments, 'start': position, 'end': arguments['end']}))
+        return results, missing_jobs
+
+    def clear(self):
+        """
+        Deletes the checkpoint, once the results of the estimation are saved.
+        :return:
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __repr__(self):
+        return f"Checkpoint({self.directory})"
+
+
+def log_error(setup_obj: SingletonSetup, exp: BaseException):
+    """
+    Saves an exception to the error file of the experiment, and prints it.
+    :param setup_obj:
+    :param exp:
+    :return:
+    """
+    error_log_dir = f'../results/experiments/experiment_{setup_obj.expt_id}/error/'
+    safe_create_dir(error_log_dir, False)
+    with open(f'{error_log_dir}error.txt', "a") as f:
+        f.write(f'An exception of type {type(exp)} occurred: {exp} \n')
+    print(f'An exception occurred: {exp}')
+
+
+def run_sampling_jobs(setup_obj: SingletonSetup, jobs: List[Tuple[Callable, Dict]], serial: bool = True, verbose: bool = False, chunk_size: int = 1000,
+                      writer: ResultsWriter = None, aggregate: bool = False, checkpoint: Checkpoint = None, max_retries: int = 2):
+    """
+    Runs the given jobs (see get_sampling_jobs), either serially in ranges of chunk_size games, or in the simulation pool of this process
+    (see get_simulation_pool) in chunks of at most chunk_size games scheduled by a ChunkScheduler, and returns all their results.
+    :param setup_obj:
+    :param jobs:
+    :param serial:
+    :param verbose:
+    :param chunk_size:
+    :param writer: if given, the results of each chunk are appended to it as soon as the chunk is done.
+    :param aggregate: if True, each chunk is aggregated where it is played, and only the merged ResultsAggregate of all chunks is kept.
+    :param checkpoint: if given, chunks already done are restored from it instead of played, and every chunk is saved to it once done.
+    :param max_retries: the number of times a chunk that raised an exception is played again. If it still fails, an exception is raised once all
+    other chunks are done, since the results would miss its games.
+    :return: the list of results, or their ResultsAggregate.
+    """
+    results = ResultsAggregate() if aggregate else []
+    # The number of times each failed chunk, by its range in its job, failed so far.
+    failures = {}
+
+    def collect(result):
+        if writer is not None:
+            writer.append(result)
+        if aggregate:
+            results.merge(result)
+        else:
+            results.extend(result)
+
+    def should_retry(j, arguments, exp) -> bool:
+        log_error(setup_obj, exp)
+        key = (j, arguments['start'], arguments['end'])
+        failures[key] = failures.get(key, 0) + 1
+        return failures[key] <= max_retries
+
+    def check_complete():
+        failed_chunks = [key for key, count in failures.items() if count > max_retries]
+        if len(failed_chunks) > 0:
+            raise Exception(f"{len(failed_chunks)} chunks failed {max_retries + 1} times, so the estimation is incomplete"
+                            + ("" if checkpoint is None else f". Chunks done are kept in {checkpoint.directory} and are not played again on a restart"))
+
+    if checkpoint is not None:
+        restored_results, jobs = checkpoint.restore(setup_obj, jobs, aggregate)
+        for result in restored_results:
+            collect(result)
+        if verbose and len(restored_results) > 0:
+            print(f"Restored {len(restored_results)} chunks from {checkpoint.directory}")
 
-    results = []
-    if verbose:
-        print("\n++++++++ Start Experiment: ++++++++\n Collecting ", m, " samples for each profile for eps = ", setup_obj.eps, ", and budget = ", setup_obj.budget)
     if serial:
-        for num_we in range(0, n + 1):
-            num_wf = n - num_we
+        static_arguments = get_static_arguments(setup_obj)
+        for j, (function, arguments) in enumerate([chunk for job in jobs for chunk in split_job(job, chunk_size)]):
             if verbose:
                 print("")
-            for t in range(0, m):
-                results.append(run_a_game(num_we=num_we,
-                                          num_wf=num_wf,
-                                          k=k,
-                                          t=t,
-                                          m=m,
-                                          reach_discount_factor=reach_discount_factor,
-                                          setup_base_goods=setup_obj.base_goods,
-                                          setup_pmf_base=setup_obj.pmf_base_goods,
-                                          setup_possible=setup_obj.possible_campaign_targets,
-                                          setup_pmf_target=setup_obj.pmf_target_goods,
-                                          verbose=verbose))
-    else:
-        with ProcessPoolExecutor(cpu_count()) as executor:
-            chunk_size = 1000
-            ends = np.arange(start=0, stop=m, step=chunk_size).astype(int)
-            ends = ends[1:].tolist() + [m]
-            starts = [0] + ends[:-1]
-
-            futures = []
-            for num_we in range(0, n + 1):
-                num_wf = n - num_we
-                for start, end in zip(starts, ends):
-                    if verbose:
-                        print(f"running from {start} to {end}")
-                    futures.append(executor.submit(run_a_game_on_range,
-                                                   num_we=num_we,
-                                                   num_wf=num_wf,
-                                                   k=k,
-                                                   start=start,
-                                                   end=end,
-                                                   m=m,
-                                                   reach_discount_factor=reach_discount_factor,
-                                                   setup_base_goods=setup_obj.base_goods,
-                                                   setup_pmf_base=setup_obj.pmf_base_goods,
-                                                   setup_possible=setup_obj.possible_campaign_targets,
-                                                   setup_pmf_target=setup_obj.pmf_target_goods,
-                                                   verbose=verbose))
-                if verbose:
-                    print(f'submitted {len(starts)} jobs', flush=True)
-            for future in as_completed(futures):
-                exp = future.exception()
-                # If an exception occurred, save it to a file and keep going.
-                if exp is not None:
-                    error_log_dir = f'../results/experiments/experiment_{setup_obj.expt_id}/error/'
-                    safe_create_dir(error_log_dir, False)
-                    with open(f'{error_log_dir}error.txt', "a") as f:
-                        f.write(f'An exception of type {type(exp)} occurred: {exp} \n')
-                    print(f'An exception occurred: {exp}')
-
-                else:
-                    result = future.result()
-                    results.extend(result)
-
-    df_results = pd.DataFrame(results, columns=['num_WE', 'num_WF', 'we', 'wf', 'revenue'])
+            while True:
+                try:
+                    result = function(**static_arguments, **arguments)
+                except Exception as exp:
+                    if should_retry(j, arguments, exp):
+                        continue
+                    break
+                result = aggregate_results(result) if aggregate else result
+                if checkpoint is not None:
+                    checkpoint.save(setup_obj, function, arguments, aggregate, result)
+                collect(result)
+                break
+        check_complete()
+        return results
+    pool = get_simulation_pool(setup_obj)
+    scheduler = ChunkScheduler(jobs, pool.max_workers, max_chunk_size=chunk_size)
+    futures = {}
+    while True:
+        # Keep every worker busy, and no more, so that chunks are sized with the latest measurements.
+        while len(futures) < pool.max_workers:
+            next_chunk = scheduler.next_chunk()
+            if next_chunk is None:
+                break
+            j, (function, arguments) = next_chunk
+            # Games played in other processes do not report progress.
+            futures[pool.submit(function, {**arguments, 'verbose': False}, aggregate)] = (j, function, arguments, pool)
+        if len(futures) == 0:
+            break
+        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+        for future in done:
+            j, function, arguments, future_pool = futures.pop(future)
+            exp = future.exception()
+            # If an exception occurred, save it to a file and play the chunk again, up to max_retries times.
+            if exp is not None:
+                if isinstance(exp, BrokenProcessPool) and future_pool is pool:
+                    # A worker died, e.g., out of memory, and the pool cannot take any more jobs, so start a new one. Chunks that were running in
+                    # the old pool fail with the same exception, and are retried in the new one as well.
+                    shutdown_simulation_pool()
+                    pool = get_simulation_pool(setup_obj)
+                if should_retry(j, arguments, exp):
+                    futures[pool.submit(function, {**arguments, 'verbose': False}, aggregate)] = (j, function, arguments, pool)
+            else:
+                result, elapsed = future.result()
+                scheduler.record(j, arguments['end'] - arguments['start'], elapsed)
+                if checkpoint is not None:
+                    checkpoint.save(setup_obj, function, arguments, aggregate, result)
+                collect(result)
+    check_complete()
+    report = scheduler.get_report()
+    utilization_reports.append(report)
+    if verbose:
+        print(f"\nPlayed {report['games']} games in {report['chunks']} chunks in {report['wall_time']:.2f}s on {report['workers']} workers, "
+              f"utilization = {100.0 * report['utilization']:.1f}%", flush=True)
+    return results
+
+
+def get_results_writer(file: str) -> ResultsWriter:
+    """
+    Returns the writer of results to the given file, or None if it is a csv file, which is written at once by save_results, or a json file, which only
+    keeps the aggregate of results (see game.results.ResultsAggregate).
+    :param file: a csv file, a json file, or the directory of a columnar binary store (see game.results.ResultsWriter).
+    :return:
+    """
+    return None if file is None or file.endswith('.csv') or file.endswith('.json') else ResultsWriter(file)
+
+
+# The thread that saves results, and anything else, in the background, see save_in_background, and the saves it has not finished yet.
+save_executor = None
+pending_saves = []
+
+
+def save_in_background(function: Callable, *args, **kwargs) -> Future:
+    """
+    Calls a function that saves data, e.g., save_results, in a background thread, so that the caller does not wait for the disk. Saves run one at a
+    time, in the order they were submitted, and the data given must not change until they are done.
+    :param function:
+    :param args:
+    :param kwargs:
+    :return: the future of the save.
+    """
+    global save_executor
+    if save_executor is None:
+        save_executor = ThreadPoolExecutor(max_workers=1)
+    future = save_executor.submit(function, *args, **kwargs)
+    pending_saves.append(future)
+    return future
+
+
+def wait_for_saves():
+    """
+    Waits until all the saves in the background are done.
+    :return:
+    """
+    while len(pending_saves) > 0:
+        # Raises the exception of a failed save, if any, since its data was not saved.
+        pending_saves.pop(0).result()
+
+
+def save_results(results, file: str, verbose: bool = False, writer: ResultsWriter = None):
+    """
+    Saves the results of games. Results in a csv file are sorted by profile. Results in a binary store were already appended by the writer as jobs
+    finished, in that order. An aggregate of results is saved to a json file.
+    :param results: the list of results, or their ResultsAggregate.
+    :param file:
+    :param verbose:
+    :param writer: the writer of the binary store, see get_results_writer.
+    :return:
+    """
+    if isinstance(results, ResultsAggregate):
+        if verbose:
+            print("\n*** Aggregate of the results per profile ***")
+            print(results.to_frame()[['num_WE', 'num_WF', 'games', 'we_mean', 'wf_mean', 'revenue_mean']].to_string(index=False))
+            print(f'\nwriting to file {file}')
+        results.save(file)
+        return
+    if verbose:
+        print("\n*** Effective number of samples per profile ***")
+        print(compute_effective_number_of_samples(pd.DataFrame(results, columns=results_columns)).to_string(index=False))
+    if writer is not None:
+        if verbose:
+            print(f'\nwrote {writer.rows} rows to {file}')
+        return
+    df_results = pd.DataFrame(results, columns=results_columns)
     df_results = df_results.sort_values(['num_WE', 'num_WF'], ascending=[True, False])
     if verbose:
         print(f'\nwriting to file {file}')
     df_results.to_csv(file, index=False)
+
+
+def save_and_clear_checkpoint(results, file: str, verbose: bool = False, writer: ResultsWriter = None, checkpoint: Checkpoint = None):
+    """
+    Saves results, see save_results, and then deletes the checkpoint of the estimation, if any, which is not needed anymore.
+    """
+    save_results(results, file, verbose, writer)
+    if checkpoint is not None:
+        checkpoint.clear()
+
+
+def get_checkpoint(file: str, seed: int, checkpoint: bool) -> Tuple[int, Checkpoint]:
+    """
+    :param file: the results file of an estimation.
+    :param seed: the seed of the estimation, or None.
+    :param checkpoint: whether the estimation keeps a checkpoint, next to its results file, so there is none without a file.
+    :return: the seed of the estimation, i.e., the given one, else the one of the checkpoint to resume, else a fresh one, and the checkpoint, if any.
+    """
+    if not checkpoint or file is None:
+        return (draw_seed() if seed is None else seed), None
+    directory = file + '.checkpoint'
+    if seed is None:
+        seed = Checkpoint.read_seed(directory)
+    elif Checkpoint.read_seed(directory) not in [None, seed]:
+        # The chunks there are games of another seed.
+        shutil.rmtree(directory)
+    seed = draw_seed() if seed is None else seed
+    return seed, Checkpoint(directory, seed)
+
+
+def estimate_a_single_game(setup_obj: SingletonSetup, file: str = None, verbose: bool = False, serial: bool = True, auction_engine: str = 'reference',
+                           common_random_numbers: bool = False, seed: int = None, checkpoint: bool = False, asynchronous: bool = False):
+    """
+    Estimate a single game. Saves results in the corresponding experiment folder, and returns them, so that they can be used without reading them back.
+    :param setup_obj:
+    :param verbose:
+    :param file: a csv file, or the directory of a columnar binary store, see get_results_writer. If it is a json file, only the aggregate of the results
+    is kept and saved, so that memory does not grow with the number of games. If None, results are only returned.
+    :param serial:
+    :param auction_engine: the key in game.game.auction_engines of the implementation used to simulate the auctions.
+    :param common_random_numbers: if True, each sampled market is played by all profiles, see run_we_wf_profiles, and the results can be paired by sample.
+    Otherwise, each profile samples its own markets.
+    :param seed: the seed of the random streams of the games, saved with the results, so that the same seed reproduces them exactly, serially or in
+    parallel. If None, a fresh seed is drawn, unless a checkpoint is resumed, in which case its seed is used.
+    :param checkpoint: if True, every chunk of games is saved, as it is done, to the directory file + '.checkpoint', and an estimation that did not
+    finish, e.g., because the machine was preempted, resumes from the chunks there instead of starting over. The checkpoint is deleted once the
+    results are saved.
+    :param asynchronous: if True, results are saved in the background (see save_in_background), and returned without waiting for the disk.
+    :return: the list of results, or their ResultsAggregate if file is a json file.
+    """
+    n = setup_obj.n
+    m = setup_obj.number_of_samples_per_profile()
+    seed, the_checkpoint = get_checkpoint(file, seed, checkpoint)
+
+    if verbose:
+        print("\n++++++++ Start Experiment: ++++++++\n Collecting ", m, " samples for each profile for eps = ", setup_obj.eps, ", and budget = ", setup_obj.budget,
+              ", seed = ", seed)
+    jobs = get_sampling_jobs(setup_obj, list(range(0, n + 1)), 0, m, m, verbose, auction_engine, common_random_numbers, seed)
+    writer = get_results_writer(file)
+    results = run_sampling_jobs(setup_obj, jobs, serial, verbose, writer=writer, aggregate=file is not None and file.endswith('.json'),
+                                checkpoint=the_checkpoint)
+    if file is not None:
+        if asynchronous:
+            save_in_background(save_and_clear_checkpoint, results, file, verbose, writer, the_checkpoint)
+        else:
+            save_and_clear_checkpoint(results, file, verbose, writer, the_checkpoint)
+    return results
     # print("\n\n Average time per simulation = ", total_time / ((n + 1) * m))
     # print("++++++++ End ++++++++ \n")
+
+
+def estimate_a_single_game_adaptively(setup_obj: SingletonSetup, file: str = None, verbose: bool = False, serial: bool = True, auction_engine: str = 'reference',
+                                      common_random_numbers: bool = False, round_size: int = 1000, seed: int = None,
+                                      checkpoint: bool = False) -> Tuple[pd.DataFrame, List[tuple]]:
+    """
+    Progressive sampling version of estimate_a_single_game. Games are played in rounds of round_size games per profile, and after each round, a profile
+    is retired once the direction of every edge of the 2eps-BRG it takes part in is decided (see gt.brg.get_undecided_edges), with confidence 1 - delta
+    over all the budget steps of the experiment, as number_of_samples_per_profile guarantees. No profile is played more than number_of_samples_per_profile times, and profiles whose utilities clearly differ stop far earlier.
+    Saves results in the corresponding experiment folder.
+    :param setup_obj:
+    :param file: as in estimate_a_single_game. Deciding edges needs the samples, so they are kept until the end in any case.
+    :param verbose:
+    :param serial:
+    :param auction_engine: the key in game.game.auction_engines of the implementation used to simulate the auctions.
+    :param common_random_numbers: if True, each sampled market of a round is played by all the profiles that are not retired, and edges are decided
+    with the paired differences of the utility of deviating players (see gt.brg.get_undecided_edges).
+    :param round_size:
+    :param seed: as in estimate_a_single_game. Games keep their streams across rounds.
+    :param checkpoint: as in estimate_a_single_game. Rounds are replayed from the checkpoint, and, since the games of each round are the same, so are
+    the profiles retired after it.
+    :return: for each profile, the number of games played, and the results of all the games.
+    """
+    n = setup_obj.n
+    m = setup_obj.number_of_samples_per_profile()
+    seed, the_checkpoint = get_checkpoint(file, seed, checkpoint)
+    number_of_rounds = math.ceil(m / round_size)
+    # Union bound over the mean utility of each strategy in each profile, i.e., 2n means (n mean differences if paired), checked after each round, and
+    # over the budget of steps of the experiment, as in number_of_samples_per_profile, so that the guarantee holds for all the games of an experiment.
+    delta = setup_obj.delta / (2 * n * number_of_rounds * setup_obj.budget)
+
+    if verbose:
+        print("\n++++++++ Start Experiment: ++++++++\n Collecting up to ", m, " samples for each profile for eps = ", setup_obj.eps, ", and budget = ", setup_obj.budget,
+              ", seed = ", seed)
+    results = []
+    writer = get_results_writer(file)
+    active_profiles = list(range(0, n + 1))
+    games_per_profile = {num_we: 0 for num_we in range(0, n + 1)}
+    for r in range(0, number_of_rounds):
+        start, end = r * round_size, min(m, (r + 1) * round_size)
+        jobs = get_sampling_jobs(setup_obj, active_profiles, start, end, m, False, auction_engine, common_random_numbers, seed)
+        results.extend(run_sampling_jobs(setup_obj, jobs, serial, False, writer=writer, checkpoint=the_checkpoint))
+        for num_we in active_profiles:
+            games_per_profile[num_we] = end
+        # A profile takes part in the edges to its neighbours, i.e., edges num_we - 1 and num_we.
+        undecided_edges = get_undecided_edges(pd.DataFrame(results, columns=results_columns), setup_obj.eps, delta, common_random_numbers)
+        active_profiles = [num_we for num_we in active_profiles if num_we - 1 in undecided_edges or num_we in undecided_edges]
+        if verbose:
+            print(f"round {r}: {end} games per active profile, undecided edges = {undecided_edges}, active profiles = {active_profiles}")
+        if len(active_profiles) == 0:
+            break
+
+    if file is not None:
+        save_and_clear_checkpoint(aggregate_results(results) if file.endswith('.json') else results, file, verbose, writer, the_checkpoint)
+    games = pd.DataFrame([(num_we, n - num_we, games) for num_we, games in games_per_profile.items()], columns=['num_WE', 'num_WF', 'games'])
+    if verbose:
+        print(f"\nPlayed {games['games'].sum()} games instead of {m * (n + 1)}, i.e., saved {m * (n + 1) - games['games'].sum()} games.")
+    return games, results
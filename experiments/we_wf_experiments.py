@@ -1,12 +1,93 @@
-from typing import List, Dict
+import copy
+from typing import List, Dict, Tuple
 
-from game.game import draw_one_impression_opportunity, run_auctions, draw_one_campaign
-from game.structures import Market, Good
+import numpy as np
+
+from game.game import CampaignSampler, auction_engines, order_free_auction_engines, ImpressionSampler
+from game.structures import Market, Good, Campaign, SpendLedger, Bid
 from game.structures import PrettyPrints
 from strategies.WE import we_strategy
 from strategies.WF import wf_strategy
 
 
+def compute_we_wf_bids(market: Market, verbose=False) -> Tuple[List[Bid], List[Bid]]:
+    """
+    Computes the bids of all campaigns of the market for both strategies, WE and WF.
+    :param market:
+    :param verbose:
+    :return: the WE bids and the WF bids.
+    """
+    # WE strategy
+    we_bids = we_strategy(market)
+    if verbose:
+        print("\n*** WE Bids ***")
+        print(PrettyPrints.get_bids_pretty_table(we_bids))
+
+    # WF strategy
+    wf_bids = wf_strategy(market)
+    if verbose:
+        print("\n*** WF Bids ***")
+        print(PrettyPrints.get_bids_pretty_table(wf_bids))
+    return we_bids, wf_bids
+
+
+def draw_impression_opportunities(k: int, goods: List[Good], pmf_base_goods: Dict[Good, float], auction_engine: str, rng: np.random.Generator = None,
+                                  impression_sampler: ImpressionSampler = None):
+    """
+    Draws random impression opportunities, as indices into goods. If the order does not matter to the engine, only draws how many there are of each good.
+    :param k:
+    :param goods:
+    :param pmf_base_goods:
+    :param auction_engine:
+    :param rng: the numpy generator to draw from. If None, the global numpy random state.
+    :param impression_sampler: the sampler of goods and pmf_base_goods, e.g., built once for a range of games. If None, one is built.
+    :return:
+    """
+    if impression_sampler is None:
+        impression_sampler = ImpressionSampler(goods, pmf_base_goods)
+    if auction_engine in order_free_auction_engines:
+        return impression_sampler.draw_counts(k, rng)
+    return impression_sampler.draw(k, rng)
+
+
+def play_we_wf_profile(num_WE: int, num_WF: int, market: Market, we_bids: List[Bid], wf_bids: List[Bid], impression_opportunities, verbose=False,
+                       auction_engine: str = 'reference', rng: np.random.Generator = None):
+    """
+    Plays the profile where the first num_WE campaigns of the market play WE and the next num_WF play WF, given the bids of all campaigns for both strategies.
+    :param num_WE:
+    :param num_WF:
+    :param market:
+    :param we_bids:
+    :param wf_bids:
+    :param impression_opportunities:
+    :param verbose:
+    :param auction_engine:
+    :param rng: the numpy generator of the auctions. If None, the global random state.
+    :return: the WE campaigns, the WF campaigns, the allocations, the expenditure and the ledger.
+    """
+    campaigns = market.campaigns
+    assert num_WE + num_WF == len(campaigns)
+    # Computing the final bids depend on the strategy of each player.
+    we_c = [campaigns[i] for i in range(0, num_WE)]
+    wf_c = [campaigns[i] for i in range(num_WE, num_WE + num_WF)]
+    final_we_bids = list(filter(lambda x, set_of_c=we_c: x.campaign in set_of_c, we_bids))
+    final_wf_bids = list(filter(lambda x, set_of_c=wf_c: x.campaign in set_of_c, wf_bids))
+    all_agents_bids = final_we_bids + final_wf_bids
+
+    if verbose:
+        print("\n*** Final Bids ***")
+        print(PrettyPrints.get_bids_pretty_table(all_agents_bids))
+
+    # -- Run auctions simulations and collect results
+    if verbose:
+        print("\n\n******* RUNNING AUCTIONS **********\n")
+    # The ledger keeps the expenditure totals, so that statistics do not need to recompute them.
+    the_ledger = SpendLedger(market.goods, campaigns, all_agents_bids)
+    the_allocations, the_expenditure = auction_engines[auction_engine](impression_opportunities, market.goods, campaigns, all_agents_bids, the_ledger, market.get_index(),
+                                                                          rng)
+    return we_c, wf_c, the_allocations, the_expenditure, the_ledger
+
+
 def run_we_wf_experiments(reach_discount_factor: float,
                           k: int,
                           num_WE: int,
@@ -14,7 +95,8 @@ def run_we_wf_experiments(reach_discount_factor: float,
                           goods: List[Good],
                           pmf_base_goods: Dict[Good, float],
                           possible_campaign_targets: List[Good],
-                          pmf_target_goods: Dict[Good, float], verbose=False):
+                          pmf_target_goods: Dict[Good, float], verbose=False, auction_engine: str = 'reference', campaigns: List[Campaign] = None,
+                          rng: np.random.Generator = None, impression_sampler: ImpressionSampler = None):
     """
     Runs one WE, WF experiment with all the given parameters and returns the results, i.e., the utilities of players and the revenue of the auctioneer.
     :param reach_discount_factor:
@@ -26,49 +108,71 @@ def run_we_wf_experiments(reach_discount_factor: float,
     :param possible_campaign_targets:
     :param pmf_target_goods:
     :param verbose:
+    :param auction_engine: the key in game.game.auction_engines of the implementation used to simulate the auctions.
+    :param campaigns: the campaigns of the game, e.g., drawn in bulk with a CampaignSampler. If None, random campaigns are drawn.
+    :param rng: the numpy generator of all the randomness of the game. If None, the global random state.
+    :param impression_sampler: the ImpressionSampler of goods and pmf_base_goods, e.g., built once for a range of games. If None, one is built.
     :return:
     """
     # Draw random campaigns
-    campaigns = [draw_one_campaign(num_WE + num_WF, reach_discount_factor, k, possible_campaign_targets, pmf_target_goods) for _ in range(0, num_WE + num_WF)]
+    if campaigns is None:
+        campaigns = CampaignSampler(num_WE + num_WF, reach_discount_factor, k, possible_campaign_targets, pmf_target_goods).draw(1, rng)[0]
     if verbose:
         print("\n*** Random Campaigns ***")
         for c in campaigns:
             print(c)
 
     assert num_WE + num_WF == len(campaigns)
-    # -- Run Strategies
+    # -- Run Strategies. Both strategies and the auctions share the index of the market.
     market = Market(campaigns, goods)
+    we_bids, wf_bids = compute_we_wf_bids(market, verbose)
 
-    # WE strategy
-    we_bids = we_strategy(market)
-    if verbose:
-        print("\n*** WE Bids ***")
-        print(PrettyPrints.get_bids_pretty_table(we_bids))
+    # -- Impression Opportunities
+    impression_opportunities = draw_impression_opportunities(k, goods, pmf_base_goods, auction_engine, rng, impression_sampler)
+    # print("some_impression_opportunities = ", impression_opportunities)
 
-    # WF strategy
-    wf_bids = wf_strategy(market)
-    if verbose:
-        print("\n*** WF Bids ***")
-        print(PrettyPrints.get_bids_pretty_table(wf_bids))
+    return play_we_wf_profile(num_WE, num_WF, market, we_bids, wf_bids, impression_opportunities, verbose, auction_engine, rng)
 
-    # Computing the final bids depend on the strategy of each player.
-    we_c = [campaigns[i] for i in range(0, num_WE)]
-    wf_c = [campaigns[i] for i in range(num_WE, num_WE + num_WF)]
-    final_we_bids = list(filter(lambda x, set_of_c=we_c: x.campaign in set_of_c, we_bids))
-    final_wf_bids = list(filter(lambda x, set_of_c=wf_c: x.campaign in set_of_c, wf_bids))
-    all_agents_bids = final_we_bids + final_wf_bids
 
+def run_we_wf_profiles(reach_discount_factor: float,
+                       k: int,
+                       n: int,
+                       goods: List[Good],
+                       pmf_base_goods: Dict[Good, float],
+                       possible_campaign_targets: List[Good],
+                       pmf_target_goods: Dict[Good, float], verbose=False, auction_engine: str = 'reference', campaigns: List[Campaign] = None,
+                       profiles: List[int] = None, rng: np.random.Generator = None, impression_sampler: ImpressionSampler = None):
+    """
+    Runs the WE, WF experiments of all n + 1 profiles with common random numbers: campaigns, bids and impression opportunities are drawn and computed
+    once, and each profile, i.e., number of WE players, is played on them. Strategies are then computed once instead of n + 1 times, and the
+    differences in utilities between profiles are not blurred by different markets.
+    :param reach_discount_factor:
+    :param k:
+    :param n: the number of players
+    :param goods:
+    :param pmf_base_goods:
+    :param possible_campaign_targets:
+    :param pmf_target_goods:
+    :param verbose:
+    :param auction_engine: the key in game.game.auction_engines of the implementation used to simulate the auctions.
+    :param campaigns: the campaigns of the game, e.g., drawn in bulk with a CampaignSampler. If None, random campaigns are drawn.
+    :param profiles: the profiles to play, as numbers of WE players. If None, all of them, from 0 to n.
+    :param rng: the numpy generator of all the randomness of the game. If None, the global random state. Ties are broken with a copy of its state
+    after drawing the impression opportunities in every profile, so that profiles also share the tie-breaking draws.
+    :param impression_sampler: as in run_we_wf_experiments.
+    :return: a list with the results of run_we_wf_experiments for each of the profiles.
+    """
+    if campaigns is None:
+        campaigns = CampaignSampler(n, reach_discount_factor, k, possible_campaign_targets, pmf_target_goods).draw(1, rng)[0]
     if verbose:
-        print("\n*** Final Bids ***")
-        print(PrettyPrints.get_bids_pretty_table(all_agents_bids))
-
-    # -- Run auctions simulations and collect results
-    if verbose:
-        print("\n\n******* RUNNING AUCTIONS **********\n")
-    # -- Impression Opportunities
-    # Draw random impression opportunities
-    impression_opportunities = [draw_one_impression_opportunity(pmf_base_goods) for _ in range(0, k)]
-    # print("some_impression_opportunities = ", impression_opportunities)
+        print("\n*** Random Campaigns ***")
+        for c in campaigns:
+            print(c)
 
-    the_allocations, the_expenditure = run_auctions(impression_opportunities, goods, campaigns, all_agents_bids)
-    return we_c, wf_c, the_allocations, the_expenditure
+    assert n == len(campaigns)
+    market = Market(campaigns, goods)
+    we_bids, wf_bids = compute_we_wf_bids(market, verbose)
+    impression_opportunities = draw_impression_opportunities(k, goods, pmf_base_goods, auction_engine, rng, impression_sampler)
+    profiles = range(0, n + 1) if profiles is None else profiles
+    return [play_we_wf_profile(num_WE, n - num_WE, market, we_bids, wf_bids, impression_opportunities, verbose, auction_engine,
+                               None if rng is None else copy.deepcopy(rng)) for num_WE in profiles]
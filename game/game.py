@@ -1,11 +1,12 @@
 import math
 import uuid
+from dataclasses import dataclass
 from random import choice
 from typing import List, Tuple, Dict
 
 import numpy as np
 
-from game.structures import Good, Bid, Campaign
+from game.structures import Good, Bid, Campaign, SpendLedger, BidBook, CampaignGoodMatrix, MarketIndex
 
 
 def second_largest(bids) -> float:
@@ -38,6 +39,88 @@ def draw_one_impression_opportunity(pmf_base_goods: Dict[Good, float]) -> Good:
         accumulator += prob
         if u <= accumulator:
             return g
+    # Rounding might leave the accumulator short of u, in which case the draw is the last good.
+    return g
+
+
+def draw_seed() -> int:
+    """
+    Draws a fresh seed from the entropy of the operating system. Seeds are non-negative 63 bits integers, so that they fit in any integer column.
+    :return:
+    """
+    return int(np.random.SeedSequence().generate_state(1, np.uint64)[0] >> np.uint64(1))
+
+
+def derive_seed(seed: int, key: Tuple[int, ...]) -> int:
+    """
+    Derives the seed of the stream with the given key from a seed, as SeedSequence.spawn does for its children.
+    :param seed:
+    :param key: a tuple of non-negative integers, e.g., (trial, step).
+    :return:
+    """
+    return int(np.random.SeedSequence(seed, spawn_key=key).generate_state(1, np.uint64)[0] >> np.uint64(1))
+
+
+def get_random_generator(seed: int, key: Tuple[int, ...]) -> np.random.Generator:
+    """
+    Returns the random generator of the stream with the given key of a seed, e.g., (profile, game). Streams of different keys are independent, and the
+    stream of a key is the same no matter which process draws it, or when.
+    :param seed:
+    :param key: a tuple of non-negative integers.
+    :return:
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=key))
+
+
+def choose(options: list, rng: np.random.Generator = None):
+    """
+    Chooses one of the options uniformly at random, with the given generator, or with random.choice if None.
+    :param options:
+    :param rng:
+    :return:
+    """
+    return choice(options) if rng is None else options[int(rng.integers(len(options)))]
+
+
+class ImpressionSampler:
+    """
+    Draws impression opportunities according to a probability mass function over goods. The cumulative distribution is computed once, and a whole
+    stream of impression opportunities is drawn with a single call, as indices into the list of goods, which all auction engines accept.
+    Draws use the given numpy generator, or the global numpy random state if None.
+    """
+
+    def __init__(self, goods: List[Good], pmf_goods: Dict[Good, float]):
+        self.goods = goods
+        self.probabilities = np.array([pmf_goods[g] for g in goods], dtype=float)
+        # Normalize so that the last value of the cumulative distribution is exactly 1.0, and hence every uniform draw maps to a good.
+        self.cumulative_distribution = np.cumsum(self.probabilities) / self.probabilities.sum()
+        self.cumulative_distribution[-1] = 1.0
+
+    def draw(self, k: int, rng: np.random.Generator = None) -> np.ndarray:
+        """
+        Draws a stream of k impression opportunities. Each one is the first good whose cumulative probability is at least a uniform draw.
+        :param k:
+        :param rng:
+        :return: an array with the index of the good of each impression opportunity.
+        """
+        return np.searchsorted(self.cumulative_distribution, (np.random if rng is None else rng).uniform(0, 1, k), side='left')
+
+    def draw_counts(self, k: int, rng: np.random.Generator = None) -> 'ImpressionCounts':
+        """
+        Draws the number of impression opportunities of each good among k, for engines that do not depend on the order of impression opportunities.
+        :param k:
+        :param rng:
+        :return:
+        """
+        return ImpressionCounts((np.random if rng is None else rng).multinomial(k, self.probabilities / self.probabilities.sum()))
+
+
+@dataclass
+class ImpressionCounts:
+    """
+    The number of impression opportunities of each good, indexed as the list of goods.
+    """
+    counts: np.ndarray
 
 
 def draw_one_campaign(n: int, reach_discount_factor: float, k: int, goods: List[Good], pmf_target_goods: Dict[Good, float]):
@@ -66,41 +149,324 @@ def draw_one_campaign(n: int, reach_discount_factor: float, k: int, goods: List[
     return Campaign("Random Campaign " + str(uuid.uuid4()), reach, budget, random_target)
 
 
-def run_auctions(impression_opportunities: List[Good], goods: List[Good], campaigns: List[Campaign], standing_bids: List[Bid]) -> \
-        Tuple[Dict[Campaign, List[Good]], Dict[Campaign, List[Good]]]:
-    allocations = {c: {g: 0 for g in goods} for c in campaigns}
-    expenditure = {c: {g: 0 for g in goods} for c in campaigns}
-    reserve_prices = {g: g.reserve_price for g in goods}
+class CampaignSampler:
+    """
+    Draws random campaigns according to the same rules as draw_one_campaign, but for a whole chunk of games at once, with a few numpy calls.
+    The reach of each possible target is computed once, and campaigns are identified by their position in the game instead of a uuid.
+    """
+
+    def __init__(self, n: int, reach_discount_factor: float, k: int, goods: List[Good], pmf_target_goods: Dict[Good, float]):
+        self.n = n
+        self.targets = goods
+        # ToDo: Unclear whether we should ceil or floor here. Ceil is to strict, floor is to lax.
+        self.reaches = np.ceil((reach_discount_factor * k * np.array([pmf_target_goods[g] for g in goods], dtype=float)) / n).astype(int)
+        if (self.reaches <= 0).any():
+            raise Exception("A campaign cannot have a non-positive reach")
+
+    def draw(self, number_of_games: int, rng: np.random.Generator = None) -> List[List[Campaign]]:
+        """
+        Draws n campaigns for each of the given number of games.
+        :param number_of_games:
+        :param rng: the numpy generator to draw from. If None, the global numpy random state.
+        :return:
+        """
+        if rng is None:
+            targets = np.random.randint(0, len(self.targets), size=(number_of_games, self.n))
+        else:
+            targets = rng.integers(0, len(self.targets), size=(number_of_games, self.n))
+        reaches = self.reaches[targets]
+        # See draw_one_campaign for the choice of the beta distribution.
+        budgets = reaches * ((np.random if rng is None else rng).beta(10, 10, size=(number_of_games, self.n)) + 0.5)
+        return [[Campaign("Random Campaign " + str(i), reach, budget, self.targets[target], i)
+                 for i, (target, reach, budget) in enumerate(zip(targets[t].tolist(), reaches[t].tolist(), budgets[t].tolist()))]
+                for t in range(0, number_of_games)]
+
+
+def get_impression_goods(impression_opportunities, goods: List[Good]) -> List[Good]:
+    """
+    Impression opportunities are either given as a list of goods, or as an array of indices into the list of goods. Returns them as goods.
+    :param impression_opportunities:
+    :param goods:
+    :return:
+    """
+    return [goods[j] for j in impression_opportunities.tolist()] if isinstance(impression_opportunities, np.ndarray) else impression_opportunities
+
+
+def get_impression_indices(impression_opportunities, good_index: Dict[Good, int]) -> np.ndarray:
+    """
+    Impression opportunities are either given as a list of goods, or as an array of indices into the list of goods. Returns them as indices.
+    :param impression_opportunities:
+    :param good_index:
+    :return:
+    """
+    if isinstance(impression_opportunities, np.ndarray):
+        return impression_opportunities
+    return np.array([good_index[i] for i in impression_opportunities], dtype=int)
+
+
+def run_auctions(impression_opportunities: List[Good], goods: List[Good], campaigns: List[Campaign], standing_bids: List[Bid], ledger: SpendLedger = None,
+                 index: MarketIndex = None, rng: np.random.Generator = None) -> \
+        Tuple[CampaignGoodMatrix, CampaignGoodMatrix]:
+    """
+    Simulates one second price auction per impression opportunity and returns the campaign x good matrices of allocations and expenditure.
+    :param impression_opportunities: a list of goods, or an array with the index in goods of each impression opportunity (see ImpressionSampler).
+    :param goods:
+    :param campaigns:
+    :param standing_bids:
+    :param ledger: an optional, empty, ledger that keeps track of the expenditure. If given, it can be used to read totals once auctions are done.
+    :param index: an optional MarketIndex of the market of campaigns and goods, so that campaigns do not need to be indexed again.
+    :param rng: the numpy generator that breaks ties. If None, ties are broken with random.choice.
+    :return:
+    """
+    allocations = CampaignGoodMatrix(campaigns, goods, dtype=int)
+    ledger = SpendLedger(goods, campaigns, standing_bids) if ledger is None else ledger
+    # The book keeps, for each good, a heap of the standing bids that match the good and are at least its reserve price.
+    bid_book = BidBook(goods, campaigns, standing_bids, index)
     # Run each individual second price auction.
     # print("\n\n --------- Running Auctions ------- \n \n")
-    for i in impression_opportunities:
+    for i in get_impression_goods(impression_opportunities, goods):
         # print("Auction of ", i)
-        # print("\t standing_bids = ", standing_bids)
-        # Collect relevant bids. These are all the bids that match the impression opportunity and are at least the reserve price.
-        relevant_bids = list(filter(lambda bid, g=i, r=reserve_prices: g.__matches__(bid.good) and bid.bid >= r[g], standing_bids))
-        if len(relevant_bids) > 0:
-            # The bids might contain competing bids from the same agent. Pick only the max bid of each agent. We filter by agent (campaign), and take the max if it exists.
-            relevant_bids = sum(list(map(lambda l: [max(l)] if len(l) > 0 else [], [list(filter(lambda x, a=c: a == x.campaign, relevant_bids)) for c in campaigns])), [])
-            if len(relevant_bids) == 0:
-                raise Exception("This should never occur.")
-            # Get the winning bid
-            max_bid = max(relevant_bids)
-            # Get all the bids that are at least as big as the winning bids.
-            winning_bids = list(filter(lambda b, win_bid_value=max_bid.bid: b.bid >= win_bid_value, relevant_bids))
-            # Compute the price, which is defined as the max between the second largest of the relevant bids and the reserve.
-            # Note the price of the second largest bid is zero if there is no such bid. Also, by this point all relevant bids can afford the reserve.
-            price = max(second_largest(relevant_bids), reserve_prices[i])
+        # Collect the winning bids, at most one per agent (campaign), and the price, which is defined as the max between the second largest of the relevant
+        # bids and the reserve. Note the price of the second largest bid is zero if there is no such bid.
+        winning_bids, price = bid_book.get_auction_outcome(i)
+        if len(winning_bids) > 0:
             # Allocate impressions to winners, breaking ties randomly. First, select a random winner among all winners, then allocate and price.
-            winner = choice(winning_bids)
-            allocations[winner.campaign][i] += 1
-            expenditure[winner.campaign][i] += price
-            # Money has been potentially spent. Hence, remove all the bids that have reached their limit. A bid limit is the sum of expenditure over all matching markets.
+            winner = choose(winning_bids, rng)
+            allocations.add(winner.campaign, i, 1)
+            ledger.record(winner.campaign, i, price)
+            # Money has been potentially spent by the winner. Hence, remove all the winner's bids that have reached their limit. A bid limit is the sum of expenditure
+            # over all matching markets, which the ledger keeps up to date. Only the winner spent money, so the bids of other campaigns do not need to be checked.
             # We remove the bids where expenditure across all matching markets is less than the bid since we assume a bidder could always end up paying its bid (but not frenq).
-            standing_bids = list(
-                filter(lambda bid_obj: bid_obj.limit - sum([expenditure[bid_obj.campaign][g] for g in goods if g.__matches__(bid_obj.good)]) >= bid_obj.bid, standing_bids))
+            bid_book.remove_exhausted_bids(winner.campaign, ledger)
             # Some debug info
-            # print("%%%% relevant_bids = ", relevant_bids)
             # print("\t\twinning_bids = ", winning_bids)
             # print("\t\t\t price = ", price)
             # print("\t\t\t\t winner is ", winner)
-    return allocations, expenditure
+    return allocations, ledger.expenditure
+
+
+class AuctionArrays:
+    """
+    Array representation of the standing bids of a game, shared by the fast implementations of the auctions simulation.
+    Bids are ordered by campaign, so that the max bid of each campaign is a reduction over a contiguous block of bids.
+    """
+
+    def __init__(self, goods: List[Good], campaigns: List[Campaign], standing_bids: List[Bid], index: MarketIndex = None):
+        self.goods = goods
+        self.campaigns = campaigns
+        self.good_index = {g: j for j, g in enumerate(goods)} if index is None else index.good_index
+        campaign_index = {c: i for i, c in enumerate(campaigns)} if index is None else index.campaign_index
+        self.bids = sorted(standing_bids, key=lambda b: campaign_index[b.campaign])
+        self.bid_values = np.array([b.bid for b in self.bids], dtype=float)
+        self.bid_limits = np.array([b.limit for b in self.bids], dtype=float)
+        self.bid_campaigns = np.array([campaign_index[b.campaign] for b in self.bids], dtype=int)
+        self.reserve_prices = np.array([g.reserve_price for g in goods], dtype=float)
+        # bid_matches[b, j] is True if good j matches the good of bid b, i.e., if bid b participates in the auctions of good j.
+        bid_masks = np.array([b.good.mask for b in self.bids], dtype=np.int64)
+        good_masks = np.array([g.mask for g in goods], dtype=np.int64)
+        self.bid_matches = (good_masks[np.newaxis, :] & bid_masks[:, np.newaxis]) == bid_masks[:, np.newaxis]
+        # A bid is eligible for the auction of a good if it matches the good and it is at least the reserve price.
+        self.eligible = self.bid_matches.T & (self.bid_values[np.newaxis, :] >= self.reserve_prices[:, np.newaxis])
+        self.bidding_campaigns, self.first_bid_of_campaign = np.unique(self.bid_campaigns, return_index=True)
+
+    def compute_outcomes(self, standing: np.ndarray) -> Tuple[List[List[int]], List[float]]:
+        """
+        Computes, for the given mask of standing bids, the winning campaigns and the price of the auction of each good.
+        Winners are listed in increasing order of campaign, which is the order in which run_auctions lists them.
+        :param standing:
+        :return:
+        """
+        winners_of_good = [[] for _ in self.goods]
+        price_of_good = [0.0 for _ in self.goods]
+        if len(self.bids) == 0:
+            return winners_of_good, price_of_good
+        relevant_values = np.where(self.eligible & standing[np.newaxis, :], self.bid_values[np.newaxis, :], -np.inf)
+        # Max bid of each campaign in each good. Campaigns without relevant bids have a max bid of -inf.
+        campaign_values = np.full((len(self.goods), len(self.campaigns)), -np.inf)
+        campaign_values[:, self.bidding_campaigns] = np.maximum.reduceat(relevant_values, self.first_bid_of_campaign, axis=1)
+        number_of_bidders = np.isfinite(campaign_values).sum(axis=1)
+        sorted_values = np.sort(campaign_values, axis=1)
+        for j in np.flatnonzero(number_of_bidders > 0):
+            max_bid = sorted_values[j, -1]
+            winners_of_good[j] = np.flatnonzero(campaign_values[j] >= max_bid).tolist()
+            # The second largest bid is zero if there is no such bid. By construction all relevant bids can afford the reserve.
+            price_of_good[j] = max(float(sorted_values[j, -2]) if number_of_bidders[j] >= 2 else 0.0, self.goods[j].reserve_price)
+        return winners_of_good, price_of_good
+
+    def reached_limit(self, expenditure: np.ndarray) -> np.ndarray:
+        """
+        Given a campaign x good matrix of expenditure, returns the mask of bids whose limit minus expenditure across all matching goods is less than the bid.
+        :param expenditure:
+        :return:
+        """
+        spent = (expenditure[self.bid_campaigns] * self.bid_matches).sum(axis=1)
+        return self.bid_limits - spent < self.bid_values
+
+    def to_matrices(self, allocations, expenditure, ledger: SpendLedger = None) -> Tuple[CampaignGoodMatrix, CampaignGoodMatrix]:
+        """
+        Turns campaign x good allocations and expenditure into the matrices returned by run_auctions, recording the expenditure in the ledger.
+        :param allocations:
+        :param expenditure:
+        :param ledger:
+        :return:
+        """
+        ledger = SpendLedger(self.goods, self.campaigns, self.bids) if ledger is None else ledger
+        for i, c in enumerate(self.campaigns):
+            for j, g in enumerate(self.goods):
+                if expenditure[i][j] != 0:
+                    ledger.record(c, g, expenditure[i][j])
+        return CampaignGoodMatrix(self.campaigns, self.goods, np.array(allocations, dtype=int).reshape(len(self.campaigns), len(self.goods))), ledger.expenditure
+
+
+def run_auctions_vectorized(impression_opportunities: List[Good], goods: List[Good], campaigns: List[Campaign], standing_bids: List[Bid], ledger: SpendLedger = None,
+                            index: MarketIndex = None, rng: np.random.Generator = None) -> \
+        Tuple[CampaignGoodMatrix, CampaignGoodMatrix]:
+    """
+    Array-backed version of run_auctions. Bids, limits and the bid x good match matrix are held as numpy arrays, and the outcome of the auction
+    of each good (set of winning campaigns and price) is computed for all goods at once. Since this outcome only changes when a bid reaches its
+    limit, it is recomputed only then, and each impression opportunity costs a table lookup plus the bookkeeping of the sale.
+    Ties are broken with the same calls to choose as run_auctions, so both engines return the same results for the same random state.
+    :param impression_opportunities:
+    :param goods:
+    :param campaigns:
+    :param standing_bids:
+    :param ledger:
+    :param index:
+    :param rng:
+    :return:
+    """
+    arrays = AuctionArrays(goods, campaigns, standing_bids, index)
+    # The allocations and expenditure are kept as lists of python numbers while running, so that the arithmetic matches the one of run_auctions.
+    allocations = [[0] * len(goods) for _ in campaigns]
+    expenditure = [[0] * len(goods) for _ in campaigns]
+    # For each bid, its expenditure across all matching goods, kept up to date as in the SpendLedger.
+    # For each (good, campaign), the bids whose expenditure changes, and hence must be checked, after a sale.
+    bid_expenditure = [0] * len(arrays.bids)
+    bids_to_check = [[np.flatnonzero(arrays.bid_matches[:, j] & (arrays.bid_campaigns == i)).tolist() for i in range(0, len(campaigns))]
+                     for j in range(0, len(goods))]
+    standing = np.ones(len(arrays.bids), dtype=bool)
+
+    winners, prices = arrays.compute_outcomes(standing)
+    for j in get_impression_indices(impression_opportunities, arrays.good_index).tolist():
+        if len(winners[j]) > 0:
+            # Winners are listed in the same order as in run_auctions, so that choose picks the same campaign.
+            w = choose(winners[j], rng)
+            allocations[w][j] += 1
+            expenditure[w][j] += prices[j]
+            # Only the bids of the winner that match the good could have reached their limit.
+            reached_limit = False
+            for b in bids_to_check[j][w]:
+                bid_expenditure[b] += prices[j]
+                if standing[b] and arrays.bid_limits[b] - bid_expenditure[b] < arrays.bid_values[b]:
+                    standing[b] = False
+                    reached_limit = True
+            if reached_limit:
+                winners, prices = arrays.compute_outcomes(standing)
+
+    return arrays.to_matrices(allocations, expenditure, ledger)
+
+
+def draw_multivariate_hypergeometric(colors: np.ndarray, nsample: int, rng: np.random.Generator = None) -> np.ndarray:
+    """
+    Draws the number of balls of each color in a sample without replacement of size nsample, from an urn with colors[i] balls of color i.
+    :param colors:
+    :param nsample:
+    :param rng: the numpy generator to draw from. If None, the global numpy random state.
+    :return:
+    """
+    sample = np.zeros(len(colors), dtype=int)
+    remaining = int(colors.sum())
+    for i, balls in enumerate(colors):
+        if nsample == 0:
+            break
+        remaining -= balls
+        if balls > 0:
+            sample[i] = (np.random if rng is None else rng).hypergeometric(balls, remaining, nsample) if remaining > 0 else nsample
+            nsample -= sample[i]
+    return sample
+
+
+def run_auctions_event_driven(impression_opportunities: List[Good], goods: List[Good], campaigns: List[Campaign], standing_bids: List[Bid], ledger: SpendLedger = None,
+                              index: MarketIndex = None, rng: np.random.Generator = None) -> \
+        Tuple[CampaignGoodMatrix, CampaignGoodMatrix]:
+    """
+    Event-driven version of run_auctions. The standing bids only change when a bid reaches its limit, and in between, every impression opportunity
+    of a good is won by one of the same winners at the same price. Hence, this engine only counts the impression opportunities of each good and jumps
+    from one limit event to the next, so that its cost grows with the number of events (at most the number of bids) and not with the number of
+    impression opportunities.
+    Impression opportunities are assumed to be drawn i.i.d., so that their order is a uniformly random permutation of their counts. Under this
+    assumption, allocations and expenditure have the same distribution as in run_auctions: ties are split multinomially, and the position of the
+    next event is found by bisection, sampling the counts of the first half of the remaining impressions with a multivariate hypergeometric.
+    Expenditure is accumulated in bulk rather than one sale at a time, so when the remaining limit of a bid is exactly equal to the bid (e.g., a WE
+    bid with limit p_g x_cg), whether the bid keeps standing is decided by a different floating point rounding than in run_auctions.
+    :param impression_opportunities: as in run_auctions, or the ImpressionCounts of each good, since the order does not matter here.
+    :param goods:
+    :param campaigns:
+    :param standing_bids:
+    :param ledger:
+    :param index:
+    :param rng: the numpy generator to draw from. If None, the global numpy random state.
+    :return:
+    """
+    arrays = AuctionArrays(goods, campaigns, standing_bids, index)
+    allocations = np.zeros((len(campaigns), len(goods)), dtype=int)
+    expenditure = np.zeros((len(campaigns), len(goods)), dtype=float)
+    # Bids that do not participate in any auction never change the outcome, so we do not need to wait for them to reach their limits.
+    standing = arrays.eligible.any(axis=0)
+    if isinstance(impression_opportunities, ImpressionCounts):
+        remaining_impressions = impression_opportunities.counts.astype(int)
+    else:
+        remaining_impressions = np.bincount(get_impression_indices(impression_opportunities, arrays.good_index), minlength=len(goods))
+
+    while remaining_impressions.sum() > 0:
+        winners, prices = arrays.compute_outcomes(standing)
+        # Split the impressions of each good among its winners. Impressions of goods without winners are not sold.
+        sold_goods = [j for j in range(0, len(goods)) if len(winners[j]) > 0]
+        if len(sold_goods) == 0:
+            break
+        type_goods = np.array([j for j in sold_goods for _ in winners[j]], dtype=int)
+        type_winners = np.array([w for j in sold_goods for w in winners[j]], dtype=int)
+        type_prices = np.array([prices[j] for j in sold_goods for _ in winners[j]], dtype=float)
+        type_counts = np.concatenate([(np.random if rng is None else rng).multinomial(remaining_impressions[j], [1.0 / len(winners[j])] * len(winners[j]))
+                                      for j in sold_goods])
+
+        def apply(counts):
+            """
+            Returns the allocations and expenditure after selling the given number of impressions of each type.
+            """
+            new_allocations, new_expenditure = allocations.copy(), expenditure.copy()
+            np.add.at(new_allocations, (type_winners, type_goods), counts)
+            np.add.at(new_expenditure, (type_winners, type_goods), counts * type_prices)
+            return new_allocations, new_expenditure
+
+        def has_event(counts):
+            return (standing & arrays.reached_limit(apply(counts)[1])).any()
+
+        if not has_event(type_counts):
+            allocations, expenditure = apply(type_counts)
+            break
+        # Bisection: committed impressions do not trigger an event, and the event happens within the window that follows them.
+        committed = np.zeros(len(type_counts), dtype=int)
+        window = type_counts
+        while window.sum() > 1:
+            first_half = draw_multivariate_hypergeometric(window, int(window.sum()) // 2, rng)
+            if has_event(committed + first_half):
+                window = first_half
+            else:
+                committed, window = committed + first_half, window - first_half
+        # Sell up to and including the impression that triggers the event, then remove all the bids that reached their limit.
+        allocations, expenditure = apply(committed + window)
+        standing &= ~arrays.reached_limit(expenditure)
+        leftover = type_counts - committed - window
+        remaining_impressions = np.zeros(len(goods), dtype=int)
+        np.add.at(remaining_impressions, type_goods, leftover)
+
+    return arrays.to_matrices(allocations, expenditure.tolist(), ledger)
+
+
+# The available implementations of the auctions simulation. All of them take the same arguments and return the same results.
+auction_engines = {"reference": run_auctions,
+                   "vectorized": run_auctions_vectorized,
+                   "event_driven": run_auctions_event_driven}
+# The engines that only depend on the number of impression opportunities of each good, which can then be drawn as ImpressionCounts.
+order_free_auction_engines = {"event_driven"}
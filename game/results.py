@@ -0,0 +1,215 @@
+import json
+import os
+from typing import List, Dict
+
+import numpy as np
+import pandas as pd
+
+# The columns of the results of games and their types, in the order of the rows of results (see summarize_games in experiments). Integer columns
+# store None as -1.
+results_schema = {'num_WE': np.int8,
+                  'num_WF': np.int8,
+                  'we': np.float64,
+                  'wf': np.float64,
+                  'revenue': np.float64,
+                  'we_var': np.float64,
+                  'wf_var': np.float64,
+                  'sample': np.int64,
+                  'deviator_we': np.float64,
+                  'deviator_wf': np.float64,
+                  'game': np.int64,
+                  'seed': np.int64}
+
+
+class ResultsWriter:
+    """
+    Writes results of games to a columnar binary store: a directory with one raw file per column, in its type, plus a schema.json file with the type
+    of each column and the number of rows. Rows are appended in chunks, e.g., as jobs finish, and the columns can then be memory-mapped (see
+    read_results). Columns are written one after the other, so the number of rows is only updated once all of them are, and a crash in between
+    leaves rows past it in some columns, which readers ignore.
+    """
+
+    def __init__(self, directory: str, schema: Dict[str, type] = None):
+        self.directory = directory
+        self.schema = results_schema if schema is None else schema
+        self.rows = 0
+        os.makedirs(directory, exist_ok=True)
+        self.write_schema()
+        # Start from empty columns, in case the directory held results before.
+        for column in self.schema:
+            open(self.get_path(column), 'wb').close()
+
+    def write_schema(self):
+        """
+        Writes the type of each column and the number of rows written to all of them. The file is replaced at once, so it is never partially written.
+        :return:
+        """
+        file = os.path.join(self.directory, 'schema.json')
+        with open(file + '.tmp', 'w') as f:
+            json.dump({'columns': {column: np.dtype(dtype).str for column, dtype in self.schema.items()}, 'rows': self.rows}, f)
+        os.replace(file + '.tmp', file)
+
+    def get_path(self, column: str) -> str:
+        return os.path.join(self.directory, column + '.bin')
+
+    def append(self, rows: List[tuple]):
+        """
+        Appends rows, given as tuples in the order of the schema, to the columns.
+        :param rows:
+        :return:
+        """
+        if len(rows) == 0:
+            return
+        for i, (column, dtype) in enumerate(self.schema.items()):
+            if np.issubdtype(dtype, np.integer):
+                values = np.array([-1 if row[i] is None else row[i] for row in rows], dtype=dtype)
+            else:
+                values = np.array([np.nan if row[i] is None else row[i] for row in rows], dtype=dtype)
+            with open(self.get_path(column), 'ab') as f:
+                f.write(values.tobytes())
+        self.rows += len(rows)
+        self.write_schema()
+
+    def __repr__(self):
+        return f"ResultsWriter({self.directory}, {self.rows} rows)"
+
+
+def read_results(path: str, columns: List[str] = None) -> pd.DataFrame:
+    """
+    Reads results of games, either from a columnar binary store (see ResultsWriter), where only the given columns are memory-mapped and read, or from
+    a csv file, as saved before the binary store existed.
+    :param path: the directory of the store, or a csv file.
+    :param columns: the columns to read. If None, all of them.
+    :return: a data frame with the results, where integer columns that store None have missing values instead. Only the rows written to all columns
+    are read, see ResultsWriter.
+    """
+    if path.endswith('.csv'):
+        return pd.read_csv(path, usecols=columns)
+    with open(os.path.join(path, 'schema.json')) as f:
+        store = json.load(f)
+    schema = {column: np.dtype(dtype) for column, dtype in store['columns'].items()}
+    data = {}
+    for column in (schema if columns is None else columns):
+        file = os.path.join(path, column + '.bin')
+        values = np.memmap(file, dtype=schema[column], mode='r', shape=(store['rows'],)) if store['rows'] > 0 else np.zeros(0, dtype=schema[column])
+        if np.issubdtype(schema[column], np.integer) and (values < 0).any():
+            data[column] = pd.array(np.where(values < 0, 0, values), dtype='Int64')
+            data[column][values < 0] = pd.NA
+        else:
+            data[column] = np.array(values)
+    return pd.DataFrame(data)
+
+
+# The columns of results that ResultsAggregate keeps statistics of.
+aggregated_columns = ['we', 'wf', 'revenue', 'we_var', 'wf_var']
+
+
+class ResultsAggregate:
+    """
+    Sufficient statistics of the results of games, per profile: for each aggregated column, the count, mean, sum of squared deviations from the mean,
+    min and max. These are all compute_eps_brg needs, and they take O(n) memory no matter how many games are played. Aggregates of disjoint sets of
+    games are merged exactly with the parallel version of Welford's algorithm (Chan et al.), so that workers can aggregate their own chunks.
+    """
+
+    def __init__(self):
+        # For each profile (num_WE, num_WF), the count and the arrays of mean, sum of squared deviations, min and max of each aggregated column.
+        self.statistics = {}
+
+    def merge_statistics(self, profile: tuple, count: int, mean: np.ndarray, m2: np.ndarray, minimum: np.ndarray, maximum: np.ndarray):
+        if profile not in self.statistics:
+            self.statistics[profile] = dict(count=count, mean=mean, m2=m2, min=minimum, max=maximum)
+            return
+        s = self.statistics[profile]
+        total = s['count'] + count
+        delta = mean - s['mean']
+        self.statistics[profile] = dict(count=total,
+                                        mean=s['mean'] + delta * count / total,
+                                        m2=s['m2'] + m2 + delta * delta * s['count'] * count / total,
+                                        min=np.minimum(s['min'], minimum),
+                                        max=np.maximum(s['max'], maximum))
+
+    def add_rows(self, rows: List[tuple]):
+        """
+        Adds rows of results, given as tuples in the order of results_schema.
+        :param rows:
+        :return:
+        """
+        positions = [list(results_schema).index(column) for column in aggregated_columns]
+        rows_of_profile = {}
+        for row in rows:
+            rows_of_profile.setdefault((int(row[0]), int(row[1])), []).append([row[i] for i in positions])
+        for profile, values in rows_of_profile.items():
+            values = np.array(values, dtype=float)
+            mean = values.mean(axis=0)
+            self.merge_statistics(profile, len(values), mean, ((values - mean) ** 2).sum(axis=0), values.min(axis=0), values.max(axis=0))
+
+    def merge(self, other: 'ResultsAggregate'):
+        """
+        Merges the aggregate of other games into this one.
+        :param other:
+        :return:
+        """
+        for profile, s in other.statistics.items():
+            self.merge_statistics(profile, s['count'], s['mean'], s['m2'], s['min'], s['max'])
+
+    def get_games(self) -> int:
+        return sum(s['count'] for s in self.statistics.values())
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        :return: a data frame with, for each profile, the number of games, and the mean, sample variance, min and max of each aggregated column.
+        """
+        rows = []
+        for (num_we, num_wf), s in sorted(self.statistics.items()):
+            row = {'num_WE': num_we, 'num_WF': num_wf, 'games': s['count']}
+            for j, column in enumerate(aggregated_columns):
+                row[column + '_mean'] = s['mean'][j]
+                row[column + '_var'] = s['m2'][j] / (s['count'] - 1) if s['count'] > 1 else 0.0
+                row[column + '_min'] = s['min'][j]
+                row[column + '_max'] = s['max'][j]
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+    def get_normalized_means(self, normalize_revenue=False) -> pd.DataFrame:
+        """
+        The mean utilities of each profile, normalized as gt.brg.normalize_utilities does with all the games, i.e., with the min and max over all profiles.
+        :param normalize_revenue:
+        :return: a data frame with the number of WE and WF players, and the normalized mean of 'we', 'wf' and 'revenue' of each profile.
+        """
+        frame = self.to_frame()
+        means = frame[['num_WE', 'num_WF']].copy()
+        for column in ['we', 'wf', 'revenue']:
+            the_min, the_max = frame[column + '_min'].min(), frame[column + '_max'].max()
+            if column == 'revenue' and not normalize_revenue:
+                means[column] = frame[column + '_mean']
+            else:
+                means[column] = (frame[column + '_mean'] - the_min) / ((the_max - the_min) if the_max - the_min > 0.0 else 1.0)
+        return means
+
+    def save(self, file: str):
+        """
+        Saves the aggregate to a json file.
+        :param file:
+        :return:
+        """
+        with open(file, 'w') as f:
+            json.dump({'columns': aggregated_columns,
+                       'statistics': [{'num_WE': num_we, 'num_WF': num_wf, 'count': s['count'], 'mean': s['mean'].tolist(), 'm2': s['m2'].tolist(),
+                                       'min': s['min'].tolist(), 'max': s['max'].tolist()} for (num_we, num_wf), s in sorted(self.statistics.items())]}, f)
+
+    @staticmethod
+    def load(file: str) -> 'ResultsAggregate':
+        """
+        Loads an aggregate saved by save.
+        :param file:
+        :return:
+        """
+        aggregate = ResultsAggregate()
+        with open(file) as f:
+            for s in json.load(f)['statistics']:
+                aggregate.statistics[(s['num_WE'], s['num_WF'])] = dict(count=s['count'], mean=np.array(s['mean']), m2=np.array(s['m2']),
+                                                                         min=np.array(s['min']), max=np.array(s['max']))
+        return aggregate
+
+    def __repr__(self):
+        return f"ResultsAggregate({len(self.statistics)} profiles, {self.get_games()} games)"
@@ -1,53 +1,72 @@
 import math
-from typing import Dict
+from typing import List, Tuple
 
-from game.structures import Campaign, Good
+import numpy as np
+
+from game.structures import SpendLedger, CampaignGoodMatrix, Campaign, Good
 
 
 def compute_sigmoidal_effective_reach_ratio(x, reach):
     """
-    Given a number of procurred impressions, computes a sigmoidal fraction of the reach.
+    Given a number of procurred impressions, computes a sigmoidal fraction of the reach. Works element-wise on numpy arrays.
     :param x:
     :param reach:
     :return:
     """
-    return (2 / 4.08577) * (math.atan(4.08577 * (x / reach) - 3.08577) - math.atan(-3.08577))
+    return (2 / 4.08577) * (np.arctan(4.08577 * (x / reach) - 3.08577) - math.atan(-3.08577))
+
+
+def compute_target_match_mask(campaigns: List[Campaign], goods: List[Good]) -> np.ndarray:
+    """
+    Returns the campaign x good mask that is True where the good matches the campaign's target.
+    :param campaigns:
+    :param goods:
+    :return:
+    """
+    target_masks = np.array([c.target.mask for c in campaigns], dtype=np.int64)
+    good_masks = np.array([g.mask for g in goods], dtype=np.int64)
+    return (good_masks[np.newaxis, :] & target_masks[:, np.newaxis]) == target_masks[:, np.newaxis]
 
 
-def compute_statistics(allocations: Dict[Campaign, Dict[Good, int]], expenditure: Dict[Campaign, Dict[Good, float]]):
+def compute_statistics(allocations: CampaignGoodMatrix, expenditure: CampaignGoodMatrix, ledger: SpendLedger = None):
     """
     Computes the statistics of the game.
-    :param allocations:
-    :param expenditure:
+    :param allocations: a campaign x good matrix of allocations. A Dict[Campaign, Dict[Good, int]] is also accepted.
+    :param expenditure: a campaign x good matrix of expenditure. A Dict[Campaign, Dict[Good, float]] is also accepted.
+    :param ledger: if given, the ledger filled by the auctions, from which expenditure totals are read instead of being summed again.
     :return:
     """
-    total_allocations = 0
-    total_expenditure = 0
-    total_effective_allocation = {}
-    sigmoidal_effective_reach_ratio = {}
+    if not isinstance(allocations, CampaignGoodMatrix):
+        allocations = CampaignGoodMatrix.from_dict(allocations, dtype=int)
+    if not isinstance(expenditure, CampaignGoodMatrix):
+        expenditure = CampaignGoodMatrix.from_dict(expenditure, allocations.campaigns, allocations.goods)
+    # The total effective allocation is the sum of the allocation across all market segments that match the campaign's target.
+    matches_target = compute_target_match_mask(allocations.campaigns, allocations.goods)
+    total_effective_allocation = (allocations.values * matches_target).sum(axis=1)
+    total_campaign_expenditure = expenditure.get_campaign_totals()
     utilities = {}
-    for c, _ in allocations.items():
-        total_c_allocations = sum([a for g, a in allocations[c].items()])
-        total_c_expenditure = sum([a for g, a in expenditure[c].items()])
-        total_allocations += total_c_allocations
-        total_expenditure += total_c_expenditure
-        if c not in total_effective_allocation:
-            # The total effective allocation is the sum of the allocation across all market segments that match the campaign's target.
-            total_effective_allocation[c] = sum([a if g.__matches__(c.target) else 0 for g, a in allocations[c].items()])
-        else:
-            raise Exception("1) This should NOT happen!")
-        if c not in sigmoidal_effective_reach_ratio:
-            # The sigmoidal effective reach ratio is compute with respect to the total effective allocation.
-            sigmoidal_effective_reach_ratio[c] = compute_sigmoidal_effective_reach_ratio(total_effective_allocation[c], c.reach)
-        else:
-            raise Exception("2) This should NOT happen!")
-        if c not in utilities:
-            # The actual final utility.
-            # print("Computing utilities:")
-            # print("\t ", sigmoidal_effective_reach_ratio[c])
-            # print("\t ", c.budget)
-            # print("\t ", total_c_expenditure)
-            utilities[c] = sigmoidal_effective_reach_ratio[c] * c.budget - total_c_expenditure
-        else:
-            raise Exception("3) This should NOT happen!")
+    for i, c in enumerate(allocations.campaigns):
+        total_c_expenditure = ledger.total_campaign_expenditure[c] if ledger is not None else total_campaign_expenditure.item(i)
+        # The sigmoidal effective reach ratio is compute with respect to the total effective allocation.
+        sigmoidal_effective_reach_ratio = compute_sigmoidal_effective_reach_ratio(total_effective_allocation.item(i), c.reach)
+        # The actual final utility.
+        utilities[c] = sigmoidal_effective_reach_ratio * c.budget - total_c_expenditure
+    total_expenditure = ledger.total_expenditure if ledger is not None else float(total_campaign_expenditure.sum())
     return utilities, total_expenditure
+
+
+def compute_statistics_batch(allocations: np.ndarray, expenditure: np.ndarray, matches_target: np.ndarray, reaches: np.ndarray, budgets: np.ndarray) -> \
+        Tuple[np.ndarray, np.ndarray]:
+    """
+    Computes the statistics of a batch of games at once. All games must have the same number of campaigns and goods.
+    :param allocations: a games x campaigns x goods array of allocations, e.g., the stacked values of CampaignGoodMatrix.
+    :param expenditure: a games x campaigns x goods array of expenditure.
+    :param matches_target: a games x campaigns x goods (or campaigns x goods, if shared by all games) mask, see compute_target_match_mask.
+    :param reaches: a games x campaigns array of reaches.
+    :param budgets: a games x campaigns array of budgets.
+    :return: a games x campaigns array of utilities, and an array with the total expenditure (auctioneer's revenue) of each game.
+    """
+    total_effective_allocation = (allocations * matches_target).sum(axis=2)
+    total_campaign_expenditure = expenditure.sum(axis=2)
+    utilities = compute_sigmoidal_effective_reach_ratio(total_effective_allocation, reaches) * budgets - total_campaign_expenditure
+    return utilities, total_campaign_expenditure.sum(axis=1)
@@ -1,21 +1,56 @@
-from dataclasses import dataclass
-from typing import Set, List, Dict
+import heapq
+from dataclasses import dataclass, field
+from typing import Set, List, Dict, Tuple, FrozenSet
 
+import numpy as np
 from prettytable import PrettyTable
 
 
+class MarketSegments:
+    """
+    Registry of market segments (attributes). Each segment is assigned its own bit, so that a set of segments is encoded as an integer bitmask.
+    The segments of the AdX game are registered upfront; any other segment is registered the first time it is seen.
+    Masks are stored in int64 arrays to match goods in bulk, so there can be at most max_segments segments.
+    """
+    bits: Dict[str, int] = {"Male": 1 << 0, "Female": 1 << 1, "Young": 1 << 2, "Old": 1 << 3, "High": 1 << 4, "Low": 1 << 5}
+    masks: Dict[FrozenSet[str], int] = {}
+    max_segments = 63
+
+    @staticmethod
+    def get_mask(segments: Set[str]) -> int:
+        """
+        Returns the bitmask of a set of segments. Masks are interned, so each distinct set of segments is only encoded once.
+        :param segments:
+        :return:
+        """
+        key = frozenset(segments)
+        if key not in MarketSegments.masks:
+            mask = 0
+            for segment in sorted(key):
+                if segment not in MarketSegments.bits:
+                    if len(MarketSegments.bits) >= MarketSegments.max_segments:
+                        raise Exception(f"Cannot register segment {segment}, there can be at most {MarketSegments.max_segments} market segments")
+                    MarketSegments.bits[segment] = 1 << len(MarketSegments.bits)
+                mask |= MarketSegments.bits[segment]
+            MarketSegments.masks[key] = mask
+        return MarketSegments.masks[key]
+
+
 @dataclass
 class Good:
     """
-    Represents an impression opportunity
+    Represents an impression opportunity. Goods are identified by the bitmask of their market segments, so matching, equality and hashing
+    are integer operations. The id, made of the first letters of the segments, is only used to display goods and to store them in files.
     """
     id: str
     market_segments: Set[str]
+    mask: int
     supply: int
     reserve_price: float
 
     def __init__(self, name: Set[str], supply: int, reserve_price: float):
         self.market_segments = name
+        self.mask = MarketSegments.get_mask(self.market_segments)
         self.supply = supply
         self.reserve_price = reserve_price
         list_of_segments = list(self.market_segments)
@@ -26,28 +61,33 @@ class Good:
     def __repr__(self):
         return "(" + self.id + "," + str(self.supply) + "," + str(self.reserve_price) + ")"
 
+    def __reduce__(self):
+        # Bits are assigned in order of registration, which might differ across processes. Hence, the mask is recomputed when unpickling.
+        return Good, (self.market_segments, self.supply, self.reserve_price)
+
     def __hash__(self):
-        return hash(self.id)
+        return self.mask
 
     def __lt__(self, other):
         return self.supply <= other.supply
 
     def __eq__(self, other):
-        return self.market_segments == other.market_segments
+        return self.mask == other.mask
 
     def __matches__(self, other):
-        return other.market_segments.issubset(self.market_segments)
+        return self.mask & other.mask == other.mask
 
 
 @dataclass
 class Campaign:
     """
-    Represents a campaign
+    Represents a campaign. Campaigns drawn in bulk carry a compact integer id, which is then used as their hash instead of the name.
     """
     name: str
     reach: int
     budget: float
     target: Good
+    id: int = None
 
     def __repr__(self):
         return "(" + self.name + ", " + self.target.id + ", " + str(self.reach) + ", " + str(self.budget) + ", " + str(self.budget / self.reach) + ")"
@@ -56,7 +96,7 @@ class Campaign:
         return (self.budget / self.reach) <= (other.budget / other.reach)
 
     def __hash__(self):
-        return hash(self.name)
+        return hash(self.name) if self.id is None else self.id
 
 
 @dataclass
@@ -66,33 +106,156 @@ class Market:
     """
     campaigns: List[Campaign]
     goods: List[Good]
+    index: 'MarketIndex' = field(default=None, init=False, repr=False, compare=False)
+
+    def get_index(self) -> 'MarketIndex':
+        """
+        Returns the index of the market, which is built the first time it is asked for. Hence, campaigns and goods must not change afterwards.
+        :return:
+        """
+        if self.index is None:
+            self.index = MarketIndex(self)
+        return self.index
+
+
+class MarketIndex:
+    """
+    Precomputed views of a market, built once and shared by the strategies and the auctions instead of each of them sorting campaigns and matching
+    them against goods again: the order of allocation of campaigns and goods, the bid per reach of each campaign, the campaign x good match matrix,
+    the goods each campaign demands and, for each good, the campaigns that demand it.
+    Campaigns are ordered by descending bid per reach, and campaigns with the same bid per reach are kept in market order.
+    """
+
+    def __init__(self, market: Market):
+        self.market = market
+        self.campaign_index = {c: i for i, c in enumerate(market.campaigns)}
+        self.good_index = {g: j for j, g in enumerate(market.goods)}
+        self.bid_per_reach = {c: c.budget / c.reach for c in market.campaigns}
+        self.ordered_campaigns = sorted(market.campaigns, key=lambda c: self.bid_per_reach[c], reverse=True)
+        self.ordered_goods = Sorting.copy_and_sort_goods(market.goods)
+        target_masks = np.array([c.target.mask for c in market.campaigns], dtype=np.int64).reshape(len(market.campaigns), 1)
+        good_masks = np.array([g.mask for g in market.goods], dtype=np.int64).reshape(1, len(market.goods))
+        # matches[i, j] is True if the j-th good matches the target of the i-th campaign.
+        self.matches = (good_masks & target_masks) == target_masks
+        # Demanded goods are listed in market order and in order of allocation. Competitors are listed in order of allocation.
+        matches = self.matches.tolist()
+        campaign_order = [self.campaign_index[c] for c in self.ordered_campaigns]
+        good_order = [self.good_index[g] for g in self.ordered_goods]
+        self.demanded_goods = {c: [g for g, match in zip(market.goods, matches[i]) if match] for i, c in enumerate(market.campaigns)}
+        self.ordered_demanded_goods = {c: [market.goods[j] for j in good_order if matches[i][j]] for i, c in enumerate(market.campaigns)}
+        self.competitors = {g: [market.campaigns[i] for i in campaign_order if matches[i][j]] for j, g in enumerate(market.goods)}
+
+
+class CampaignGoodMatrix:
+    """
+    A campaign x good matrix, e.g., of allocations or expenditure, stored as a dense numpy array together with the index maps of campaigns and goods.
+    It reads and writes like a Dict[Campaign, Dict[Good, x]], i.e., m[c][g], but actual dictionaries are only built when asked for, e.g., to print it.
+    Totals per campaign and per good are row and column sums.
+    """
+
+    def __init__(self, campaigns: List[Campaign], goods: List[Good], values: np.ndarray = None, dtype=float):
+        self.campaigns = campaigns
+        self.goods = goods
+        self.campaign_index = {c: i for i, c in enumerate(campaigns)}
+        self.good_index = {g: j for j, g in enumerate(goods)}
+        self.values = np.zeros((len(campaigns), len(goods)), dtype=dtype) if values is None else values
+
+    @staticmethod
+    def from_dict(matrix: Dict[Campaign, Dict[Good, float]], campaigns: List[Campaign] = None, goods: List[Good] = None, dtype=float):
+        campaigns = list(matrix.keys()) if campaigns is None else campaigns
+        goods = (list(matrix[campaigns[0]].keys()) if len(campaigns) > 0 else []) if goods is None else goods
+        return CampaignGoodMatrix(campaigns, goods, np.array([[matrix[c][g] for g in goods] for c in campaigns], dtype=dtype).reshape(len(campaigns), len(goods)))
+
+    def add(self, c: Campaign, g: Good, amount):
+        self.values[self.campaign_index[c], self.good_index[g]] += amount
+
+    def get_campaign_totals(self) -> np.ndarray:
+        return self.values.sum(axis=1)
+
+    def get_good_totals(self) -> np.ndarray:
+        return self.values.sum(axis=0)
+
+    def to_dict(self) -> Dict[Campaign, Dict[Good, float]]:
+        return {c: {g: self.values.item(i, j) for j, g in enumerate(self.goods)} for i, c in enumerate(self.campaigns)}
+
+    def items(self):
+        return ((c, self[c]) for c in self.campaigns)
+
+    def __getitem__(self, c: Campaign) -> 'CampaignGoodMatrixRow':
+        return CampaignGoodMatrixRow(self, self.campaign_index[c])
+
+    def __iter__(self):
+        return iter(self.campaigns)
+
+    def __len__(self):
+        return len(self.campaigns)
+
+    def __contains__(self, c: Campaign):
+        return c in self.campaign_index
+
+    def __eq__(self, other):
+        return self.to_dict() == (other.to_dict() if isinstance(other, CampaignGoodMatrix) else other)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+class CampaignGoodMatrixRow:
+    """
+    The row of a campaign in a CampaignGoodMatrix, which reads and writes like a Dict[Good, x].
+    """
+
+    def __init__(self, matrix: CampaignGoodMatrix, i: int):
+        self.matrix = matrix
+        self.i = i
+
+    def items(self):
+        return ((g, self.matrix.values.item(self.i, j)) for j, g in enumerate(self.matrix.goods))
+
+    def __getitem__(self, g: Good):
+        return self.matrix.values.item(self.i, self.matrix.good_index[g])
+
+    def __setitem__(self, g: Good, value):
+        self.matrix.values[self.i, self.matrix.good_index[g]] = value
+
+    def __iter__(self):
+        return iter(self.matrix.goods)
+
+    def __len__(self):
+        return len(self.matrix.goods)
+
+    def __eq__(self, other):
+        return dict(self.items()) == (dict(other.items()) if isinstance(other, CampaignGoodMatrixRow) else other)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
 
 
 @dataclass
 class Allocation:
     """
-    An allocation is a mapping from campaings to impressions (goods).
+    An allocation is a mapping from campaings to impressions (goods), stored as a campaign x good matrix.
     """
     market: Market
-    allocation: Dict[Campaign, Dict[Good, int]]
-    total_allocation_campaign: Dict[Campaign, int]
-    total_allocation_good: Dict[Good, int]
+    allocation: CampaignGoodMatrix
+    total_allocation_campaign: np.ndarray
+    total_allocation_good: np.ndarray
 
-    def __init__(self, market: Market, allocation: Dict[Campaign, Dict[Good, int]]):
+    def __init__(self, market: Market, allocation):
         self.market = market
-        self.allocation = allocation
-        self.total_allocation_campaign = {}
-        self.total_allocation_good = {}
+        self.allocation = allocation if isinstance(allocation, CampaignGoodMatrix) else CampaignGoodMatrix.from_dict(allocation, market.campaigns, market.goods, dtype=int)
+        self.total_allocation_campaign = None
+        self.total_allocation_good = None
 
     def get_total_campaign_allocation(self, c: Campaign) -> int:
-        if c not in self.total_allocation_campaign:
-            self.total_allocation_campaign[c] = sum(self.allocation[c][g] for g in self.market.goods)
-        return self.total_allocation_campaign[c]
+        if self.total_allocation_campaign is None:
+            self.total_allocation_campaign = self.allocation.get_campaign_totals()
+        return self.total_allocation_campaign.item(self.allocation.campaign_index[c])
 
     def get_total_good_allocation(self, g: Good) -> int:
-        if g not in self.total_allocation_good:
-            self.total_allocation_good[g] = sum(self.allocation[c][g] for c in self.market.campaigns)
-        return self.total_allocation_good[g]
+        if self.total_allocation_good is None:
+            self.total_allocation_good = self.allocation.get_good_totals()
+        return self.total_allocation_good.item(self.allocation.good_index[g])
 
     def __str__(self):
         allocation_table = PrettyTable()
@@ -133,6 +296,98 @@ class Bid:
         return self.bid <= other.bid
 
 
+class SpendLedger:
+    """
+    Keeps track, incrementally, of the expenditure of each campaign per good, in total, and matched over the good of each of its bids.
+    The matched expenditure of a bid's good is the sum of the expenditure over all goods that match it, i.e., what is checked against the bid limit.
+    """
+
+    def __init__(self, goods: List[Good], campaigns: List[Campaign], bids: List[Bid]):
+        self.expenditure = CampaignGoodMatrix(campaigns, goods)
+        self.total_campaign_expenditure = {c: 0 for c in campaigns}
+        self.total_expenditure = 0
+        self.matched_expenditure = {c: {} for c in campaigns}
+        for b in bids:
+            self.matched_expenditure[b.campaign][b.good] = 0
+        # For each campaign and good, the bid goods whose matched expenditure changes when the campaign spends on the good.
+        self.matching_bid_goods = {c: {g: [t for t in self.matched_expenditure[c] if g.__matches__(t)] for g in goods} for c in campaigns}
+
+    def record(self, c: Campaign, g: Good, amount: float):
+        self.expenditure.add(c, g, amount)
+        self.total_campaign_expenditure[c] += amount
+        self.total_expenditure += amount
+        for t in self.matching_bid_goods[c][g]:
+            self.matched_expenditure[c][t] += amount
+
+    def get_remaining_limit(self, b: Bid) -> float:
+        return b.limit - self.matched_expenditure[b.campaign][b.good]
+
+
+class BidBook:
+    """
+    The standing bids of a game, organized to run second price auctions. For each good, keeps a max-heap of the bids that participate in its auctions,
+    i.e., bids that match the good and are at least its reserve price. Ties are ordered by the position of the campaign in the list of campaigns.
+    Bids that reach their limit are removed lazily: they are only discarded from a heap once they show up at its top.
+    """
+
+    def __init__(self, goods: List[Good], campaigns: List[Campaign], bids: List[Bid], index: MarketIndex = None):
+        self.reserve_prices = {g: g.reserve_price for g in goods}
+        campaign_index = {c: i for i, c in enumerate(campaigns)} if index is None else index.campaign_index
+        self.bids = bids
+        self.standing = [True for _ in bids]
+        self.bids_of_campaign = {c: [] for c in campaigns}
+        for b, bid in enumerate(bids):
+            self.bids_of_campaign[bid.campaign].append(b)
+        self.heaps = {g: [(-bid.bid, campaign_index[bid.campaign], b) for b, bid in enumerate(bids) if g.__matches__(bid.good) and bid.bid >= g.reserve_price]
+                      for g in goods}
+        for heap in self.heaps.values():
+            heapq.heapify(heap)
+
+    def get_auction_outcome(self, g: Good) -> Tuple[List[Bid], float]:
+        """
+        Returns the winning bids of an auction for good g, at most one per campaign, together with the price, i.e., the max between the second
+        largest bid and the reserve price. The price of the second largest bid is zero if there is no such bid. If there are no bids, returns no winners.
+        :param g:
+        :return:
+        """
+        heap = self.heaps[g]
+        winning_bids = []
+        second_largest = None
+        # Pop bids until the first one from a campaign that does not win. Each campaign only counts with its max bid.
+        popped = []
+        seen_campaigns = set()
+        while len(heap) > 0 and second_largest is None:
+            entry = heapq.heappop(heap)
+            if not self.standing[entry[2]]:
+                continue
+            popped.append(entry)
+            if entry[1] in seen_campaigns:
+                continue
+            seen_campaigns.add(entry[1])
+            if len(winning_bids) == 0 or -entry[0] >= winning_bids[0].bid:
+                winning_bids.append(self.bids[entry[2]])
+            else:
+                second_largest = -entry[0]
+        for entry in popped:
+            heapq.heappush(heap, entry)
+        if len(winning_bids) == 0:
+            return winning_bids, 0.0
+        if len(winning_bids) >= 2:
+            second_largest = winning_bids[0].bid
+        return winning_bids, max(second_largest if second_largest is not None else 0.0, self.reserve_prices[g])
+
+    def remove_exhausted_bids(self, c: Campaign, ledger: SpendLedger):
+        """
+        Removes the bids of campaign c whose limit minus the expenditure across all matching goods is less than the bid.
+        :param c:
+        :param ledger:
+        :return:
+        """
+        for b in self.bids_of_campaign[c]:
+            if self.standing[b] and ledger.get_remaining_limit(self.bids[b]) < self.bids[b].bid:
+                self.standing[b] = False
+
+
 class Sorting:
     @staticmethod
     def copy_and_sort_goods(list_of_goods: List[Good]) -> List[Good]:
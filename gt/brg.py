@@ -1,7 +1,12 @@
+import math
+from typing import List
+
 import matplotlib.pyplot as plt
 import networkx as nx
 import pandas as pd
 
+from game.results import read_results, results_schema, ResultsAggregate
+
 
 def plot_directed_graph(G: nx.Graph):
     """
@@ -14,29 +19,132 @@ def plot_directed_graph(G: nx.Graph):
     plt.show()
 
 
-def compute_eps_brg(file: str, eps: float = 0.0, normalize_revenue=False, verbose: bool = False):
+def normalize_utilities(data: pd.DataFrame, normalize_revenue=False, columns: List[str] = None) -> pd.DataFrame:
+    """
+    Normalizes the utilities of results to be in the 0-1 range, each strategy with respect to its own min and max.
+    :param data: results, e.g., as saved by estimate_a_single_game.
+    :param normalize_revenue: whether to normalize the revenue too.
+    :param columns: for each strategy, the columns normalized together with it, e.g., the utilities of the deviating players. The min and max are taken
+    over the strategy and all of its columns, so that all of them end up in the 0-1 range.
+    :return: a normalized copy of the data.
+    """
+    data = data.copy()
+    for strategy in ['we', 'wf']:
+        strategy_columns = [strategy] + [c for c in (columns or []) if c.endswith('_' + strategy)]
+        the_max, the_min = data[strategy_columns].max().max(), data[strategy_columns].min().min()
+        for column in strategy_columns:
+            data[column] = data[column].apply(lambda x: (x - the_min) / ((the_max - the_min) if the_max - the_min > 0.0 else 1.0))
+    if normalize_revenue:
+        data['revenue'] = data['revenue'].apply(
+            lambda x, the_max=data['revenue'].max(), the_min=data['revenue'].min(): (x - the_min) / ((the_max - the_min) if the_max - the_min > 0.0 else 1.0))
+    return data
+
+
+def compute_paired_differences(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Pairs the results of neighbouring profiles played on the same market. Edge i links profile i with profile i + 1, where player i deviates from WF to
+    WE, so each market where both were played gives a sample of the gain of the deviation: the utility of player i as the last WE player of profile
+    i + 1 minus its utility as the first WF player of profile i. Utilities of deviating players are normalized together with the mean utilities of their
+    strategy, with the min and max over both, since a single player can be farther from them than the mean of its strategy. Differences are thus in the
+    -1-1 range, as get_undecided_edges assumes.
+    :param data: results with samples, i.e., as saved by estimate_a_single_game with common random numbers.
+    :return: a data frame with the edge, the sample, the normalized utilities of the deviating player and their difference.
+    """
+    data = normalize_utilities(data, columns=['deviator_we', 'deviator_wf']).dropna(subset=['sample'])
+    we = data[['sample']].assign(edge=data['num_WE'] - 1, we=data['deviator_we'])
+    wf = data[['sample']].assign(edge=data['num_WE'], wf=data['deviator_wf'])
+    paired = we.merge(wf, on=['edge', 'sample']).dropna()
+    paired['edge'] = paired['edge'].astype(int)
+    paired['difference'] = paired['we'] - paired['wf']
+    return paired[['edge', 'sample', 'we', 'wf', 'difference']].sort_values(['edge', 'sample']).reset_index(drop=True)
+
+
+def compute_empirical_bernstein_radius(variance: float, m: int, delta: float, value_range: float = 1.0) -> float:
+    """
+    Radius of the two-sided empirical Bernstein confidence interval of Maurer and Pontil around the mean of m samples in a range of length value_range.
+    :param variance: the sample variance (with Bessel's correction).
+    :param m: the number of samples.
+    :param delta: the probability that the true mean is outside the interval.
+    :param value_range: the length of the range of the samples, e.g., 2 for differences of utilities in the 0-1 range.
+    :return:
     """
-    Reads the results.csv file, constructs the 2eps-BRG and returns it, together with the revenue at each node.
-    :param file:
+    if m < 2:
+        return math.inf
+    return math.sqrt(2.0 * variance * math.log(4.0 / delta) / m) + 7.0 * value_range * math.log(4.0 / delta) / (3.0 * (m - 1))
+
+
+def get_undecided_edges(data: pd.DataFrame, eps: float, delta: float, paired: bool = False) -> List[int]:
+    """
+    Given results so far, returns the edges of the 2eps-BRG (see compute_eps_brg) whose direction is not decided yet. Edge i links profile i (i WE players)
+    with profile i + 1 and depends on the WE utility in profile i + 1 and the WF utility in profile i. Its forward (backward) direction is decided
+    once the empirical Bernstein interval of the difference between those is entirely on one side of -2eps (2eps). Utilities are normalized as in
+    compute_eps_brg, with the min and max of the results so far.
+    :param data: results, e.g., as saved by estimate_a_single_game.
+    :param eps:
+    :param delta: the probability that each interval of a mean utility (or of a mean difference, if paired) does not contain it.
+    :param paired: if True, the data comes from common random numbers and the difference is estimated directly by the paired differences of the
+    deviating players (see compute_paired_differences), whose variance does not add up the variance of both profiles.
+    :return: the list of undecided edges, by index.
+    """
+    n = int(data.iloc[0]['num_WE']) + int(data.iloc[0]['num_WF'])
+    if paired:
+        differences = compute_paired_differences(data).groupby('edge')['difference'].agg(['mean', 'var', 'count'])
+    else:
+        statistics = normalize_utilities(data).groupby('num_WE')[['we', 'wf']].agg(['mean', 'var', 'count'])
+    undecided_edges = []
+    for i in range(0, n):
+        if paired:
+            if i not in differences.index:
+                undecided_edges.append(i)
+                continue
+            difference = differences.loc[i, 'mean']
+            radius = compute_empirical_bernstein_radius(differences.loc[i, 'var'], int(differences.loc[i, 'count']), delta, 2.0)
+        else:
+            if i not in statistics.index or i + 1 not in statistics.index:
+                undecided_edges.append(i)
+                continue
+            we, wf = statistics.loc[i + 1, 'we'], statistics.loc[i, 'wf']
+            difference = we['mean'] - wf['mean']
+            radius = compute_empirical_bernstein_radius(we['var'], int(we['count']), delta) + compute_empirical_bernstein_radius(wf['var'], int(wf['count']), delta)
+        forward_decided = difference - radius >= -2.0 * eps or difference + radius < -2.0 * eps
+        backward_decided = difference + radius <= 2.0 * eps or difference - radius > 2.0 * eps
+        if not (forward_decided and backward_decided):
+            undecided_edges.append(i)
+    return undecided_edges
+
+
+def compute_eps_brg(file: str = None, eps: float = 0.0, normalize_revenue=False, verbose: bool = False, paired_differences: pd.DataFrame = None,
+                    results=None):
+    """
+    Reads the results file, or takes the results in memory, constructs the 2eps-BRG and returns it, together with the revenue at each node.
+    :param file: a columnar binary store of results, of which only the columns needed are read, or a csv file (see game.results.read_results), or a json
+    file with their aggregate (see game.results.ResultsAggregate).
     :param eps:
     :param normalize_revenue:
     :param verbose:
+    :param paired_differences: the paired differences of deviating players, see compute_paired_differences. If given, edges are decided by the mean
+    gain of each deviation instead of by comparing the mean utilities of independently sampled profiles. Edges without paired differences go both ways.
+    :param results: the results, as returned by estimate_a_single_game, i.e., a list of rows, or their ResultsAggregate, or a data frame. If given, the
+    file is not read.
     :return:
     """
-    # Read the results and compute the mean utility
-    data = pd.read_csv(file)
-
-    # Normalize the utilities to be in the 0-1 range
-    data['we'] = data['we'].apply(lambda x, the_max=max(data['we']), the_min=min(data['we']): (x - the_min) / ((the_max - the_min) if the_max - the_min > 0.0 else 1.0))
-    data['wf'] = data['wf'].apply(lambda x, the_max=max(data['wf']), the_min=min(data['wf']): (x - the_min) / ((the_max - the_min) if the_max - the_min > 0.0 else 1.0))
-    if normalize_revenue:
-        data['revenue'] = data['revenue'].apply(
-            lambda x, the_max=max(data['revenue']), the_min=min(data['revenue']): (x - the_min) / ((the_max - the_min) if the_max - the_min > 0.0 else 1.0))
+    if results is None and file is None:
+        raise Exception("Either the results or the file of the results must be given")
+    if isinstance(results, ResultsAggregate) or (results is None and file.endswith('.json')):
+        # The aggregate already has the mean of each profile, and the min and max of each column.
+        mean = (ResultsAggregate.load(file) if results is None else results).get_normalized_means(normalize_revenue)
+    else:
+        # Read the results and compute the mean utility
+        if results is None:
+            data = read_results(file, ['num_WE', 'num_WF', 'we', 'wf', 'revenue'])
+        else:
+            data = results if isinstance(results, pd.DataFrame) else pd.DataFrame(results, columns=list(results_schema))
+        data = normalize_utilities(data[['num_WE', 'num_WF', 'we', 'wf', 'revenue']], normalize_revenue)
 
-    # Aggregate data by mean.
-    mean = data.groupby(by=['num_WE', 'num_WF']).mean()
-    mean = mean.reset_index()
-    n = int(data.iloc[0]['num_WE']) + int(data.iloc[0]['num_WF'])
+        # Aggregate data by mean.
+        mean = data.groupby(by=['num_WE', 'num_WF']).mean()
+        mean = mean.reset_index()
+    n = int(mean.iloc[0]['num_WE']) + int(mean.iloc[0]['num_WF'])
 
     # Create the best-response graph object.
     G = nx.DiGraph()
@@ -44,6 +152,12 @@ def compute_eps_brg(file: str, eps: float = 0.0, normalize_revenue=False, verbos
     G.add_nodes_from([str(k) + 'WE_' + str(n - k) + 'WF' for k in range(0, n + 1)])
     we_utilities = {int(row['num_WE']): row['we'] for index, row in mean.iterrows()}
     wf_utilities = {int(row['num_WF']): row['wf'] for index, row in mean.iterrows()}
+    if paired_differences is not None:
+        # The mean gain of deviating along edge i plays the role of the WE utility, against a WF utility of 0. An edge without paired samples, e.g.,
+        # because one of its profiles was retired before markets were shared, is undecided, so it gets a gain of 0, i.e., both directions.
+        mean_differences = paired_differences.groupby('edge')['difference'].mean()
+        we_utilities = {i + 1: mean_differences[i] if i in mean_differences.index else 0.0 for i in range(0, n)}
+        wf_utilities = {n - i: 0.0 for i in range(0, n)}
     # Record the revenue.
     revenue = {str(int(row['num_WE'])) + 'WE_' + str(n - int(row['num_WE'])) + 'WF': row['revenue'] for index, row in mean.iterrows()}
 
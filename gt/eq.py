@@ -94,27 +94,28 @@ def compute_scc_eq(G: nx.Graph, revenue_per_node: Dict[str, float]) -> Tuple[Lis
     return strongly_connected_components, revenue_per_node_per_scc
 
 
-def save_eq_data(family_of_nodes: List[List[str]], revenue_per_node_per_family_member: List[List[float]], aggregations, file: str, verbose: bool):
+def save_eq_data(family_of_nodes: List[List[str]], revenue_per_node_per_family_member: List[List[float]], aggregations, file: str = None, verbose: bool = False):
     """
     Given a family of nodes, the revenue per node per family member, and aggregated data; save all of it for logging purposes.
     :param family_of_nodes:
     :param revenue_per_node_per_family_member:
     :param aggregations:
-    :param file:
+    :param file: the file to save to. If None, nothing is saved, e.g., to save it later, or in the background.
     :param verbose:
-    :return:
+    :return: the final aggregated revenue, i.e., the first line of the file, so that it need not be read back.
     """
     final_aggregated_revenue = aggregations[0]
     aggregated_revenue_per_family_member = aggregations[1]
     # Save results to files.
-    f = open(file, "w")
-    f.write(str(final_aggregated_revenue) + "\n")
-    for s in family_of_nodes:
-        f.write(",".join(s) + "\n")
-    for s in revenue_per_node_per_family_member:
-        f.write(",".join([str(r) for r in s]) + "\n")
-    for m in aggregated_revenue_per_family_member:
-        f.write(str(m) + "\n")
+    if file is not None:
+        with open(file, "w") as f:
+            f.write(str(final_aggregated_revenue) + "\n")
+            for s in family_of_nodes:
+                f.write(",".join(s) + "\n")
+            for s in revenue_per_node_per_family_member:
+                f.write(",".join([str(r) for r in s]) + "\n")
+            for m in aggregated_revenue_per_family_member:
+                f.write(str(m) + "\n")
 
     if verbose:
         print("family_of_nodes = ", family_of_nodes)
@@ -122,3 +123,4 @@ def save_eq_data(family_of_nodes: List[List[str]], revenue_per_node_per_family_m
         print("aggregated_revenue_per_family_member = ", aggregated_revenue_per_family_member)
         print("final_aggregated_revenue = ", final_aggregated_revenue)
         # plot_directed_graph(G)
+    return final_aggregated_revenue
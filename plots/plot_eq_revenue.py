@@ -1,3 +1,5 @@
+import os
+
 import matplotlib.pyplot as plt
 
 from gt.brg import compute_eps_brg
@@ -15,7 +17,11 @@ for i in range(0, 151):
     # for i in range(0, 51):
     print("\r", i, end='')
     # Compute the eps-BRG from the game data
-    G, revenue_per_node = compute_eps_brg('../results/experiments/' + str(which_folder) + '/' + str(i) + '/results.csv', eps=0.025, normalize_revenue=normalize_revenue)
+    # Experiments save either the results of all games or only their aggregate, see experiments.estimate_a_single_game.
+    results_file = '../results/experiments/' + str(which_folder) + '/' + str(i) + '/results.json'
+    if not os.path.exists(results_file):
+        results_file = results_file.replace('results.json', 'results.csv')
+    G, revenue_per_node = compute_eps_brg(results_file, eps=0.025, normalize_revenue=normalize_revenue)
 
     # Compute the Equilibria
     family_of_nodes, revenue_per_node_per_family_member = \
@@ -1,9 +1,14 @@
 import itertools
-from typing import Dict, List
+import math
+from collections import deque, OrderedDict
+from typing import Dict, List, Tuple, Set
 
+import numpy as np
 import pulp
+from scipy.optimize import linprog
+from scipy.sparse import coo_array
 
-from game.structures import Market, Allocation, Good, Bid, Sorting
+from game.structures import Market, Allocation, Good, Bid, CampaignGoodMatrix
 
 
 def greedy_allocation(m: Market) -> Allocation:
@@ -12,38 +17,35 @@ def greedy_allocation(m: Market) -> Allocation:
     :param m: a market
     :return: an Allocation
     """
-    # Sort a shallow copy of campaigns to get the order of allocation
-    list_of_ordered_campaigns = Sorting.copy_and_sort_campaigns(m.campaigns)
-    # Sort a shallow copy of goods to get the order of allocation
-    list_of_ordered_goods = Sorting.copy_and_sort_goods(m.goods)
+    # The index of the market holds the order of allocation of campaigns and goods, and the goods each campaign demands.
+    index = m.get_index()
 
     # Book keeping structures
     remaining_supply = {g: g.supply for g in m.goods}
-    allocation = {c: {g: 0 for g in m.goods} for c in m.campaigns}
+    allocation = CampaignGoodMatrix(m.campaigns, m.goods, dtype=int)
     total_allocation = {c: 0 for c in m.campaigns}
     # Loop through Campaigns
-    for c in list_of_ordered_campaigns:
+    for c in index.ordered_campaigns:
         # Check if there are enough goods to completely allocate the campaign.
-        if sum([remaining_supply[g] for g in m.goods if g.__matches__(c.target)]) >= c.reach:
+        if sum([remaining_supply[g] for g in index.demanded_goods[c]]) >= c.reach:
             # Loop through Goods.
-            for g in list_of_ordered_goods:
-                if g.__matches__(c.target):
-                    allocation[c][g] = min(c.reach - total_allocation[c], remaining_supply[g])
-                    total_allocation[c] = total_allocation[c] + allocation[c][g]
-                    remaining_supply[g] = remaining_supply[g] - allocation[c][g]
+            for g in index.ordered_demanded_goods[c]:
+                allocation[c][g] = min(c.reach - total_allocation[c], remaining_supply[g])
+                total_allocation[c] = total_allocation[c] + allocation[c][g]
+                remaining_supply[g] = remaining_supply[g] - allocation[c][g]
                 # If the goods are too expensive, give them back
-            if sum([allocation[c][g] * g.reserve_price for g in list_of_ordered_goods]) > c.budget:
+            if sum([allocation[c][g] * g.reserve_price for g in index.ordered_demanded_goods[c]]) > c.budget:
                 total_allocation[c] = 0
-                for g in list_of_ordered_goods:
+                for g in index.ordered_demanded_goods[c]:
                     allocation[c][g] = 0
                     remaining_supply[g] += allocation[c][g]
 
     return Allocation(m, allocation)
 
 
-def pricing(allocation: Allocation) -> Dict[Good, float]:
+def pricing_pulp(allocation: Allocation) -> Dict[Good, float]:
     """
-    Given an allocation, compute prices.
+    Given an allocation, compute prices by solving the pricing LP with PuLP, i.e., with an external CBC process.
     :param allocation: an allocated market
     :return: a dictionary with prices, one per good
     """
@@ -78,10 +80,251 @@ def pricing(allocation: Allocation) -> Dict[Good, float]:
     return {g: prices_variables[g].value() for g in allocation.market.goods}
 
 
-def we_strategy(market: Market) -> List[Bid]:
+def get_indifference_pairs(allocation: Allocation) -> List[Tuple[int, int]]:
+    """
+    Given an allocation, returns the indifference constraints of the pricing LP, as pairs of good indices (i, k) standing for p_i <= p_k + slack.
+    There is one pair per campaign allocated good i and other good k matching its target and not entirely allocated to it.
+    :param allocation: an allocated market
+    :return: a list of pairs of good indices, with repetitions.
+    """
+    goods = allocation.market.goods
+    x = allocation.allocation.values
+    return [(i, k)
+            for j, c in enumerate(allocation.market.campaigns)
+            for i in np.flatnonzero(x[j] > 0).tolist()
+            for k, g in enumerate(goods)
+            if goods[i] != g and g.__matches__(c.target) and x[j, k] < g.supply]
+
+
+def pricing_highs(allocation: Allocation) -> Dict[Good, float]:
+    """
+    Given an allocation, compute prices by solving the same LP as pricing_pulp in-process with scipy's HiGHS solver.
+    Only the slack variables of indifference constraints that are actually imposed are part of the LP, the others are zero at any optimum anyway.
+    :param allocation: an allocated market
+    :return: a dictionary with prices, one per good
+    """
+    goods = allocation.market.goods
+    campaigns = allocation.market.campaigns
+    x = allocation.allocation.values
+    num_goods = len(goods)
+    # Indifference condition, a.k.a. compact condition, relaxed with slacks: p_i - p_k - slack <= 0.
+    indifference_pairs = get_indifference_pairs(allocation)
+    # IR constraints, one row per allocated campaign.
+    allocated_campaigns = np.flatnonzero(x.sum(axis=1) > 0)
+    ir_rows, ir_cols = np.nonzero(x[allocated_campaigns])
+    num_slacks = len(indifference_pairs)
+    slack_rows = np.arange(len(allocated_campaigns), len(allocated_campaigns) + num_slacks)
+    pairs = np.array(indifference_pairs, dtype=int).reshape(num_slacks, 2)
+    a_ub = coo_array((np.concatenate([x[allocated_campaigns][ir_rows, ir_cols], np.ones(num_slacks), -np.ones(num_slacks), -np.ones(num_slacks)]),
+                      (np.concatenate([ir_rows, slack_rows, slack_rows, slack_rows]),
+                       np.concatenate([ir_cols, pairs[:, 0], pairs[:, 1], num_goods + np.arange(0, num_slacks)]))),
+                     shape=(len(allocated_campaigns) + num_slacks, num_goods + num_slacks))
+    b_ub = np.concatenate([np.array([campaigns[j].budget for j in allocated_campaigns.tolist()], dtype=float), np.zeros(num_slacks)])
+    # Maximum revenue objective, minimizing slack. linprog minimizes, hence the signs.
+    objective = np.concatenate([-x.sum(axis=0).astype(float), np.ones(num_slacks)])
+    # Reserve price constraints, on top of the prices being non-negative.
+    bounds = [(max(0.0, g.reserve_price), None) for g in goods] + [(0.0, None)] * num_slacks
+    result = linprog(objective, A_ub=a_ub.tocsr() if a_ub.shape[0] > 0 else None, b_ub=b_ub if a_ub.shape[0] > 0 else None, bounds=bounds, method='highs')
+    if not result.success:
+        raise Exception(f"Could not compute WE prices: {result.message}")
+    return {g: result.x[i].item() for i, g in enumerate(goods)}
+
+
+def get_maximal_min_cut(capacity: List[List[float]], source: int, sink: int) -> Set[int]:
+    """
+    Computes a minimum source-sink cut of a small graph with the Edmonds-Karp algorithm.
+    :param capacity: a dense matrix of edge capacities, possibly infinite. It is overwritten with residual capacities.
+    :param source: the source node
+    :param sink: the sink node
+    :return: the source side of the minimum cut with the most nodes.
+    """
+    nodes = range(0, len(capacity))
+    while True:
+        # Find a shortest augmenting path.
+        parent = {source: None}
+        queue = deque([source])
+        while queue and sink not in parent:
+            u = queue.popleft()
+            for v in nodes:
+                if v not in parent and capacity[u][v] > 0:
+                    parent[v] = u
+                    queue.append(v)
+        if sink not in parent:
+            break
+        path = []
+        v = sink
+        while parent[v] is not None:
+            path.append((parent[v], v))
+            v = parent[v]
+        flow = min([capacity[u][v] for u, v in path])
+        for u, v in path:
+            capacity[u][v] -= flow
+            capacity[v][u] += flow
+    # The sink side are the nodes that can still reach the sink.
+    sink_side = {sink}
+    queue = deque([sink])
+    while queue:
+        v = queue.popleft()
+        for u in nodes:
+            if u not in sink_side and capacity[u][v] > 0:
+                sink_side.add(u)
+                queue.append(u)
+    return set(nodes) - sink_side
+
+
+def pricing_difference_constraints(allocation: Allocation) -> Dict[Good, float]:
+    """
+    Given an allocation, compute prices exploiting the structure of the pricing LP instead of solving it. When every allocated campaign is allocated
+    a single good, IR constraints are upper bounds on prices, so the LP maximizes sum_g x_g p_g - sum_(i, k) max(0, p_i - p_k) over prices within
+    bounds, where (i, k) ranges over the difference constraints p_i <= p_k. For every price level t, the goods priced at least t must then form a
+    maximum weight closure, i.e., a minimum cut, and the largest such sets are nested as t grows. Hence, prices are found by solving a small
+    minimum cut problem per distinct bound. Otherwise, i.e., when the IR constraint of some campaign spans several goods, the LP is solved with pricing_highs.
+    Since the largest closures are taken, when the LP has several optimal solutions, these are the maximal optimal prices, which may differ from the
+    prices pricing_pulp or pricing_highs find, although their objective is the same.
+    :param allocation: an allocated market
+    :return: a dictionary with prices, one per good
+    """
+    goods = allocation.market.goods
+    campaigns = allocation.market.campaigns
+    x = allocation.allocation.values
+    lower = [max(0.0, g.reserve_price) for g in goods]
+    upper = [math.inf] * len(goods)
+    for j in np.flatnonzero(x.sum(axis=1) > 0).tolist():
+        goods_of_j = np.flatnonzero(x[j] > 0).tolist()
+        if len(goods_of_j) > 1:
+            return pricing_highs(allocation)
+        g = goods_of_j[0]
+        upper[g] = min(upper[g], campaigns[j].budget / x[j, g])
+    allocated_goods = [g for g in range(0, len(goods)) if upper[g] < math.inf]
+    if any([lower[g] > upper[g] for g in allocated_goods]):
+        return pricing_highs(allocation)
+    # Goods nobody was allocated can always be priced high enough to need no slack, so only difference constraints among allocated goods matter.
+    weights = {}
+    for i, k in get_indifference_pairs(allocation):
+        if upper[k] < math.inf:
+            weights[(i, k)] = weights.get((i, k), 0) + 1
+    total_allocation = x.sum(axis=0).tolist()
+    levels = sorted(set([lower[g] for g in allocated_goods] + [upper[g] for g in allocated_goods]))
+    prices = [lower[g] for g in range(0, len(goods))]
+    for previous_level, level in zip(levels, levels[1:]):
+        # Goods that must be priced at least level, and goods that cannot be.
+        priced_in = [g for g in allocated_goods if lower[g] >= level]
+        priced_out = set([g for g in allocated_goods if upper[g] <= previous_level])
+        candidates = [g for g in allocated_goods if g not in priced_out]
+        if all([k not in priced_out for i, k in weights]):
+            # Raising every candidate costs no slack.
+            priced_goods = candidates
+        else:
+            # Node 0 is the source, node 1 the sink, and the node of the n-th allocated good is n + 2.
+            node = {g: n + 2 for n, g in enumerate(allocated_goods)}
+            capacity = [[0.0] * (len(allocated_goods) + 2) for _ in range(0, len(allocated_goods) + 2)]
+            for g in allocated_goods:
+                capacity[0][node[g]] = math.inf if g in priced_in else total_allocation[g]
+                if g in priced_out:
+                    capacity[node[g]][1] = math.inf
+            for (i, k), w in weights.items():
+                capacity[node[i]][node[k]] += w
+            source_side = get_maximal_min_cut(capacity, 0, 1)
+            priced_goods = [g for g in allocated_goods if node[g] in source_side]
+        for g in priced_goods:
+            prices[g] = level
+    # Goods nobody was allocated are priced high enough to need no slack.
+    for i, k in get_indifference_pairs(allocation):
+        if upper[k] == math.inf:
+            prices[k] = max(prices[k], prices[i])
+    return {g: prices[i] for i, g in enumerate(goods)}
+
+
+# The implementations of the pricing LP, by name.
+pricing_backends = {"pulp": pricing_pulp,
+                    "highs": pricing_highs,
+                    "difference_constraints": pricing_difference_constraints}
+
+
+class PricingCache:
+    """
+    A bounded least recently used cache of WE prices. Prices only depend on the data of the pricing LP, i.e., the goods, and the allocation,
+    target and budget of each allocated campaign, so those, in a canonical order, are the key.
+    Budgets cannot be left out of the key: without IR constraints, the LP is unbounded, since the price of an allocated good rises until the budget
+    of some campaign binds, so every optimum depends on the exact value of some budgets. Markets with budgets drawn from a continuous distribution
+    hence never hit, and the cache only pays off when the same markets are priced again, e.g., with fixed campaigns. This is why pricing does not
+    use it by default.
+    The cache lives in a module level variable, so every process, e.g., each worker of a ProcessPoolExecutor, has its own.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_signature(allocation: Allocation, backend: str) -> tuple:
+        """
+        Computes the key of the pricing LP of the given allocation. Campaigns that are not allocated anything play no role in the LP.
+        :param allocation: an allocated market
+        :param backend: the key in pricing_backends of the implementation used to solve the pricing LP.
+        :return: a hashable signature.
+        """
+        x = allocation.allocation.values
+        goods = tuple([(g.mask, g.supply, g.reserve_price) for g in allocation.market.goods])
+        campaigns = tuple(sorted([(c.target.mask, c.budget, x[j].tobytes())
+                                  for j, c in enumerate(allocation.market.campaigns) if x[j].any()]))
+        return backend, goods, campaigns
+
+    def get_prices(self, allocation: Allocation, backend: str) -> Dict[Good, float]:
+        """
+        Given an allocation, returns the cached prices, or computes and caches them.
+        :param allocation: an allocated market
+        :param backend: the key in pricing_backends of the implementation used to solve the pricing LP.
+        :return: a dictionary with prices, one per good
+        """
+        signature = PricingCache.get_signature(allocation, backend)
+        prices = self.entries.get(signature)
+        if prices is not None:
+            self.hits += 1
+            self.entries.move_to_end(signature)
+        else:
+            self.misses += 1
+            prices = pricing_backends[backend](allocation)
+            prices = [prices[g] for g in allocation.market.goods]
+            self.entries[signature] = prices
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return {g: p for g, p in zip(allocation.market.goods, prices)}
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"PricingCache(size={len(self.entries)}, maxsize={self.maxsize}, hits={self.hits}, misses={self.misses})"
+
+
+# The prices computed so far by this process.
+pricing_cache = PricingCache()
+
+
+def pricing(allocation: Allocation, backend: str = 'difference_constraints', use_cache: bool = False) -> Dict[Good, float]:
+    """
+    Given an allocation, compute prices.
+    :param allocation: an allocated market
+    :param backend: the key in pricing_backends of the implementation used to solve the pricing LP. All of them find optimal prices, but when the LP
+    has several optimal solutions, they may find different ones, e.g., the default finds the maximal optimal prices (see pricing_difference_constraints).
+    :param use_cache: whether to look the prices up in, and store them in, pricing_cache. Only worth it if the same markets are priced again, see
+    PricingCache.
+    :return: a dictionary with prices, one per good
+    """
+    if use_cache:
+        return pricing_cache.get_prices(allocation, backend)
+    return pricing_backends[backend](allocation)
+
+
+def we_strategy(market: Market, pricing_backend: str = 'difference_constraints') -> List[Bid]:
     # The we strategy is to bid only on those goods for which the bidder was allocated.
     # The bid is (bid, limit) = (p_g, p_g x_cg) in case p_g >0; otherwise the bid is (bid, limit) = (0.0, c.budget) in case p_g=0.
     allocation_object = greedy_allocation(market)
-    prices = pricing(allocation_object)
+    prices = pricing(allocation_object, pricing_backend)
     return [Bid(c, g, prices[g], allocation_object.allocation[c][g] * prices[g] if prices[g] > 0 else c.budget)
             for c in market.campaigns for g in market.goods if allocation_object.allocation[c][g] > 0]
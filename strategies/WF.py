@@ -1,6 +1,9 @@
+import heapq
 from typing import List, Tuple, Dict
 
-from game.structures import Campaign, Good, Market, Allocation, Bid, Sorting
+import numpy as np
+
+from game.structures import Campaign, Good, Market, Allocation, Bid, CampaignGoodMatrix
 
 
 def waterfall(m: Market) -> Tuple[Allocation, Dict[Campaign, Good]]:
@@ -9,31 +12,31 @@ def waterfall(m: Market) -> Tuple[Allocation, Dict[Campaign, Good]]:
     :param m:
     :return:
     """
+    # The index of the market holds the order of allocation of campaigns, the goods each campaign demands and the competitors of each good.
+    index = m.get_index()
+
     # Book keeping structures
-    alloca = {c: {g: 0 for g in m.goods} for c in m.campaigns}
+    alloca = CampaignGoodMatrix(m.campaigns, m.goods, dtype=int)
     prices = {c: {g: g.reserve_price for g in m.goods} for c in m.campaigns}
     total_allocation = {c: 0 for c in m.campaigns}
-    # Sort a shallow copy of campaigns to get the order of allocation
-    list_of_ordered_campaigns = Sorting.copy_and_sort_campaigns(m.campaigns)
     # Keep track of the remaining supply
     remaining_supply = {g: g.supply for g in m.goods}
+    # The campaign with the second highest bid of each good, which does not depend on the allocation, hence is only computed once per good.
+    campaign_with_2nd_high_of_good = {}
 
     # Allocate each campaign in order
-    for c in list_of_ordered_campaigns:
+    for c in index.ordered_campaigns:
         # Check if the campaign can be satisfied with the remaining supply
-        if sum([remaining_supply[g] for g in m.goods if g.__matches__(c.target)]) >= c.reach:
-            list_of_c_demanded_goods = list(filter(lambda g: g.__matches__(c.target), m.goods))
+        if sum([remaining_supply[g] for g in index.demanded_goods[c]]) >= c.reach:
             second_highest = []
-            for g in list_of_c_demanded_goods:
-                # Get the competing campaigns, i.e., those that demand g. Filter bids that do not meet reserve and add an Auctioneer bid with the reserve price.
-                list_of_competition = list(filter(lambda x: x.budget / x.reach >= g.reserve_price, [c for c in list_of_ordered_campaigns if g.__matches__(c.target)])) \
-                                      + [Campaign("Auctioneer", 1, g.reserve_price, g)]
-                # Order by descending order of bids
-                list_of_competition = Sorting.copy_and_sort_campaigns(list_of_competition)
-                # Compute the campaign that has the second highest bid. Note that this is always something, as the Auctioneer's bid is always there.
-                campaign_with_2nd_high = list_of_competition[1] if len(list_of_competition) > 1 else list_of_competition[0]
-                assert (campaign_with_2nd_high.budget / campaign_with_2nd_high.reach) >= 0
-                second_highest += [(g, campaign_with_2nd_high)]
+            for g in index.demanded_goods[c]:
+                if g not in campaign_with_2nd_high_of_good:
+                    # Get the competing campaigns, i.e., those that demand g, in descending order of bids. Filter bids that do not meet reserve.
+                    list_of_competition = [x for x in index.competitors[g] if index.bid_per_reach[x] >= g.reserve_price]
+                    # Compute the campaign that has the second highest bid. If there is none, this is an Auctioneer bid with the reserve price.
+                    campaign_with_2nd_high_of_good[g] = list_of_competition[1] if len(list_of_competition) > 1 else Campaign("Auctioneer", 1, g.reserve_price, g)
+                    assert (campaign_with_2nd_high_of_good[g].budget / campaign_with_2nd_high_of_good[g].reach) >= 0
+                second_highest += [(g, campaign_with_2nd_high_of_good[g])]
             # Sort the selected campaigns by ascending order of bids.
             second_highest.sort(key=lambda x: x[1], reverse=False)
             # Allocate greedily from all goods in ascending order of second_highest bid.
@@ -57,9 +60,63 @@ def waterfall(m: Market) -> Tuple[Allocation, Dict[Campaign, Good]]:
     return Allocation(m, alloca), prices
 
 
-def wf_strategy(market: Market) -> List[Bid]:
+def waterfall_heap(m: Market) -> Tuple[Allocation, Dict[Campaign, Good]]:
+    """
+    Given a market, run the waterfall algorithm, with the same result as waterfall but in time linear in the size of the market, so that it
+    scales to markets with hundreds of campaigns. The second highest bid of each good is kept in a heap of its two highest eligible bids, filled
+    in a single pass over the demand of campaigns, and campaigns and goods are handled by their index in the market.
+    :param m:
+    :return:
+    """
+    index = m.get_index()
+    goods = m.goods
+    matches = index.matches.tolist()
+    demanded_goods = [[j for j, match in enumerate(matches[i]) if match] for i in range(0, len(m.campaigns))]
+    bid_per_reach = [index.bid_per_reach[c] for c in m.campaigns]
+    reserve_prices = [g.reserve_price for g in goods]
+    # The two highest bids per reach at least the reserve price of each good. With less than two, the second highest bid is the reserve price.
+    top_two_bids = [[] for _ in goods]
+    for i in range(0, len(m.campaigns)):
+        for j in demanded_goods[i]:
+            if bid_per_reach[i] >= reserve_prices[j]:
+                if len(top_two_bids[j]) < 2:
+                    heapq.heappush(top_two_bids[j], bid_per_reach[i])
+                else:
+                    heapq.heappushpop(top_two_bids[j], bid_per_reach[i])
+    second_highest_bid = [heap[0] if len(heap) == 2 else reserve_price for heap, reserve_price in zip(top_two_bids, reserve_prices)]
+
+    alloca = [[0] * len(goods) for _ in m.campaigns]
+    prices = [list(reserve_prices) for _ in m.campaigns]
+    remaining_supply = [g.supply for g in goods]
+    for c in index.ordered_campaigns:
+        i = index.campaign_index[c]
+        if sum([remaining_supply[j] for j in demanded_goods[i]]) >= c.reach:
+            # Goods in ascending order of second highest bid. waterfall sorts campaigns, whose comparison is <=, which puts ties in reverse order.
+            total_allocation = 0
+            for j in sorted(reversed(demanded_goods[i]), key=second_highest_bid.__getitem__):
+                alloca[i][j] = min(remaining_supply[j], c.reach - total_allocation)
+                if alloca[i][j] > 0:
+                    remaining_supply[j] -= alloca[i][j]
+                    total_allocation += alloca[i][j]
+                    prices[i][j] = second_highest_bid[j]
+            # If the allocated bundle is too expensive, give all the goods back. As in waterfall, they do not return to the remaining supply.
+            if sum([alloca[i][j] * prices[i][j] for j in demanded_goods[i]]) > c.budget:
+                for j in demanded_goods[i]:
+                    alloca[i][j] = 0
+                    prices[i][j] = reserve_prices[j]
+    allocation = CampaignGoodMatrix(m.campaigns, goods, np.array(alloca, dtype=int).reshape(len(m.campaigns), len(goods)))
+    return Allocation(m, allocation), {c: dict(zip(goods, prices[i])) for i, c in enumerate(m.campaigns)}
+
+
+# The implementations of the waterfall algorithm, by name.
+waterfall_algorithms = {"reference": waterfall,
+                        "heap": waterfall_heap}
+
+
+def wf_strategy(market: Market, algorithm: str = 'heap') -> List[Bid]:
     # The wf strategy is to bid only on those goods for which the bidder was allocated.
     # The bid is (bid, limit) = (p_cg, p_cg x_cg) in case p_cg >0; otherwise the bid is (bid, limit) = (0.0, c.budget) in case p_g=0.
-    wf_alloca, wf_prices = waterfall(market)
+    # The algorithm is the key in waterfall_algorithms of the implementation of the waterfall algorithm.
+    wf_alloca, wf_prices = waterfall_algorithms[algorithm](market)
     return [Bid(c, g, wf_prices[c][g], wf_alloca.allocation[c][g] * wf_prices[c][g] if wf_prices[c][g] > 0 else c.budget)
             for c in market.campaigns for g in market.goods if wf_alloca.allocation[c][g] > 0]
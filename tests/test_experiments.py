@@ -0,0 +1,230 @@
+import copy
+import os
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# The experiments modules import each other as top level modules, as when they are run as scripts from their directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'experiments'))
+
+import experiments
+from game.game import ImpressionSampler, CampaignSampler, get_random_generator
+from game.results import ResultsAggregate
+from game.structures import Market
+from gt.brg import get_undecided_edges
+from singletonsetup import SingletonSetup
+from we_wf_experiments import run_we_wf_profiles, play_we_wf_profile, compute_we_wf_bids
+
+
+def get_setup(reserve_price: float = 0.2) -> SingletonSetup:
+    """
+    :param reserve_price: the reserve price of every base good.
+    :return: a small setup, with 40 games per profile. The setup is a singleton, so all tests share it.
+    """
+    setup_obj = SingletonSetup('test', 100, 3, 1.0, 0.1, 0.1, 5)
+    setup_obj.number_of_samples_per_profile = lambda: 40
+    SingletonSetup.set_reserve_prices({g: reserve_price for g in setup_obj.base_goods})
+    return setup_obj
+
+
+def sort_results(results) -> pd.DataFrame:
+    # Missing values are filled, since NaN is not equal to itself.
+    return pd.DataFrame(results, columns=experiments.results_columns).sort_values(['num_WE', 'sample', 'game']).fillna(-1).reset_index(drop=True)
+
+
+class TestExperiments():
+
+    def test_checkpoint_restore(self):
+        setup_obj = get_setup()
+        jobs = experiments.get_sampling_jobs(setup_obj, [0, 1], 0, 100, 100, seed=1)
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = experiments.Checkpoint(os.path.join(directory, 'results.csv.checkpoint'), 1)
+            assert experiments.Checkpoint.read_seed(checkpoint.directory) == 1
+            function, arguments = jobs[0]
+            # Chunks of profile 0 with a gap between them, and a chunk that overlaps the last one.
+            for start, end in [(50, 70), (0, 20), (60, 80)]:
+                checkpoint.save(setup_obj, function, {**arguments, 'start': start, 'end': end}, False, [(start, end)])
+            results, missing_jobs = checkpoint.restore(setup_obj, jobs, False)
+            assert results == [[(0, 20)], [(50, 70)]]
+            assert [(a['num_we'], a['start'], a['end']) for _, a in missing_jobs] == [(0, 20, 50), (0, 70, 100), (1, 0, 100)]
+            # Chunks of other jobs, or of aggregated jobs, are not restored.
+            assert checkpoint.restore(setup_obj, experiments.get_sampling_jobs(setup_obj, [0], 0, 100, 100, seed=2), False)[0] == []
+            assert checkpoint.restore(setup_obj, jobs, True)[0] == []
+            # Nor are chunks played at other reserve prices.
+            assert checkpoint.restore(get_setup(0.3), jobs, False)[0] == []
+            get_setup()
+            checkpoint.clear()
+            assert not os.path.exists(checkpoint.directory)
+
+    def test_checkpoint_resume(self):
+        setup_obj = get_setup()
+        jobs = experiments.get_sampling_jobs(setup_obj, [0, 3], 0, 40, 40, seed=5)
+        expected = sort_results(experiments.run_sampling_jobs(setup_obj, jobs, chunk_size=10))
+        calls = []
+
+        def failing_run_a_game_on_range(**arguments):
+            # Games from 20 on fail, e.g., because the machine was preempted.
+            calls.append(arguments['start'])
+            if failing and arguments['start'] >= 20:
+                raise Exception('preempted')
+            return experiments.run_a_game_on_range(**arguments)
+
+        failing_run_a_game_on_range.__name__ = 'run_a_game_on_range'
+        failing_jobs = [(failing_run_a_game_on_range, arguments) for _, arguments in jobs]
+        current_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as directory:
+            # Errors are logged relative to the working directory.
+            os.chdir(directory)
+            try:
+                checkpoint = experiments.Checkpoint(os.path.join(directory, 'results.csv.checkpoint'), 5)
+                failing = True
+                with pytest.raises(Exception, match='4 chunks failed 2 times'):
+                    experiments.run_sampling_jobs(setup_obj, failing_jobs, chunk_size=10, checkpoint=checkpoint, max_retries=1)
+                # Each failing chunk is played once, and then retried once.
+                assert sorted(calls) == [0, 0, 10, 10] + [20] * 4 + [30] * 4
+                # A restart only plays the chunks that failed, and gives the same results as if nothing failed.
+                failing, calls = False, []
+                results = experiments.run_sampling_jobs(setup_obj, failing_jobs, chunk_size=10, checkpoint=checkpoint)
+                assert sorted(calls) == [20, 20, 30, 30]
+                assert sort_results(results).equals(expected)
+            finally:
+                os.chdir(current_directory)
+
+    def test_chunk_scheduler(self):
+        jobs = [(None, dict(start=0, end=100)), (None, dict(start=10, end=50))]
+        scheduler = experiments.ChunkScheduler(jobs, workers=2, target_time=1.0, min_chunk_size=5, max_chunk_size=30)
+        get_range = lambda chunk: (chunk[0], chunk[1][1]['start'], chunk[1][1]['end'])
+        # Every job starts with a pilot chunk, and while nothing is measured, the first pending job keeps getting pilot chunks.
+        chunks = [scheduler.next_chunk() for _ in range(0, 3)]
+        assert [get_range(chunk) for chunk in chunks] == [(0, 0, 5), (1, 10, 15), (0, 5, 10)]
+        # Job 0 plays 100 games per second, and job 1, not measured yet, is assumed as fast as all jobs so far. Job 0 has the most time left, and its
+        # chunk would take the time left of both jobs split among workers, (90 + 35) / 100 / 2 seconds, but is clamped to max_chunk_size.
+        scheduler.record(0, 5, 0.05)
+        chunks.append(scheduler.next_chunk())
+        assert get_range(chunks[-1]) == (0, 10, 40)
+        # Job 1 plays 10 games per second, so it has the most time left, 35 / 10 seconds, and its chunk takes target_time.
+        scheduler.record(1, 5, 0.5)
+        chunks.append(scheduler.next_chunk())
+        assert get_range(chunks[-1]) == (1, 15, 25)
+        # Towards the end, chunks shrink down to min_chunk_size, and never go past the end of their job.
+        throughput = [100.0, 10.0]
+        for chunk in chunks[2:]:
+            scheduler.record(chunk[0], chunk[1][1]['end'] - chunk[1][1]['start'], (chunk[1][1]['end'] - chunk[1][1]['start']) / throughput[chunk[0]])
+        while True:
+            chunk = scheduler.next_chunk()
+            if chunk is None:
+                break
+            chunks.append(chunk)
+            j, size = chunk[0], chunk[1][1]['end'] - chunk[1][1]['start']
+            assert 0 < size <= 30 and (size >= 5 or chunk[1][1]['end'] == jobs[j][1]['end'])
+            scheduler.record(j, size, size / throughput[j])
+        assert 5 in [chunk[1][1]['end'] - chunk[1][1]['start'] for chunk in chunks[5:] if chunk[1][1]['end'] < jobs[chunk[0]][1]['end']]
+        # The chunks of each job cover its range exactly, without overlaps.
+        for j, (_, arguments) in enumerate(jobs):
+            ranges = sorted([(start, end) for i, start, end in map(get_range, chunks) if i == j])
+            assert ranges[0][0] == arguments['start'] and ranges[-1][1] == arguments['end']
+            assert all([end == next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:])])
+        report = scheduler.get_report()
+        assert report['chunks'] == len(chunks) and report['games'] == 140
+
+    def test_simulation_pool(self):
+        setup_obj = get_setup()
+        jobs = experiments.get_sampling_jobs(setup_obj, [0, 3], 0, 20, 20, seed=3)
+        experiments.simulation_pool = experiments.SimulationPool(setup_obj, 2)
+        try:
+            results = {}
+            for reserve_price in [0.2, 1.0]:
+                # The pool is started once, and only learns the reserve prices of each call with its jobs.
+                get_setup(reserve_price)
+                results[reserve_price] = sort_results(experiments.run_sampling_jobs(setup_obj, jobs, serial=True))
+                assert sort_results(experiments.run_sampling_jobs(setup_obj, jobs, serial=False, chunk_size=5)).equals(results[reserve_price])
+            assert experiments.get_simulation_pool(setup_obj) is experiments.simulation_pool
+            assert not np.allclose(results[0.2]['revenue'], results[1.0]['revenue'])
+        finally:
+            experiments.shutdown_simulation_pool()
+            get_setup()
+
+    def test_common_random_numbers(self):
+        setup_obj = get_setup()
+        draws = []
+
+        class RecordingImpressionSampler(ImpressionSampler):
+            def draw(self, k, rng=None):
+                draws.append(super().draw(k, rng))
+                return draws[-1]
+
+            def draw_counts(self, k, rng=None):
+                counts = super().draw_counts(k, rng)
+                draws.append(counts.counts)
+                return counts
+
+        sampler = RecordingImpressionSampler(setup_obj.base_goods, setup_obj.pmf_base_goods)
+        for auction_engine in ['reference', 'event_driven']:
+            draws.clear()
+            games = run_we_wf_profiles(setup_obj.reach_discount_factor, setup_obj.k, setup_obj.n, setup_obj.base_goods, setup_obj.pmf_base_goods,
+                                       setup_obj.possible_campaign_targets, setup_obj.pmf_target_goods, auction_engine=auction_engine,
+                                       rng=get_random_generator(3, (4, 0)), impression_sampler=sampler)
+            # All profiles are played by the same campaigns, on the same impression opportunities, drawn once.
+            assert len(games) == setup_obj.n + 1 and len(draws) == 1
+            campaigns = games[0][0] + games[0][1]
+            for num_we, (we_c, wf_c, _, _, _) in enumerate(games):
+                assert len(we_c) == num_we and all([c is d for c, d in zip(we_c + wf_c, campaigns)])
+            # Each profile is the game play_we_wf_profile plays on the same market, drawn from the same stream.
+            rng = get_random_generator(3, (4, 0))
+            market_campaigns = CampaignSampler(setup_obj.n, setup_obj.reach_discount_factor, setup_obj.k, setup_obj.possible_campaign_targets,
+                                               setup_obj.pmf_target_goods).draw(1, rng)[0]
+            assert [(c.reach, c.budget) for c in market_campaigns] == [(c.reach, c.budget) for c in campaigns]
+            market = Market(market_campaigns, setup_obj.base_goods)
+            we_bids, wf_bids = compute_we_wf_bids(market)
+            impression_opportunities = sampler.draw_counts(setup_obj.k, rng) if auction_engine == 'event_driven' else sampler.draw(setup_obj.k, rng)
+            assert np.array_equal(draws[0], draws[1])
+            for num_we, (_, _, allocations, expenditure, _) in enumerate(games):
+                _, _, the_allocations, the_expenditure, _ = play_we_wf_profile(num_we, setup_obj.n - num_we, market, we_bids, wf_bids,
+                                                                               impression_opportunities, auction_engine=auction_engine, rng=copy.deepcopy(rng))
+                assert np.array_equal(allocations.values, the_allocations.values)
+                assert np.allclose(expenditure.values, the_expenditure.values)
+
+    def test_effective_number_of_samples(self):
+        assert experiments.summarize_utilities([1.0, 3.0], [2.0], 5.0) == (2.0, 2.0, 5.0, 1.0, 0.0)
+        columns = ['num_WE', 'num_WF', 'we', 'wf', 'we_var', 'wf_var']
+        results = pd.DataFrame(
+            # 2 WE players, uncorrelated within a game: the variance among them is the variance of a player, twice the variance of their mean.
+            [(2, 1, we, we, 0.25, 0.0) for we in [0.0, 1.0, 0.0, 1.0]]
+            # 3 WE players, perfectly correlated within a game: they always have the same utility.
+            + [(3, 0, we, 0.0, 0.0, 0.0) for we in [0.0, 1.0, 0.0, 1.0]]
+            # 1 WE player, whose utility never changes.
+            + [(1, 2, 0.5, we, 0.0, 0.0) for we in [0.0, 1.0, 0.0, 1.0]], columns=columns)
+        samples = experiments.compute_effective_number_of_samples(results).set_index('num_WE')
+        assert samples.loc[2, 'games'] == 4 and samples.loc[2, 'we_samples'] == 4 * 2 and samples.loc[2, 'wf_samples'] == 4
+        assert samples.loc[3, 'we_samples'] == 4 and samples.loc[3, 'wf_samples'] == 0
+        assert samples.loc[1, 'we_samples'] == 4 and samples.loc[1, 'wf_samples'] == 4
+        # Estimates are clipped between the number of games and the number of games times the number of players.
+        results.loc[results['num_WE'] == 2, 'we_var'] = 10.0
+        assert experiments.compute_effective_number_of_samples(results).set_index('num_WE').loc[2, 'we_samples'] == 4 * 2
+
+    def test_adaptive_estimation(self):
+        setup_obj = get_setup()
+        eps = setup_obj.eps
+        # Enough games for the edges to be decided, with common random numbers, before all of them are played.
+        setup_obj.number_of_samples_per_profile, setup_obj.eps = lambda: 400, 0.2
+        try:
+            games, results = experiments.estimate_a_single_game_adaptively(setup_obj, round_size=50, common_random_numbers=True, seed=3)
+            assert list(games['games']) == [200] * (setup_obj.n + 1)
+            assert len(results) == 200 * (setup_obj.n + 1)
+            delta = setup_obj.delta / (2 * setup_obj.n * 8 * setup_obj.budget)
+            assert get_undecided_edges(pd.DataFrame(results, columns=experiments.results_columns), setup_obj.eps, delta, True) == []
+            with tempfile.TemporaryDirectory() as directory:
+                file = os.path.join(directory, 'results.json')
+                the_games, the_results = experiments.estimate_a_single_game_adaptively(setup_obj, file, round_size=50, common_random_numbers=True,
+                                                                                       seed=3, checkpoint=True)
+                assert the_games.equals(games)
+                assert sort_results(the_results).equals(sort_results(results))
+                # The aggregate of the games played is saved, and the checkpoint is cleared.
+                assert list(ResultsAggregate.load(file).to_frame()['games']) == list(games['games'])
+                assert os.listdir(directory) == ['results.json']
+        finally:
+            setup_obj.eps = eps
+            get_setup()
@@ -1,13 +1,23 @@
 import itertools
 import math
+import os
+import random
+import tempfile
 
 import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import pytest
 
-from game.game import run_auctions, draw_one_impression_opportunity
-from game.statistics import compute_statistics, compute_sigmoidal_effective_reach_ratio
-from game.structures import Campaign, Good, Market, Bid, PrettyPrints, Sorting, Allocation
-from strategies.WE import greedy_allocation, pricing, we_strategy
-from strategies.WF import waterfall, wf_strategy
+from game.game import run_auctions, draw_one_impression_opportunity, run_auctions_vectorized, run_auctions_event_driven, ImpressionSampler, ImpressionCounts, CampaignSampler, \
+    get_random_generator
+from game.results import ResultsWriter, read_results, ResultsAggregate, results_schema
+from game.statistics import compute_statistics, compute_sigmoidal_effective_reach_ratio, compute_statistics_batch, compute_target_match_mask
+from game.structures import Campaign, Good, Market, Bid, PrettyPrints, Sorting, Allocation, SpendLedger, BidBook, CampaignGoodMatrix, MarketIndex, \
+    MarketSegments
+from strategies.WE import greedy_allocation, pricing, we_strategy, pricing_pulp, pricing_highs, pricing_difference_constraints, PricingCache, pricing_backends
+from strategies.WF import waterfall, wf_strategy, waterfall_heap
+from gt.brg import get_undecided_edges, compute_empirical_bernstein_radius, compute_paired_differences, compute_eps_brg
 
 
 class TestGreedyAllocation():
@@ -57,6 +67,25 @@ class TestGreedyAllocation():
             assert allocation.get_total_good_allocation(g) <= g.supply
         return allocation
 
+    def test_market_index(self):
+        m = TestGreedyAllocation.get_market_1()
+        index = m.get_index()
+        assert m.get_index() is index
+        c1, c2, c3 = m.campaigns
+        g1, g2, g3, g4 = m.goods
+        assert index.ordered_campaigns == [c3, c2, c1]
+        assert index.ordered_goods == Sorting.copy_and_sort_goods(m.goods)
+        for i, c in enumerate(m.campaigns):
+            assert index.bid_per_reach[c] == c.budget / c.reach
+            for j, g in enumerate(m.goods):
+                assert index.matches[i, j] == g.__matches__(c.target)
+        assert index.demanded_goods[c1] == [g1, g2, g3] and index.ordered_demanded_goods[c1] == [g2, g3, g1]
+        assert index.competitors[g2] == [c2, c1] and index.competitors[g4] == [c3]
+        # Campaigns with the same bid per reach keep their market order.
+        c4 = Campaign("C4", 50, 61.75, Good({"Male"}, -1, -1))
+        assert MarketIndex(Market([c4, c1, c2], m.goods)).ordered_campaigns == [c2, c4, c1]
+        assert MarketIndex(Market([c1, c4, c2], m.goods)).ordered_campaigns == [c2, c1, c4]
+
     def test_greedy_allocation_1(self):
         g1 = Good({"Male", "Young", "High"}, 200, 1.0)
         c1 = Campaign("C1", 50, 100.0, Good({"Male"}, -1, -1))
@@ -88,6 +117,62 @@ class TestGreedyAllocation():
         print("\n*** WE Strategy ***")
         print(PrettyPrints.get_bids_pretty_table(bids))
 
+    def test_pricing_backends(self):
+        # The pricing LP can have several optimal solutions, so the other backends must reach the same objective as PuLP with feasible prices.
+        random.seed(0)
+        goods = [Good({"Male", "Young"}, 50, 0.5), Good({"Male", "Old"}, 80, 0.2), Good({"Female", "Young"}, 60, 0.9),
+                 Good({"Female", "Old"}, 40, 0.0), Good({"Male", "Young", "High"}, 30, 1.2)]
+        targets = [Good({"Male"}, -1, -1), Good({"Young"}, -1, -1), Good({"Female", "Old"}, -1, -1), Good({"Male", "Young"}, -1, -1)]
+        for _ in range(0, 40):
+            campaigns = []
+            for i in range(0, random.randint(1, 8)):
+                reach = random.randint(10, 120)
+                campaigns.append(Campaign("C" + str(i), reach, reach * random.uniform(0.5, 1.5), random.choice(targets)))
+            allocation = greedy_allocation(Market(campaigns, goods))
+            x = allocation.allocation
+            objective = {}
+            for name, prices in [("pulp", pricing_pulp(allocation)), ("highs", pricing_highs(allocation)),
+                                 ("difference_constraints", pricing_difference_constraints(allocation))]:
+                # Revenue minus the smallest slacks compatible with the prices.
+                objective[name] = sum([prices[g] * allocation.get_total_good_allocation(g) for g in goods]) - \
+                                  sum([max(0.0, prices[i] - prices[k]) for c in campaigns for i in goods for k in goods
+                                       if x[c][i] > 0 and i != k and k.__matches__(c.target) and x[c][k] < k.supply])
+                for g in goods:
+                    assert prices[g] >= max(0.0, g.reserve_price) - 1e-6
+                for c in campaigns:
+                    assert sum([prices[g] * x[c][g] for g in goods]) <= c.budget * (1 + 1e-6)
+            assert math.isclose(objective["pulp"], objective["highs"], rel_tol=1e-6, abs_tol=1e-6)
+            assert math.isclose(objective["pulp"], objective["difference_constraints"], rel_tol=1e-6, abs_tol=1e-6)
+
+    def test_pricing_backends_unique_optimum(self):
+        # Budgets of C1 and C2 are binding, so the LP has a single optimal solution, which all backends must find.
+        market = TestGreedyAllocation.get_market_1()
+        allocation = greedy_allocation(market)
+        g1, g2, g3, g4 = market.goods
+        expected = {g1: (130.5 - 25 * 1.4) / 75, g2: 1.4, g3: (123.5 - 50 * (130.5 - 25 * 1.4) / 75) / 50, g4: 130.5 / 25}
+        for backend in pricing_backends:
+            prices = pricing(allocation, backend)
+            for g in market.goods:
+                assert math.isclose(prices[g], expected[g], rel_tol=1e-6), (backend, g)
+            assert pricing(allocation) == pricing_difference_constraints(allocation)
+
+    def test_pricing_cache(self):
+        m = TestGreedyAllocation.get_market_1()
+        cache = PricingCache(maxsize=2)
+        prices = cache.get_prices(greedy_allocation(m), 'difference_constraints')
+        assert prices == pricing(greedy_allocation(m), use_cache=False)
+        # The order of campaigns does not matter.
+        assert cache.get_prices(greedy_allocation(Market(m.campaigns[::-1], m.goods)), 'difference_constraints') == prices
+        assert (cache.hits, cache.misses) == (1, 1)
+        cache.get_prices(greedy_allocation(m), 'highs')
+        m.goods[0].reserve_price += 0.01
+        cache.get_prices(greedy_allocation(m), 'difference_constraints')
+        assert (cache.hits, cache.misses) == (1, 3)
+        # The least recently used entry was evicted.
+        m.goods[0].reserve_price -= 0.01
+        cache.get_prices(greedy_allocation(m), 'difference_constraints')
+        assert (cache.hits, cache.misses) == (1, 4) and len(cache.entries) == 2
+
     def test_wf(self):
         some_goods = [Good({"Male"}, 10, 0.0),
                       Good({"Female", "Young"}, 100, 0.0),
@@ -118,13 +203,38 @@ class TestGreedyAllocation():
 
     def test_draw_impression_opportunities(self):
         # Just making sure the distribution is correctly implemented.
-        # counts = {g: 0 for g in goods}
-        # for i in impression_opportunities:
-        #    counts[i] += 1
-
-        # for g, count in counts.items():
-        #    print("count = ", g, "\t", count / k)
-        pass
+        goods = [Good({"Male"}, -1, -1), Good({"Female", "Young"}, -1, -1), Good({"Female", "Old"}, -1, -1)]
+        pmf = {goods[0]: 0.5, goods[1]: 0.3, goods[2]: 0.2}
+        k = 10000
+        sampler = ImpressionSampler(goods, pmf)
+        # The stream is drawn with the same uniform draws as draw_one_impression_opportunity.
+        np.random.seed(0)
+        impression_opportunities = [draw_one_impression_opportunity(pmf) for _ in range(0, 100)]
+        np.random.seed(0)
+        assert [goods[j] for j in sampler.draw(100)] == impression_opportunities
+        counts = np.bincount(sampler.draw(k), minlength=len(goods))
+        impression_counts = sampler.draw_counts(k).counts
+        assert counts.sum() == k and impression_counts.sum() == k
+        for j, g in enumerate(goods):
+            assert abs(counts[j] / k - pmf[g]) < 0.05
+            assert abs(impression_counts[j] / k - pmf[g]) < 0.05
+
+    def test_draw_campaigns(self):
+        goods = [Good({"Male"}, -1, -1), Good({"Female", "Young"}, -1, -1), Good({"Female", "Old"}, -1, -1)]
+        pmf = {goods[0]: 0.5, goods[1]: 0.3, goods[2]: 0.2}
+        sampler = CampaignSampler(4, 0.8, 1000, goods, pmf)
+        np.random.seed(0)
+        games = sampler.draw(500)
+        assert len(games) == 500
+        for campaigns in games:
+            assert [c.id for c in campaigns] == list(range(0, 4))
+            assert len(set(campaigns)) == 4
+            for c in campaigns:
+                assert c.reach == math.ceil((0.8 * 1000 * pmf[c.target]) / 4)
+                assert 0.5 * c.reach <= c.budget <= 1.5 * c.reach
+        targets = [c.target for campaigns in games for c in campaigns]
+        for g in goods:
+            assert abs(targets.count(g) / len(targets) - 1 / 3) < 0.05
 
     def test_run_auctions(self):
         print("\t ****** \t")
@@ -150,6 +260,186 @@ class TestGreedyAllocation():
         print("allocations = ", Allocation(Market(campaigns, goods), allocations))
         print("expenditure = ", PrettyPrints.get_expenditure_pretty_table(expenditure))
 
+    def test_run_auctions_vectorized(self):
+        goods = [Good({"Male", "Young"}, 60, 0.1), Good({"Male", "Old"}, 30, 0.0), Good({"Female", "Young"}, 10, 0.2)]
+        campaigns = [Campaign("Agent 1", 10, 10.0, Good({"Male"}, -1, -1)),
+                     Campaign("Agent 2", 20, 15.0, Good({"Male", "Young"}, -1, -1)),
+                     Campaign("Agent 3", 5, 10.0, Good({"Young"}, -1, -1))]
+        # Overlapping bids, ties and limits that are reached half way through the impressions.
+        all_agents_bids = [Bid(campaigns[0], Good({"Male"}, -1, -1), 0.5, 3.0),
+                           Bid(campaigns[0], goods[0], 0.7, 4.0),
+                           Bid(campaigns[1], goods[0], 0.7, 5.0),
+                           Bid(campaigns[1], Good({"Male", "Old"}, -1, -1), 0.3, 0.3),
+                           Bid(campaigns[2], Good({"Young"}, -1, -1), 0.1, 10.0),
+                           Bid(campaigns[2], goods[2], 0.7, 0.7)]
+        for seed in range(0, 10):
+            random.seed(seed)
+            impression_opportunities = [random.choice(goods) for _ in range(0, 100)]
+            state = random.getstate()
+            allocations, expenditure = run_auctions(impression_opportunities, goods, campaigns, all_agents_bids)
+            random.setstate(state)
+            vectorized_allocations, vectorized_expenditure = run_auctions_vectorized(impression_opportunities, goods, campaigns, all_agents_bids)
+            assert allocations == vectorized_allocations
+            assert expenditure == vectorized_expenditure
+
+    def test_random_streams(self):
+        goods = [Good({"Male", "Young"}, 60, 0.1), Good({"Male", "Old"}, 30, 0.0), Good({"Female", "Young"}, 10, 0.2)]
+        campaigns = [Campaign("Agent 1", 10, 10.0, Good({"Male"}, -1, -1)),
+                     Campaign("Agent 2", 20, 15.0, Good({"Male", "Young"}, -1, -1))]
+        # Ties in every auction of the first good, until a limit is reached.
+        all_agents_bids = [Bid(campaigns[0], goods[0], 0.7, 4.0), Bid(campaigns[1], goods[0], 0.7, 5.0), Bid(campaigns[1], goods[1], 0.3, 3.0)]
+        sampler = ImpressionSampler(goods, {goods[0]: 0.6, goods[1]: 0.3, goods[2]: 0.1})
+        outcomes = []
+        for key in [(0, 0), (0, 1), (0, 0)]:
+            rng = get_random_generator(42, key)
+            impression_opportunities = sampler.draw(100, rng)
+            state = rng.bit_generator.state
+            allocations, expenditure = run_auctions(impression_opportunities, goods, campaigns, all_agents_bids, rng=rng)
+            rng.bit_generator.state = state
+            assert (allocations, expenditure) == run_auctions_vectorized(impression_opportunities, goods, campaigns, all_agents_bids, rng=rng)
+            outcomes.append((impression_opportunities.tolist(), allocations.values.tolist()))
+        # The stream of a key is always the same, and streams of different keys differ.
+        assert outcomes[0] == outcomes[2]
+        assert outcomes[0] != outcomes[1]
+        pmf = {g: 1.0 / len(goods) for g in goods}
+        assert [c.budget for c in CampaignSampler(2, 1.0, 100, goods, pmf).draw(1, get_random_generator(1, (3,)))[0]] == \
+               [c.budget for c in CampaignSampler(2, 1.0, 100, goods, pmf).draw(1, get_random_generator(1, (3,)))[0]]
+
+    def test_good_masks(self):
+        # Segments that share an initial are still different segments. The new segment is registered for the whole process, so restore the registry.
+        bits, masks = dict(MarketSegments.bits), dict(MarketSegments.masks)
+        try:
+            assert Good({"Male"}, None, None) != Good({"Medium"}, None, None)
+            # Masks must fit in an int64, so only so many segments can be registered.
+            for i in range(len(MarketSegments.bits), MarketSegments.max_segments):
+                Good({"Segment " + str(i)}, None, None)
+            assert MarketSegments.bits["Segment " + str(MarketSegments.max_segments - 1)] == 1 << 62
+            with pytest.raises(Exception, match='at most 63 market segments'):
+                Good({"Male", "One too many"}, None, None)
+        finally:
+            MarketSegments.bits, MarketSegments.masks = bits, masks
+        assert "Medium" not in MarketSegments.bits
+        assert Good({"Male", "Young"}, 10, 1.0) == Good({"Young", "Male"}, 20, 2.0)
+        assert hash(Good({"Male", "Young"}, 10, 1.0)) == hash(Good({"Young", "Male"}, 20, 2.0))
+        assert Good({"Male", "Young", "High"}, None, None).__matches__(Good({"Male", "High"}, None, None))
+        assert not Good({"Male", "Young"}, None, None).__matches__(Good({"Male", "High"}, None, None))
+        # Every good matches the empty set of segments.
+        assert Good({"Female"}, None, None).__matches__(Good(set(), None, None))
+
+    def test_campaign_good_matrix(self):
+        m = TestGreedyAllocation.get_market_1()
+        allocation_dict = {c: {g: i + j for j, g in enumerate(m.goods)} for i, c in enumerate(m.campaigns)}
+        allocation = Allocation(m, allocation_dict)
+        assert isinstance(allocation.allocation, CampaignGoodMatrix)
+        assert allocation.allocation == allocation_dict
+        for c in m.campaigns:
+            assert allocation.get_total_campaign_allocation(c) == sum(allocation_dict[c].values())
+        for g in m.goods:
+            assert allocation.get_total_good_allocation(g) == sum(allocation_dict[c][g] for c in m.campaigns)
+        # Writes through the dictionary view land in the matrix.
+        matrix = CampaignGoodMatrix(m.campaigns, m.goods, dtype=int)
+        matrix[m.campaigns[1]][m.goods[2]] += 3
+        matrix.add(m.campaigns[1], m.goods[2], 1)
+        assert matrix.values[1, 2] == 4 and matrix.values.sum() == 4
+        assert matrix[m.campaigns[1]] == {g: 4 if g == m.goods[2] else 0 for g in m.goods}
+
+    def test_bid_book(self):
+        goods = [Good({"Male", "Young"}, 60, 0.1), Good({"Male", "Old"}, 30, 0.0), Good({"Female", "Young"}, 10, 0.2)]
+        campaigns = [Campaign("Agent 1", 10, 10.0, Good({"Male"}, -1, -1)),
+                     Campaign("Agent 2", 20, 15.0, Good({"Male", "Young"}, -1, -1)),
+                     Campaign("Agent 3", 5, 10.0, Good({"Young"}, -1, -1))]
+        all_agents_bids = [Bid(campaigns[0], Good({"Male"}, -1, -1), 0.5, 3.0),
+                           Bid(campaigns[0], goods[0], 0.7, 0.7),
+                           Bid(campaigns[1], goods[0], 0.7, 5.0),
+                           Bid(campaigns[2], Good({"Young"}, -1, -1), 0.05, 10.0),
+                           Bid(campaigns[2], goods[2], 0.15, 0.15)]
+        bid_book = BidBook(goods, campaigns, all_agents_bids)
+        # Ties are listed in the order of campaigns, with one bid per campaign.
+        winning_bids, price = bid_book.get_auction_outcome(goods[0])
+        assert [b.campaign for b in winning_bids] == [campaigns[0], campaigns[1]]
+        assert price == 0.7
+        winning_bids, price = bid_book.get_auction_outcome(goods[1])
+        assert winning_bids == [all_agents_bids[0]] and price == 0.0
+        # The bid of Agent 3 on goods[2] does not meet the reserve, so the only relevant bid is below the reserve as well.
+        winning_bids, price = bid_book.get_auction_outcome(goods[2])
+        assert winning_bids == [] and price == 0.0
+        # Once Agent 1 spends its limit on goods[0], its next best bid is still relevant and the outcome is computed without it.
+        ledger = SpendLedger(goods, campaigns, all_agents_bids)
+        ledger.record(campaigns[0], goods[0], 0.7)
+        bid_book.remove_exhausted_bids(campaigns[0], ledger)
+        winning_bids, price = bid_book.get_auction_outcome(goods[0])
+        assert winning_bids == [all_agents_bids[2]] and price == 0.5
+
+    def test_spend_ledger(self):
+        goods = [Good({"Male", "Young"}, 60, 0.1), Good({"Male", "Old"}, 30, 0.0), Good({"Female", "Young"}, 10, 0.2)]
+        campaigns = [Campaign("Agent 1", 10, 10.0, Good({"Male"}, -1, -1)),
+                     Campaign("Agent 2", 20, 15.0, Good({"Young"}, -1, -1))]
+        all_agents_bids = [Bid(campaigns[0], Good({"Male"}, -1, -1), 0.5, 3.0),
+                           Bid(campaigns[0], goods[0], 0.7, 4.0),
+                           Bid(campaigns[1], Good({"Young"}, -1, -1), 0.6, 5.0)]
+        random.seed(0)
+        impression_opportunities = [random.choice(goods) for _ in range(0, 100)]
+        ledger = SpendLedger(goods, campaigns, all_agents_bids)
+        allocations, expenditure = run_auctions(impression_opportunities, goods, campaigns, all_agents_bids, ledger)
+        for b in all_agents_bids:
+            matched_expenditure = sum([expenditure[b.campaign][g] for g in goods if g.__matches__(b.good)])
+            assert math.isclose(ledger.get_remaining_limit(b), b.limit - matched_expenditure, abs_tol=1e-9)
+        utilities, total_expenditure = compute_statistics(allocations, expenditure)
+        ledger_utilities, ledger_total_expenditure = compute_statistics(allocations, expenditure, ledger)
+        assert math.isclose(total_expenditure, ledger_total_expenditure)
+        for c in campaigns:
+            assert math.isclose(utilities[c], ledger_utilities[c])
+
+    def test_run_auctions_event_driven(self):
+        goods = [Good({"Male", "Young"}, 60, 0.05), Good({"Male", "Old"}, 30, 0.0), Good({"Female", "Young"}, 10, 0.2)]
+        campaigns = [Campaign("Agent 1", 10, 10.0, goods[0]),
+                     Campaign("Agent 2", 20, 15.0, goods[0]),
+                     Campaign("Agent 3", 5, 10.0, goods[1])]
+        # Without ties and with bids on single goods, the outcome only depends on the number of impressions of each good, not on their order.
+        all_agents_bids = [Bid(campaigns[0], goods[0], 0.73, 2.0),
+                           Bid(campaigns[1], goods[0], 0.31, 10.0),
+                           Bid(campaigns[2], goods[1], 0.42, 1.0)]
+        for seed in range(0, 10):
+            random.seed(seed)
+            impression_opportunities = [random.choice(goods) for _ in range(0, 100)]
+            allocations, expenditure = run_auctions(impression_opportunities, goods, campaigns, all_agents_bids)
+            event_allocations, event_expenditure = run_auctions_event_driven(impression_opportunities, goods, campaigns, all_agents_bids)
+            assert allocations == event_allocations
+            for c in campaigns:
+                for g in goods:
+                    assert math.isclose(expenditure[c][g], event_expenditure[c][g], abs_tol=1e-9)
+            # Only the number of impression opportunities of each good matters.
+            counts = ImpressionCounts(np.array([impression_opportunities.count(g) for g in goods]))
+            assert run_auctions_event_driven(counts, goods, campaigns, all_agents_bids)[0] == allocations
+
+    def test_run_auctions_event_driven_ties(self):
+        goods = [Good({"Male", "Young"}, 60, 0.1), Good({"Male", "Old"}, 30, 0.0)]
+        campaigns = [Campaign("Agent 1", 10, 10.0, goods[0]),
+                     Campaign("Agent 2", 20, 15.0, goods[0]),
+                     Campaign("Agent 3", 5, 10.0, Good({"Male"}, -1, -1)),
+                     Campaign("Agent 4", 5, 10.0, goods[1])]
+        # Ties on both goods, and limits that are reached within a few impressions of each other, so that several bids leave in the same window.
+        all_agents_bids = [Bid(campaigns[0], goods[0], 1.0, 4.0),
+                           Bid(campaigns[1], goods[0], 1.0, 5.0),
+                           Bid(campaigns[2], Good({"Male"}, -1, -1), 0.6, 3.0),
+                           Bid(campaigns[2], goods[1], 0.8, 2.4),
+                           Bid(campaigns[3], goods[1], 0.8, 2.4)]
+        sampler = ImpressionSampler(goods, {goods[0]: 0.6, goods[1]: 0.4})
+        rng = np.random.default_rng(7)
+        outcomes = {'reference': [], 'event': []}
+        for _ in range(0, 2000):
+            impression_opportunities = sampler.draw(30, rng)
+            for engine, run in [('reference', run_auctions), ('event', run_auctions_event_driven)]:
+                allocations, expenditure = run(impression_opportunities, goods, campaigns, all_agents_bids, rng=rng)
+                outcomes[engine].append(np.concatenate([[allocations[c][g] for c in campaigns for g in goods],
+                                                        [expenditure[c][g] for c in campaigns for g in goods]]))
+        reference, event = np.array(outcomes['reference']), np.array(outcomes['event'])
+        # Both engines draw from the same distribution, so their means only differ by sampling noise.
+        standard_error = np.sqrt((reference.var(axis=0) + event.var(axis=0)) / len(reference))
+        assert (np.abs(reference.mean(axis=0) - event.mean(axis=0)) <= 4.0 * standard_error + 1e-9).all()
+        # Ties are actually split, rather than always won by the same campaign.
+        assert reference[:, 0].std() > 0.0 and event[:, 0].std() > 0.0
+
     def test_game(self):
         # -- Common Parameters
         # Base Goods. These have meaningless supply, we just use them to identify the type of goods in the auction.
@@ -202,6 +492,28 @@ class TestGreedyAllocation():
             print(c, u)
         print("Total auctioneer revenue = ", total_expenditure)
 
+    def test_statistics_batch(self):
+        goods = [Good({"Male", "Young"}, 60, 0.0), Good({"Male", "Old"}, 30, 0.0), Good({"Female", "Young"}, 10, 0.0)]
+        campaigns = [Campaign("Agent 1", 10, 10.0, Good({"Male"}, -1, -1)),
+                     Campaign("Agent 2", 20, 15.0, Good({"Young"}, -1, -1))]
+        all_agents_bids = [Bid(campaigns[0], Good({"Male"}, -1, -1), 0.5, 3.0),
+                           Bid(campaigns[1], Good({"Young"}, -1, -1), 0.6, 5.0),
+                           Bid(campaigns[1], goods[1], 0.2, 1.0)]
+        games = []
+        for seed in range(0, 5):
+            random.seed(seed)
+            games.append(run_auctions([random.choice(goods) for _ in range(0, 50)], goods, campaigns, all_agents_bids))
+        utilities, revenue = compute_statistics_batch(allocations=np.stack([a.values for a, _ in games]),
+                                                      expenditure=np.stack([e.values for _, e in games]),
+                                                      matches_target=compute_target_match_mask(campaigns, goods),
+                                                      reaches=np.array([c.reach for c in campaigns]),
+                                                      budgets=np.array([c.budget for c in campaigns]))
+        for t, (allocations, expenditure) in enumerate(games):
+            game_utilities, total_expenditure = compute_statistics(allocations, expenditure)
+            assert math.isclose(revenue[t], total_expenditure)
+            for i, c in enumerate(campaigns):
+                assert math.isclose(utilities[t, i], game_utilities[c])
+
     def test_statistics(self):
         grid = [i for i in range(0, 200)]
         sigmoidal = [compute_sigmoidal_effective_reach_ratio(i, 100) for i in grid]
@@ -232,6 +544,121 @@ class TestGreedyAllocation():
         ordered_campaigns = Sorting.copy_and_sort_campaigns(market.campaigns)
         print(ordered_campaigns)
 
+    def test_waterfall_heap(self):
+        # Differential test against the reference waterfall, with equal reserve prices and bids so that ties occur.
+        random.seed(0)
+        segments = [{"Male", "Young"}, {"Male", "Old"}, {"Female", "Young"}, {"Female", "Old"}]
+        targets = [Good({"Male"}, -1, -1), Good({"Young"}, -1, -1), Good({"Female", "Old"}, -1, -1), Good({"Old"}, -1, -1)]
+        for _ in range(0, 200):
+            goods = [Good(segment, random.randint(20, 100), random.choice([0.0, 0.5, 1.0])) for segment in segments]
+            campaigns = []
+            for i in range(0, random.randint(1, 40)):
+                reach = random.randint(5, 60)
+                campaigns.append(Campaign("C" + str(i), reach, reach * random.choice([0.5, 1.0, 1.5, random.uniform(0.2, 2.0)]), random.choice(targets)))
+            reference_allocation, reference_prices = waterfall(Market(campaigns, goods))
+            allocation, prices = waterfall_heap(Market(campaigns, goods))
+            assert allocation.allocation == reference_allocation.allocation
+            assert prices == reference_prices
+
+    def test_undecided_edges(self):
+        assert compute_empirical_bernstein_radius(0.1, 1, 0.05) == math.inf
+        assert compute_empirical_bernstein_radius(0.1, 10000, 0.05) < compute_empirical_bernstein_radius(0.1, 100, 0.05)
+        # Two players. Differences in utilities along both edges are far from 2eps, so that both are decided once there are enough samples.
+        rows = []
+        for num_we, we, wf in [(0, 0.0, 0.5), (1, 1.0, 0.0), (2, 0.2, 0.0)]:
+            rows += [(num_we, 2 - num_we, we + noise, wf + noise, 0.0, 0.0, 0.0) for noise in np.random.default_rng(0).uniform(-0.01, 0.01, 500)]
+        data = pd.DataFrame(rows, columns=['num_WE', 'num_WF', 'we', 'wf', 'revenue', 'we_var', 'wf_var'])
+        assert get_undecided_edges(data, 0.05, 0.01) == []
+        assert get_undecided_edges(data.groupby('num_WE').head(3), 0.05, 0.01) == [0, 1]
+        assert get_undecided_edges(data[data['num_WE'] != 2], 0.05, 0.01) == [1]
+
+    def test_results_store(self):
+        rows = [(0, 2, 0.0, 0.5, 1.0, 0.0, 0.0, None, math.nan, 0.4, 0, 7),
+                (1, 1, 0.6, 0.3, 2.0, 0.0, 0.0, 3, 0.6, 0.3, 1, 7),
+                (2, 0, 1.0, 0.0, 3.0, 0.0, 0.0, 5, 1.0, math.nan, 2, 7)]
+        with tempfile.TemporaryDirectory() as directory:
+            writer = ResultsWriter(os.path.join(directory, 'results'))
+            writer.append(rows[:1])
+            writer.append(rows[1:])
+            data = read_results(os.path.join(directory, 'results'))
+            assert data['num_WE'].dtype == np.int8 and data['we'].dtype == np.float64
+            assert data['num_WE'].tolist() == [0, 1, 2] and data['revenue'].tolist() == [1.0, 2.0, 3.0] and data['seed'].tolist() == [7, 7, 7]
+            # None is stored as -1 in integer columns and read back as missing.
+            assert data['sample'].isna().tolist() == [True, False, False] and data['sample'][1] == 3
+            assert list(read_results(os.path.join(directory, 'results'), ['we', 'wf']).columns) == ['we', 'wf']
+            # Results saved before the binary store are still read.
+            data.to_csv(os.path.join(directory, 'results.csv'), index=False)
+            assert read_results(os.path.join(directory, 'results.csv'), ['num_WE', 'we'])['we'].tolist() == [0.0, 0.6, 1.0]
+            # A crash while appending leaves some columns longer than others, and rows not written to all columns are ignored.
+            with open(writer.get_path('num_WE'), 'ab') as f:
+                f.write(np.array([3], dtype=np.int8).tobytes())
+            assert len(read_results(os.path.join(directory, 'results'))) == 3
+
+    def test_results_aggregate(self):
+        rows = [(num_we, 3 - num_we, *np.random.uniform(0, 100, 5).tolist(), None, 0.0, 0.0, t, 1) for t in range(0, 200) for num_we in range(0, 4)]
+        data = pd.DataFrame(rows, columns=list(results_schema))
+        # Aggregating chunks and merging them is the same as aggregating all rows at once.
+        whole, merged = ResultsAggregate(), ResultsAggregate()
+        whole.add_rows(rows)
+        for start in range(0, len(rows), 150):
+            chunk = ResultsAggregate()
+            chunk.add_rows(rows[start:start + 150])
+            merged.merge(chunk)
+        for aggregate in [whole, merged]:
+            frame = aggregate.to_frame()
+            assert frame['games'].tolist() == [200] * 4
+            assert np.allclose(frame['we_mean'], data.groupby('num_WE')['we'].mean())
+            assert np.allclose(frame['revenue_var'], data.groupby('num_WE')['revenue'].var())
+            assert np.allclose(frame['wf_min'], data.groupby('num_WE')['wf'].min())
+        # Normalized means are the ones compute_eps_brg computes from all rows.
+        normalized = data.assign(we=(data['we'] - data['we'].min()) / (data['we'].max() - data['we'].min()))
+        assert np.allclose(merged.get_normalized_means()['we'], normalized.groupby('num_WE')['we'].mean())
+        with tempfile.TemporaryDirectory() as directory:
+            merged.save(os.path.join(directory, 'results.json'))
+            assert ResultsAggregate.load(os.path.join(directory, 'results.json')).to_frame().equals(merged.to_frame())
+
+    def test_eps_brg_in_memory(self):
+        rows = [(num_we, 3 - num_we, *np.random.uniform(0, 100, 5).tolist(), None, 0.0, 0.0, t, 1) for t in range(0, 50) for num_we in range(0, 4)]
+        aggregate = ResultsAggregate()
+        aggregate.add_rows(rows)
+        with tempfile.TemporaryDirectory() as directory:
+            pd.DataFrame(rows, columns=list(results_schema)).to_csv(os.path.join(directory, 'results.csv'), index=False)
+            G, revenue = compute_eps_brg(os.path.join(directory, 'results.csv'), eps=0.01, normalize_revenue=True)
+        # The rows, or their aggregate, in memory give the same BRG as the file.
+        for results in [rows, aggregate]:
+            G_in_memory, revenue_in_memory = compute_eps_brg(eps=0.01, normalize_revenue=True, results=results)
+            assert set(G_in_memory.edges) == set(G.edges)
+            assert np.allclose([revenue_in_memory[node] for node in revenue], list(revenue.values()))
+
+    def test_paired_differences(self):
+        # Two players on two markets. Market 1 is only played by profiles 0 and 1, and utilities are already in the 0-1 range.
+        columns = ['num_WE', 'num_WF', 'we', 'wf', 'revenue', 'we_var', 'wf_var', 'sample', 'deviator_we', 'deviator_wf']
+        data = pd.DataFrame([(0, 2, 0.0, 0.5, 0.0, 0.0, 0.0, 0, math.nan, 0.4),
+                             (1, 1, 0.6, 0.3, 0.0, 0.0, 0.0, 0, 0.6, 0.3),
+                             (2, 0, 1.0, 0.0, 0.0, 0.0, 0.0, 0, 1.0, math.nan),
+                             (0, 2, 0.0, 1.0, 0.0, 0.0, 0.0, 1, math.nan, 1.0),
+                             (1, 1, 0.5, 0.0, 0.0, 0.0, 0.0, 1, 0.5, 0.0)], columns=columns)
+        paired = compute_paired_differences(data)
+        assert paired['edge'].tolist() == [0, 0, 1]
+        assert paired['sample'].tolist() == [0, 1, 0]
+        assert np.allclose(paired['difference'], [0.6 - 0.4, 0.5 - 1.0, 1.0 - 0.3])
+        # Games without a sample, i.e., played on their own markets, are not paired.
+        assert len(compute_paired_differences(data.assign(sample=None))) == 0
+        assert get_undecided_edges(data, 0.05, 0.01, True) == [0, 1]
+        # The mean gain of edge 0 is -0.15, so only the backward deviation is a 2eps best response, and the mean gain of edge 1 is 0.7.
+        G, _ = compute_eps_brg(eps=0.05, paired_differences=paired, results=data)
+        assert set(G.edges) == {('1WE_1WF', '0WE_2WF'), ('1WE_1WF', '2WE_0WF')}
+        # An edge without paired differences is undecided, so it goes both ways.
+        G, _ = compute_eps_brg(eps=0.05, paired_differences=paired[paired['edge'] == 0], results=data)
+        assert set(G.edges) == {('1WE_1WF', '0WE_2WF'), ('1WE_1WF', '2WE_0WF'), ('2WE_0WF', '1WE_1WF')}
+        # Deviating players can be outside the range of the mean utilities, and are normalized together with them, here, we from 0 to 1.5 and wf
+        # from -0.5 to 1.0.
+        data.loc[data['num_WE'] == 2, 'deviator_we'] = 1.5
+        data.loc[(data['num_WE'] == 0) & (data['sample'] == 1), 'deviator_wf'] = -0.5
+        paired = compute_paired_differences(data)
+        assert paired['difference'].between(-1.0, 1.0).all()
+        assert np.allclose(paired['difference'], [(0.6 - 0.9) / 1.5, (0.5 - 0.0) / 1.5, (1.5 - 0.8) / 1.5])
+
     def test_new_wf(self):
         market = TestGreedyAllocation.get_market_1()
         allocation, prices = waterfall(market)